@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { supabase } from '@/lib/supabase';
+import { callRecommenderService } from '@/lib/recommender-service';
 import { spawn } from 'child_process';
 import path from 'path';
 import { createClient } from '@/utils/supabase/server';
@@ -155,6 +156,27 @@ export async function POST(req: NextRequest) {
       }
     }
 
+    // Prefer the warm recommender service; only spawn the script if it is unavailable
+    const serviceResponse = await callRecommenderService('/recommend/size', {
+      height: user_height_cm,
+      weight: user_weight_kg,
+      product_data: product,
+      measurements: userMeasurements
+    });
+
+    if (serviceResponse) {
+      if (serviceResponse.status !== 200 || serviceResponse.data.error) {
+        return NextResponse.json(
+          { 
+            error: `Failed to generate size recommendation: ${serviceResponse.data.error || 'Unknown error'}`,
+            details: 'The size recommender requires product measurement data and user measurements.'
+          },
+          { status: 500 }
+        );
+      }
+      return NextResponse.json(serviceResponse.data);
+    }
+
     // Run the Python script for robust size recommendation
     const pythonPath = 'python3';  // Use python3 command directly
     const scriptPath = path.join(process.cwd(), 'recommender', 'size_recommender.py');
@@ -1,5 +1,6 @@
 import { NextRequest, NextResponse } from 'next/server';
 import { supabase } from '@/lib/supabase';
+import { callRecommenderService } from '@/lib/recommender-service';
 import { spawn } from 'child_process';
 import path from 'path';
 import fs from 'fs';
@@ -191,6 +192,19 @@ export async function GET(req: NextRequest) {
       }
     }
     
+    // Prefer the warm recommender service; only spawn the script if it is unavailable
+    const serviceResponse = await callRecommenderService('/recommend/style', {
+      user_id,
+      limit: parseInt(limit),
+      product_data: product,
+      user_preferences: userPreferences,
+      user_materials: userMaterials
+    });
+
+    if (serviceResponse) {
+      return buildStyleResponse(serviceResponse.data, hasModel, user_id, userPreferences, userMaterials);
+    }
+
     // The style recommender script can use a personalized model if it exists
     const pythonPath = path.join(process.cwd(), 'env', 'bin', 'python');
     const scriptPath = path.join(process.cwd(), 'recommender', 'style_recommender.py');
@@ -256,49 +270,7 @@ export async function GET(req: NextRequest) {
           
           const recommendation = JSON.parse(trimmedResult);
           
-          // Check if the recommendation is empty or has no results
-          const hasRecommendations = 
-            recommendation.recommendations?.length > 0 || 
-            recommendation.data?.length > 0;
-          
-          // Add metadata about whether we used a personalized model
-          const responseWithMetadata = {
-            ...recommendation,
-            meta: {
-              is_personalized: hasModel,
-              model_path: hasModel ? `recommender/models/${user_id}_model` : null,
-              user_preferences: userPreferences,
-              user_materials: userMaterials,
-              timestamp: Date.now() // Add timestamp to prevent caching
-            }
-          };
-          
-          if (!hasRecommendations) {
-            console.log('No recommendations returned from the model.');
-            return resolve(NextResponse.json(
-              { 
-                error: 'The style recommender model did not return any recommendations.',
-                recommendations: [],
-                meta: {
-                  is_personalized: hasModel,
-                  error_details: 'Empty recommendations from model',
-                  timestamp: Date.now() // Add timestamp
-                }
-              },
-              { 
-                status: 500,
-                headers: {
-                  'Cache-Control': 'no-store, max-age=0, must-revalidate'
-                }
-              }
-            ));
-          }
-          
-          resolve(NextResponse.json(responseWithMetadata, {
-            headers: {
-              'Cache-Control': 'no-store, max-age=0, must-revalidate'
-            }
-          }));
+          resolve(buildStyleResponse(recommendation, hasModel, user_id, userPreferences, userMaterials));
         } catch (e) {
           console.error('Error parsing recommendation result:', e);
           
@@ -341,13 +313,73 @@ export async function GET(req: NextRequest) {
   }
 }
 
+// Wrap the recommender output with metadata about the personalized model
+function buildStyleResponse(
+  recommendation: any,
+  hasModel: boolean,
+  user_id: string | null,
+  userPreferences: string[],
+  userMaterials: string[]
+) {
+  // Check if the recommendation is empty or has no results
+  const hasRecommendations = 
+    recommendation.recommendations?.length > 0 || 
+    recommendation.data?.length > 0;
+
+  // Add metadata about whether we used a personalized model
+  const responseWithMetadata = {
+    ...recommendation,
+    meta: {
+      is_personalized: hasModel,
+      model_path: hasModel ? userModelPath(user_id) : null,
+      user_preferences: userPreferences,
+      user_materials: userMaterials,
+      timestamp: Date.now() // Add timestamp to prevent caching
+    }
+  };
+
+  if (!hasRecommendations) {
+    console.log('No recommendations returned from the model.');
+    return NextResponse.json(
+      { 
+        error: 'The style recommender model did not return any recommendations.',
+        recommendations: [],
+        meta: {
+          is_personalized: hasModel,
+          error_details: 'Empty recommendations from model',
+          timestamp: Date.now() // Add timestamp
+        }
+      },
+      { 
+        status: 500,
+        headers: {
+          'Cache-Control': 'no-store, max-age=0, must-revalidate'
+        }
+      }
+    );
+  }
+
+  return NextResponse.json(responseWithMetadata, {
+    headers: {
+      'Cache-Control': 'no-store, max-age=0, must-revalidate'
+    }
+  });
+}
+
+// Path of the user's personalization artefact: an adapter, or a legacy full model
+function userModelPath(userId: string): string {
+  const adapterPath = `recommender/models/${userId}_adapter.npz`;
+  return fs.existsSync(path.join(process.cwd(), adapterPath)) ? adapterPath : `recommender/models/${userId}_model`;
+}
+
 // Helper function to check if a user has a personalized model
 function checkUserModelExists(userId: string): boolean {
   if (!userId) return false;
   
   try {
+    const adapterPath = path.join(process.cwd(), 'recommender', 'models', `${userId}_adapter.npz`);
     const modelPath = path.join(process.cwd(), 'recommender', 'models', `${userId}_model`);
-    return fs.existsSync(modelPath);
+    return fs.existsSync(adapterPath) || fs.existsSync(modelPath);
   } catch (error) {
     console.error(`Error checking for user model ${userId}:`, error);
     return false;
@@ -3,6 +3,8 @@ import { spawn } from 'child_process';
 import path from 'path';
 import fs from 'fs';
 import { createClient } from '@/utils/supabase/server';
+import { callRecommenderService } from '@/lib/recommender-service';
+import { enqueueTraining } from '@/lib/training-queue';
 
 // Threshold for retraining (for testing, set to 2)
 const RETRAIN_THRESHOLD = 2;
@@ -102,6 +104,10 @@ export async function POST(req: NextRequest) {
       );
     }
     
+    // Apply the swipe to the user's online preference vector so the next
+    // recommendation reflects it; adapter retraining below still runs periodically
+    const preferenceUpdated = await updatePreferenceVector(user_id, product_id, interaction_type);
+    
     // Get total interactions count
     const { data: interactions, error: countError } = await supabase
       .from('style_interactions')
@@ -122,15 +128,15 @@ export async function POST(req: NextRequest) {
     // Check if we need to retrain
     let retrainTriggered = false;
     if (totalInteractions >= RETRAIN_THRESHOLD) {
-      // Check if we have a model already
-      const modelPath = path.join(process.cwd(), 'models', `${user_id}_model`);
-      const hasModel = fs.existsSync(modelPath);
+      // Check if we have an adapter (or a legacy model directory) already
+      const modelsDir = path.join(process.cwd(), 'recommender', 'models');
+      const hasModel = fs.existsSync(path.join(modelsDir, `${user_id}_adapter.npz`)) ||
+        fs.existsSync(path.join(modelsDir, `${user_id}_model`));
       
       // If no model or it's time to retrain
       if (!hasModel || totalInteractions % RETRAIN_THRESHOLD === 0) {
-        // Trigger retraining in the background
-        retrainTriggered = true;
-        retrainUserModel(user_id);
+        // Queue retraining; jobs for the same user are coalesced into one
+        retrainTriggered = await retrainUserModel(user_id);
       }
     }
     
@@ -138,6 +144,7 @@ export async function POST(req: NextRequest) {
       success: true,
       message: `Interaction recorded: ${interaction_type}`,
       retrain_triggered: retrainTriggered,
+      preference_updated: preferenceUpdated,
       interaction_count: totalInteractions
     });
     
@@ -150,10 +157,58 @@ export async function POST(req: NextRequest) {
   }
 }
 
+// Update the user's preference vector through the recommender service, or
+// the preference_vectors.py script when the service is unavailable
+async function updatePreferenceVector(userId: string, productId: string, interactionType: string) {
+  const serviceResponse = await callRecommenderService('/interactions', {
+    user_id: userId,
+    product_id: productId,
+    interaction_type: interactionType
+  });
+  
+  if (serviceResponse) {
+    if (serviceResponse.status !== 200) {
+      console.error('Preference vector update failed:', serviceResponse.data);
+      return false;
+    }
+    return true;
+  }
+  
+  try {
+    const pythonPath = path.join(process.cwd(), 'env', 'bin', 'python');
+    const scriptPath = path.join(process.cwd(), 'recommender', 'preference_vectors.py');
+    const pythonProcess = spawn(pythonPath, [scriptPath, 'swipe', userId, productId, interactionType], {
+      env: {
+        ...process.env,
+        PATH: process.env.PATH || ''
+      }
+    });
+    
+    pythonProcess.stderr.on('data', (data) => {
+      console.error(`Preference update stderr: ${data}`);
+    });
+    
+    // Only report the update once the script has applied it
+    return await new Promise<boolean>((resolve) => {
+      pythonProcess.on('error', (error) => {
+        console.error('Error running preference update:', error);
+        resolve(false);
+      });
+      pythonProcess.on('close', (code) => {
+        console.log(`Preference update process exited with code ${code}`);
+        resolve(code === 0);
+      });
+    });
+  } catch (error) {
+    console.error('Error updating preference vector:', error);
+    return false;
+  }
+}
+
 // Retraining function
 async function retrainUserModel(userId: string) {
   try {
-    console.log(`Starting model retraining for user ${userId}`);
+    console.log(`Queueing model retraining for user ${userId}`);
     
     // Get all user interactions
     const supabase = await createClient();
@@ -176,52 +231,11 @@ async function retrainUserModel(userId: string) {
     const dislikedDescriptions = dislikedProducts.map(p => p.product_description || p.product_name);
     const savedDescriptions = savedProducts.map(p => p.product_description || p.product_name);
     
-    // Run the retrain script
-    const pythonPath = path.join(process.cwd(), 'env', 'bin', 'python');
-    const scriptPath = path.join(process.cwd(), 'recommender', 'retrain_model.py');
-    
-    // Prepare arguments
-    const args = [scriptPath, userId];
-    
-    // Add liked items
-    if (likedDescriptions.length > 0) {
-      args.push('--liked', JSON.stringify(likedDescriptions));
-    }
-    
-    // Add disliked items
-    if (dislikedDescriptions.length > 0) {
-      args.push('--disliked', JSON.stringify(dislikedDescriptions));
-    }
-    
-    // Add saved items
-    if (savedDescriptions.length > 0) {
-      args.push('--saved', JSON.stringify(savedDescriptions));
-    }
-    
-    console.log(`Running retraining command: ${pythonPath} ${args.join(' ')}`);
-    
-    const pythonProcess = spawn(pythonPath, args, {
-      env: {
-        ...process.env,
-        NEXT_PUBLIC_SUPABASE_URL: process.env.NEXT_PUBLIC_SUPABASE_URL || '',
-        NEXT_PUBLIC_SUPABASE_ANON_KEY: process.env.NEXT_PUBLIC_SUPABASE_ANON_KEY || '',
-        PATH: process.env.PATH || ''
-      }
-    });
-    
-    pythonProcess.stdout.on('data', (data) => {
-      console.log(`Retraining stdout: ${data}`);
+    return await enqueueTraining(userId, {
+      liked: likedDescriptions,
+      disliked: dislikedDescriptions,
+      saved: savedDescriptions
     });
-    
-    pythonProcess.stderr.on('data', (data) => {
-      console.error(`Retraining stderr: ${data}`);
-    });
-    
-    pythonProcess.on('close', (code) => {
-      console.log(`Retraining process exited with code ${code}`);
-    });
-    
-    return true;
   } catch (error) {
     console.error('Error retraining model:', error);
     return false;
@@ -1,9 +1,9 @@
 import { NextRequest, NextResponse } from 'next/server';
-import { spawn } from 'child_process';
 import path from 'path';
 import fs from 'fs';
+import { enqueueTraining } from '@/lib/training-queue';
 
-// This endpoint triggers model retraining for a user's style preferences
+// This endpoint queues model retraining for a user's style preferences
 export async function POST(req: NextRequest) {
   try {
     // Parse request body
@@ -41,98 +41,31 @@ export async function POST(req: NextRequest) {
       likedForTraining = ["neutral style item"];
     }
     
-    console.log(`Starting model retraining for user ${user_id} with:
+    console.log(`Queueing model retraining for user ${user_id} with:
       - ${hasLikedItems ? liked.length : '0 real + 1 synthetic'} liked descriptions
       - ${disliked?.length || 0} disliked descriptions
       - ${saved?.length || 0} saved descriptions
     `);
     
-    // Create models directory if needed
-    const modelsDir = path.join(process.cwd(), 'recommender', 'models');
-    if (!fs.existsSync(modelsDir)) {
-      fs.mkdirSync(modelsDir, { recursive: true });
-    }
-    
-    // Run the retrain script using python in the project environment
-    const pythonPath = process.env.NODE_ENV === 'production' 
-      ? 'python3'  // Use system python in production
-      : path.join(process.cwd(), 'env', 'bin', 'python');  // Use venv in dev
-    
-    const scriptPath = path.join(process.cwd(), 'recommender', 'retrain_model.py');
-    
-    // Prepare arguments
-    const args = [scriptPath, user_id];
-    
-    // Add liked items - use our potentially modified list
-    if (likedForTraining.length > 0) {
-      args.push('--liked', JSON.stringify(likedForTraining));
-    }
-    
-    // Add disliked items
-    if (disliked && disliked.length > 0) {
-      args.push('--disliked', JSON.stringify(disliked));
-    }
-    
-    // Add saved items
-    if (saved && saved.length > 0) {
-      args.push('--saved', JSON.stringify(saved));
-    }
-    
-    console.log(`Running retraining command: ${pythonPath} ${args.join(' ')}`);
-    
-    // Run the retraining script
-    const retrainProcess = spawn(pythonPath, args);
-    
-    // Handle process output
-    retrainProcess.stdout.on('data', (data) => {
-      console.log(`Retraining output: ${data}`);
-    });
-    
-    retrainProcess.stderr.on('data', (data) => {
-      console.error(`Retraining error: ${data}`);
+    // Queue the job: it is coalesced with any pending job for this user and
+    // run on the training queue's bounded worker pool
+    const queued = await enqueueTraining(user_id, {
+      liked: likedForTraining,
+      disliked: disliked || [],
+      saved: saved || []
     });
-    
-    // Wait for process to complete
-    let success = false;
-    let error = null;
-
-    try {
-      await new Promise<void>((resolve, reject) => {
-        const timeout = setTimeout(() => {
-          console.log("Training taking too long, stopping the process");
-          retrainProcess.kill();
-          resolve(); // Don't reject, just move on
-        }, 30000); // 30 second timeout
-        
-        retrainProcess.on('close', (code) => {
-          clearTimeout(timeout);
-          if (code === 0) {
-            success = true;
-            resolve();
-          } else {
-            error = `Retraining process exited with code ${code}`;
-            console.error(error);
-            // Don't reject - still consider it handled
-            resolve();
-          }
-        });
-      });
-    } catch (e) {
-      console.error("Error waiting for retraining process:", e);
-    }
 
-    // Even if training failed, check if the model directory exists
+    // Users keep their current adapter (or legacy model directory) until the job finishes
+    const userAdapterPath = path.join(process.cwd(), 'recommender', 'models', `${user_id}_adapter.npz`);
     const userModelDir = path.join(process.cwd(), 'recommender', 'models', `${user_id}_model`);
-    const modelExists = fs.existsSync(userModelDir);
-
-    console.log(`Training ${success ? 'succeeded' : 'failed'}, model directory ${modelExists ? 'exists' : 'does not exist'}`);
+    const modelExists = fs.existsSync(userAdapterPath) || fs.existsSync(userModelDir);
 
-    // Return success if either the process succeeded or the model exists
     return NextResponse.json({
-      success: success || modelExists,
+      success: queued || modelExists,
+      queued: queued,
       modelExists: modelExists,
-      error: error,
-      message: success ? 'Model retraining completed successfully' : 
+      error: queued ? null : 'Failed to queue training job',
+      message: queued ? 'Model retraining queued' :
         (modelExists ? 'Model exists despite training issues' : 'Failed to train model')
     });
     
@@ -0,0 +1,30 @@
+// Client for the long-lived Python recommender service (recommender/server.py).
+// When RECOMMENDER_SERVICE_URL is not set, or the service cannot be reached,
+// callers get null back and fall back to spawning the Python scripts.
+
+const serviceUrl = process.env.RECOMMENDER_SERVICE_URL || ''
+
+export type RecommenderServiceResponse = {
+  status: number
+  data: any
+}
+
+export async function callRecommenderService(
+  endpoint: string,
+  body: unknown
+): Promise<RecommenderServiceResponse | null> {
+  if (!serviceUrl) return null
+
+  try {
+    const response = await fetch(`${serviceUrl}${endpoint}`, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify(body),
+      cache: 'no-store'
+    })
+    return { status: response.status, data: await response.json() }
+  } catch (error) {
+    console.error(`Recommender service unavailable at ${serviceUrl}:`, error)
+    return null
+  }
+}
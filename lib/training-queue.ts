@@ -0,0 +1,68 @@
+// Queue adapter retraining for a user (recommender/training_queue.py).
+// Jobs go through the recommender service when it is reachable; otherwise the
+// script queues the job and runs the queue itself unless a worker already is.
+// Either way a user has at most one pending job and training runs on a
+// bounded pool, so rapid swipes never start overlapping training runs.
+
+import { spawn } from 'child_process';
+import path from 'path';
+import { callRecommenderService } from '@/lib/recommender-service';
+
+export type TrainingInteractions = {
+  liked?: string[]
+  disliked?: string[]
+  saved?: string[]
+}
+
+export async function enqueueTraining(
+  userId: string,
+  interactions: TrainingInteractions
+): Promise<boolean> {
+  const serviceResponse = await callRecommenderService('/training/jobs', {
+    user_id: userId,
+    ...interactions
+  });
+
+  if (serviceResponse) {
+    if (serviceResponse.status !== 202) {
+      console.error('Failed to queue training job:', serviceResponse.data);
+      return false;
+    }
+    console.log(`Queued training job ${serviceResponse.data.job_id} for user ${userId}`);
+    return true;
+  }
+
+  try {
+    const pythonPath = process.env.NODE_ENV === 'production'
+      ? 'python3'
+      : path.join(process.cwd(), 'env', 'bin', 'python');
+    const scriptPath = path.join(process.cwd(), 'recommender', 'training_queue.py');
+    const args = [scriptPath, 'enqueue', userId, '--drain'];
+    for (const key of ['liked', 'disliked', 'saved'] as const) {
+      const texts = interactions[key];
+      if (texts && texts.length > 0) {
+        args.push(`--${key}`, JSON.stringify(texts));
+      }
+    }
+
+    const queueProcess = spawn(pythonPath, args, {
+      env: {
+        ...process.env,
+        PATH: process.env.PATH || ''
+      }
+    });
+
+    queueProcess.stdout.on('data', (data) => {
+      console.log(`Training queue: ${data}`);
+    });
+
+    queueProcess.stderr.on('data', (data) => {
+      console.error(`Training queue stderr: ${data}`);
+    });
+
+    return true;
+  } catch (error) {
+    console.error('Error queueing training job:', error);
+    return false;
+  }
+}
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+"""
+ann_index.py
+
+Nearest-neighbour indexes over the product embeddings used by StyleRecommender.
+
+ExactIndex scores every product against the query and is the reference the
+approximate index is measured against. IVFIndex clusters the catalog with
+spherical k-means and, per query, only scores the products in the `nprobe`
+clusters closest to it. Raising nprobe trades latency for recall.
+
+Build the IVF index offline, next to the product vector store:
+
+    python recommender/ann_index.py build --nlist 64
+
+and check its recall against exact search:
+
+    python recommender/ann_index.py recall --nprobe 8
+
+The index records a digest of the vector store's product IDs and is only
+loaded for exactly those rows. The embedding scripts rebuild an existing
+index after each store build.
+
+At startup, RECOMMENDER_INDEX selects the index ("ivf", "quantized",
+"sharded" or "exact") and RECOMMENDER_NPROBE sets the number of clusters
+probed per query. The quantized index (a compressed first pass re-scored
+exactly) lives in quantized_index.py, and the sharded index (exact search
+spread over a thread pool) in sharded_index.py.
+"""
+
+import argparse
+import os
+import sys
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from attribute_index import ids_digest
+from metrics import stage
+from vector_store import MODELS_DIR, STORE_PATH, load_product_vectors
+
+IVF_INDEX_PATH = os.path.join(MODELS_DIR, 'product_index_ivf.npz')
+DEFAULT_NPROBE = 8
+
+# Rows scored per block when assigning the catalog to clusters, so building
+# the index on a large catalog does not materialise an n x nlist matrix.
+_ASSIGN_BLOCK = 65536
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Return float32 copies of the rows scaled to unit L2 norm."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the top_k highest scores, best first, without a full sort."""
+    top_k = min(top_k, len(scores))
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+def top_k_rows(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Per-row indices of the top_k highest scores in a 2-D array, best first."""
+    top_k = min(top_k, scores.shape[1])
+    if top_k <= 0:
+        return np.empty((len(scores), 0), dtype=np.int64)
+    if top_k < scores.shape[1]:
+        candidates = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def search_rows(embeddings: np.ndarray, query: np.ndarray, rows: np.ndarray, top_k: int,
+                kind: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact search over a subset of rows of normalised embeddings."""
+    with stage('similarity', index=kind, filtered='1'):
+        scores = embeddings[rows] @ query
+    with stage('top_k', index=kind, filtered='1'):
+        best = top_k_indices(scores, top_k)
+    return rows[best], scores[best]
+
+
+class ExactIndex:
+    """Brute-force cosine search over every product embedding."""
+
+    kind = 'exact'
+
+    def __init__(self, embeddings: np.ndarray, normalized: bool = False):
+        # Pre-normalised embeddings (e.g. a memory-mapped vector store) are used as-is
+        self.embeddings = embeddings if normalized else normalize_rows(embeddings)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def search(self, query: np.ndarray, top_k: int,
+               rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row indices, cosine scores) of the top_k products, best first.
+
+        With rows (sorted row indices, e.g. from an attribute filter) only
+        those products are scored.
+        """
+        if rows is not None:
+            return search_rows(self.embeddings, normalize_rows(query), rows, top_k, self.kind)
+        with stage('similarity', index=self.kind):
+            scores = self.embeddings @ normalize_rows(query)
+        with stage('top_k', index=self.kind):
+            indices = top_k_indices(scores, top_k)
+        return indices, scores[indices]
+
+    def search_batch(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search many queries with one matrix multiply; returns (n_queries, top_k) arrays."""
+        with stage('batch_similarity', index=self.kind):
+            scores = normalize_rows(queries) @ self.embeddings.T
+        with stage('batch_top_k', index=self.kind):
+            indices = top_k_rows(scores, top_k)
+        return indices, np.take_along_axis(scores, indices, axis=1)
+
+
+class IVFIndex:
+    """Inverted-file index: products bucketed by their nearest k-means centroid."""
+
+    kind = 'ivf'
+
+    def __init__(self, embeddings: np.ndarray, centroids: np.ndarray,
+                 list_offsets: np.ndarray, list_ids: np.ndarray,
+                 nprobe: int = DEFAULT_NPROBE, normalized: bool = False):
+        self.embeddings = embeddings if normalized else normalize_rows(embeddings)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, nlist: Optional[int] = None,
+              n_iter: int = 20, seed: int = 0, nprobe: int = DEFAULT_NPROBE) -> 'IVFIndex':
+        """Cluster the embeddings with spherical k-means and bucket them."""
+        vectors = normalize_rows(embeddings)
+        n = len(vectors)
+        if nlist is None:
+            nlist = max(1, int(np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+
+        # Train on a sample; a few hundred points per centroid is plenty.
+        sample_size = min(n, nlist * 256)
+        sample = vectors[rng.choice(n, sample_size, replace=False)]
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(n_iter):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            counts = np.bincount(assignment, minlength=nlist)
+            empty = counts == 0
+            if empty.any():
+                # Re-seed empty clusters so every list stays useful
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            centroids = normalize_rows(sums)
+
+        assignment = np.empty(n, dtype=np.int64)
+        for start in range(0, n, _ASSIGN_BLOCK):
+            block = vectors[start:start + _ASSIGN_BLOCK]
+            assignment[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+
+        list_ids = np.argsort(assignment, kind='stable').astype(np.int64)
+        counts = np.bincount(assignment, minlength=nlist)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(vectors, centroids, list_offsets, list_ids, nprobe=nprobe, normalized=True)
+
+    def save(self, path: str = IVF_INDEX_PATH, product_ids=None):
+        """Save the index; product_ids (the vector store rows) let load() reject another catalog."""
+        arrays = {'centroids': self.centroids, 'list_offsets': self.list_offsets, 'list_ids': self.list_ids,
+                  'shape': np.array(self.embeddings.shape, dtype=np.int64)}
+        if product_ids is not None:
+            arrays['digest'] = np.array(ids_digest(product_ids))
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, embeddings: np.ndarray, path: str = IVF_INDEX_PATH,
+             nprobe: int = DEFAULT_NPROBE, normalized: bool = False, product_ids=None) -> 'IVFIndex':
+        data = np.load(path)
+        if tuple(data['shape']) != tuple(np.shape(embeddings)):
+            raise ValueError(f"IVF index at {path} was built for embeddings of shape "
+                             f"{tuple(data['shape'])}, not {tuple(np.shape(embeddings))}; rebuild it")
+        # A same-sized catalog with different products would load silently and lose recall
+        if product_ids is not None and ('digest' not in data or str(data['digest']) != ids_digest(product_ids)):
+            raise ValueError(f"IVF index at {path} was built for other products; rebuild it")
+        return cls(embeddings, data['centroids'], data['list_offsets'], data['list_ids'],
+                   nprobe=nprobe, normalized=normalized)
+
+    def search(self, query: np.ndarray, top_k: int,
+               rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row indices, cosine scores) of the best products in the probed lists.
+
+        With rows (sorted row indices), only those products are candidates.
+        A subset no larger than the probed lists would be is scored exactly.
+        """
+        query = normalize_rows(query)
+        nprobe = max(1, min(self.nprobe, self.nlist))
+        if rows is not None and len(rows) <= len(self) * nprobe / self.nlist:
+            return search_rows(self.embeddings, query, rows, top_k, self.kind)
+        with stage('probe', index=self.kind):
+            probed = top_k_indices(self.centroids @ query, nprobe)
+            candidates = np.concatenate([
+                self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]] for c in probed
+            ])
+            if rows is not None:
+                allowed = np.zeros(len(self), dtype=bool)
+                allowed[rows] = True
+                candidates = candidates[allowed[candidates]]
+        if rows is not None and len(candidates) < top_k:
+            # Too few matches near the query; score the whole subset instead
+            return search_rows(self.embeddings, query, rows, top_k, self.kind)
+        with stage('similarity', index=self.kind):
+            scores = self.embeddings[candidates] @ query
+        with stage('top_k', index=self.kind):
+            best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+
+def load_index(embeddings: np.ndarray, kind: Optional[str] = None, nprobe: Optional[int] = None,
+               normalized: bool = False, product_ids=None):
+    """Load the configured index, falling back to exact search if it is unavailable.
+
+    With product_ids, a saved index built for other products is not used.
+    """
+    kind = kind or os.getenv('RECOMMENDER_INDEX', 'ivf')
+    if nprobe is None:
+        nprobe = int(os.getenv('RECOMMENDER_NPROBE', DEFAULT_NPROBE))
+
+    if kind == 'ivf':
+        if os.path.exists(IVF_INDEX_PATH):
+            try:
+                index = IVFIndex.load(embeddings, IVF_INDEX_PATH, nprobe=nprobe, normalized=normalized,
+                                      product_ids=product_ids)
+                print(f"[INDEX] Loaded IVF index with {index.nlist} lists, nprobe={index.nprobe}", file=sys.stderr)
+                return index
+            except Exception as e:
+                print(f"[INDEX] Could not load IVF index: {e}", file=sys.stderr)
+        else:
+            print(f"[INDEX] No IVF index at {IVF_INDEX_PATH}", file=sys.stderr)
+    elif kind == 'quantized':
+        from quantized_index import DEFAULT_RERANK, QUANTIZED_INDEX_PATH, QuantizedIndex
+        if os.path.exists(QUANTIZED_INDEX_PATH):
+            try:
+                index = QuantizedIndex.load(embeddings, QUANTIZED_INDEX_PATH, normalized=normalized,
+                                            rerank=int(os.getenv('RECOMMENDER_RERANK', DEFAULT_RERANK)),
+                                            product_ids=product_ids)
+                print(f"[INDEX] Loaded {index.describe()} quantized index ({index.compression:.1f}x smaller), "
+                      f"rerank={index.rerank}", file=sys.stderr)
+                return index
+            except Exception as e:
+                print(f"[INDEX] Could not load quantized index: {e}", file=sys.stderr)
+        else:
+            print(f"[INDEX] No quantized index at {QUANTIZED_INDEX_PATH}", file=sys.stderr)
+    elif kind == 'sharded':
+        from sharded_index import ShardedIndex, default_shards
+        index = ShardedIndex(embeddings, shards=default_shards(), normalized=normalized)
+        print(f"[INDEX] Using exact search in {index.shards} shards", file=sys.stderr)
+        return index
+    elif kind != 'exact':
+        print(f"[INDEX] Unknown index type '{kind}'", file=sys.stderr)
+
+    print("[INDEX] Using exact search", file=sys.stderr)
+    return ExactIndex(embeddings, normalized=normalized)
+
+
+def refresh_ivf_index(store_path: str = STORE_PATH, path: str = IVF_INDEX_PATH) -> Optional[IVFIndex]:
+    """Rebuild an existing IVF index for the current vector store, with its number of lists."""
+    if not os.path.exists(path):
+        return None
+    nlist = len(np.load(path)['centroids'])
+    ids, embeddings, _ = load_product_vectors(store_path)
+    start = time.time()
+    index = IVFIndex.build(embeddings, nlist=nlist)
+    index.save(path, ids)
+    print(f"Rebuilt IVF index with {index.nlist} lists over {len(index)} products "
+          f"in {time.time() - start:.2f}s")
+    return index
+
+
+def recall_at_k(index, reference: ExactIndex, queries: np.ndarray, top_k: int = 10) -> float:
+    """Fraction of the exact top_k that the index also returns, averaged over queries."""
+    hits = 0
+    for query in queries:
+        expected = set(reference.search(query, top_k)[0].tolist())
+        found = set(index.search(query, top_k)[0].tolist())
+        hits += len(expected & found)
+    return hits / float(len(queries) * min(top_k, len(reference)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or evaluate the product embedding index')
+    parser.add_argument('command', choices=['build', 'recall'], help='Build the IVF index or measure its recall')
+    parser.add_argument('--nlist', type=int, help='Number of k-means clusters (default: sqrt of catalog size)')
+    parser.add_argument('--nprobe', type=int, default=DEFAULT_NPROBE, help='Clusters scored per query')
+    parser.add_argument('--top_k', type=int, default=10, help='k for recall@k')
+    parser.add_argument('--queries', type=int, default=200, help='Number of sampled queries for recall')
+    args = parser.parse_args()
+
+    ids, embeddings, normalized = load_product_vectors()
+
+    if args.command == 'build':
+        start = time.time()
+        index = IVFIndex.build(embeddings, nlist=args.nlist, nprobe=args.nprobe)
+        index.save(IVF_INDEX_PATH, ids)
+        print(f"Built IVF index with {index.nlist} lists over {len(index)} products "
+              f"in {time.time() - start:.2f}s, saved to {IVF_INDEX_PATH}")
+        return
+
+    index = IVFIndex.load(embeddings, IVF_INDEX_PATH, nprobe=args.nprobe, normalized=normalized, product_ids=ids)
+    reference = ExactIndex(embeddings, normalized=normalized)
+    rng = np.random.default_rng(0)
+    # Perturbed catalog vectors stand in for real preference queries
+    queries = reference.embeddings[rng.choice(len(reference), min(args.queries, len(reference)), replace=False)]
+    queries = queries + rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+
+    recall = recall_at_k(index, reference, queries, args.top_k)
+    start = time.time()
+    for query in queries:
+        index.search(query, args.top_k)
+    ivf_ms = (time.time() - start) * 1000 / len(queries)
+    start = time.time()
+    for query in queries:
+        reference.search(query, args.top_k)
+    exact_ms = (time.time() - start) * 1000 / len(queries)
+    print(f"recall@{args.top_k} = {recall:.3f} with nprobe={index.nprobe}/{index.nlist} "
+          f"({ivf_ms:.3f} ms/query vs {exact_ms:.3f} ms/query exact)")
+
+
+if __name__ == '__main__':
+    main()
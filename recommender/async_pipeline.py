@@ -0,0 +1,166 @@
+"""
+async_pipeline.py
+
+Style recommendations as an asyncio pipeline, so a request's waits overlap
+with its own CPU work and with other requests'.
+
+StyleRecommender.recommend runs its steps one after another: look up the
+materialised list, load the user's adapter, read their preference vector,
+encode the query, search, then fetch product details. Only encoding and
+search need the CPU. Here each request is a coroutine on one event loop:
+
+    materialised lookup ─┐
+    user model load      ├─ I/O executor, concurrently
+    preference vector   ─┘
+    query encoding       ─  encode batcher (or CPU executor), at the same time
+    search               ─  CPU executor, once the above are in
+    detail fetch         ─  I/O executor
+
+When the model is wrapped in an EncodeBatcher, as the service does, the
+query's cache misses are submitted to it and awaited on the loop, so a
+batch collects every waiting request and no CPU worker sits idle while it
+is encoded; the batcher's thread is the one thread that encodes. Otherwise
+encoding runs on the CPU executor. The CPU executor has one thread per core
+(RECOMMENDER_CPU_WORKERS), so however many requests are in flight, search
+never runs more threads than there are cores. Waits on Supabase and SQLite go to a larger
+I/O executor (RECOMMENDER_IO_WORKERS) and hold no CPU slot. The query is
+encoded with the base model while the user's model loads. Users with a
+full fine-tuned model of their own are re-encoded with it.
+
+The service runs the loop in a background thread and submits each request
+to it:
+
+    pipeline = RecommendationPipeline(get_base_recommender, get_recommender)
+    recommendations = pipeline.run(user_id, user_preferences, user_materials, limit)
+
+Set RECOMMENDER_ASYNC=0 to serve requests with recommend_for_user instead.
+"""
+
+import asyncio
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+from embedding_cache import query_cache
+from materialized import recommendation_store
+from metrics import increment, stage
+from style_recommender import (StyleRecommender, read_preference, store_recommendations,
+                               stored_recommendations)
+
+DEFAULT_IO_WORKERS = 32
+
+
+def default_cpu_workers() -> int:
+    return int(os.getenv('RECOMMENDER_CPU_WORKERS', '0')) or os.cpu_count() or 1
+
+
+class RecommendationPipeline:
+    """Runs recommendation requests as coroutines on one event loop in a background thread."""
+
+    def __init__(self, get_base: Callable[[], StyleRecommender],
+                 get_recommender: Callable[[Optional[str]], StyleRecommender],
+                 cpu_workers: Optional[int] = None, io_workers: Optional[int] = None):
+        self.get_base = get_base
+        self.get_recommender = get_recommender
+        self.cpu_workers = cpu_workers or default_cpu_workers()
+        self.io_workers = io_workers or int(os.getenv('RECOMMENDER_IO_WORKERS', DEFAULT_IO_WORKERS))
+        self._cpu = ThreadPoolExecutor(max_workers=self.cpu_workers, thread_name_prefix='recommend-cpu')
+        self._io = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='recommend-io')
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name='recommend-loop', daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._loop = None
+        self._cpu.shutdown(wait=False)
+        self._io.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {'in_flight': self.in_flight, 'completed': self.completed,
+                'cpu_workers': self.cpu_workers, 'io_workers': self.io_workers}
+
+    def run(self, user_id: Optional[str], user_preferences: List[str], user_materials: List[str], limit: int,
+            catalog: Optional[str] = None, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Submit a request to the loop from any thread and wait for its recommendations."""
+        future = asyncio.run_coroutine_threadsafe(
+            self.recommend(user_id, user_preferences, user_materials, limit, catalog, filters), self._ensure_loop())
+        return future.result()
+
+    async def _encode(self, recommender: StyleRecommender, texts: List[str]) -> np.ndarray:
+        """recommender.encode, awaiting a batching model's Future rather than blocking a CPU worker."""
+        if not hasattr(recommender.model, 'submit'):
+            return await asyncio.get_running_loop().run_in_executor(self._cpu, recommender.encode, texts)
+        with stage('encode'):
+            vectors = await asyncio.wrap_future(query_cache.submit(recommender.model, texts, recommender.model_key))
+        return np.mean(vectors, axis=0)
+
+    async def recommend(self, user_id: Optional[str], user_preferences: List[str], user_materials: List[str],
+                        limit: int, catalog: Optional[str] = None,
+                        filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Same results as recommend_for_user, with I/O overlapped with encoding."""
+        loop = asyncio.get_running_loop()
+        base = self.get_base()
+        materialize = bool(user_id and recommendation_store is not None and not filters)
+        self.in_flight += 1
+        try:
+            with stage('pipeline'):
+                stored = (loop.run_in_executor(self._io, stored_recommendations, user_id, user_preferences,
+                                               user_materials, limit, catalog) if materialize else None)
+                recommender = loop.run_in_executor(self._io, self.get_recommender, user_id)
+                preference = loop.run_in_executor(self._io, read_preference, user_id)
+                encoded = (asyncio.ensure_future(self._encode(base, user_preferences))
+                           if user_preferences else None)
+
+                if stored is not None:
+                    fingerprint, recommendations = await stored
+                    if recommendations is not None:
+                        # Drop the work a hit does not need, where it has not started yet
+                        for pending in (recommender, preference, encoded):
+                            if pending is not None:
+                                pending.cancel()
+                        return recommendations
+
+                # As in recommend_for_user, a recommender that cannot be created fails the request
+                recommender, preference = await asyncio.gather(recommender, preference)
+                try:
+                    encoded = await encoded if encoded is not None else None
+                    if encoded is not None and recommender.model_key != base.model_key:
+                        # The user's own fine-tuned model; the base encoding does not apply
+                        encoded = await self._encode(recommender, user_preferences)
+                    query_embedding = recommender.query_vector(encoded, preference)
+                    if query_embedding is None:
+                        print("[RECOMMEND] No query or user embeddings available", file=sys.stderr)
+                        return []
+                    ranked = await loop.run_in_executor(self._cpu, recommender.search, query_embedding,
+                                                        user_materials, limit, filters)
+                    recommendations = await loop.run_in_executor(self._io, recommender.details, ranked)
+                except Exception as e:
+                    print(f"[RECOMMEND] Error during recommendation: {str(e)}", file=sys.stderr)
+                    increment('recommender_errors_total', stage='recommend')
+                    return []
+
+                if materialize:
+                    await loop.run_in_executor(self._io, store_recommendations, user_id, fingerprint, limit,
+                                               recommendations)
+                return recommendations
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
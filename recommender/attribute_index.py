@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+attribute_index.py
+
+Posting lists over product attributes, aligned with the vector store rows.
+
+Style recommendations could not be constrained by material, category, tag,
+colour or price: callers fetched extra results and filtered them afterwards.
+This index maps each normalised attribute term to the sorted vector store
+rows of the products that have it, and keeps every row's price for range
+queries, so a filter resolves to a row subset before any similarity is
+computed and the search only scores that subset.
+
+Terms are lower-cased and split on commas ("Cotton, Spandex" is both
+cotton and spandex); tags are also read from Postgres array literals such
+as "{Casual,Work}". Within an attribute the requested values are OR-ed,
+and attributes and the price range are AND-ed:
+
+    {"material": ["linen"], "category": ["top"], "max_price": 50}
+
+The index is written to models/product_attributes.npz by the embedding
+scripts after each build, or on its own:
+
+    python recommender/attribute_index.py build
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from vector_store import MODELS_DIR
+
+ATTRIBUTE_INDEX_PATH = os.path.join(MODELS_DIR, 'product_attributes.npz')
+ATTRIBUTES = ('material', 'category', 'tag', 'colour')
+FILTER_KEYS = ATTRIBUTES + ('min_price', 'max_price')
+
+
+def normalize_terms(value: Any) -> List[str]:
+    """Split an attribute value into lower-case terms."""
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple, set)):
+        return [term for item in value for term in normalize_terms(item)]
+    if isinstance(value, float) and np.isnan(value):
+        return []
+    text = str(value).strip()
+    if text.startswith('{') and text.endswith('}'):
+        text = text[1:-1]
+    terms = []
+    for part in re.split(r'[,;/]', text):
+        # "95% Cotton" and '"Cotton"' are both cotton
+        term = re.sub(r'^\s*\d+(\.\d+)?\s*%\s*', '', part).strip().strip('"\'').strip().lower()
+        if term:
+            terms.append(term)
+    return terms
+
+
+def ids_digest(product_ids: Iterable[Any]) -> str:
+    """Digest of the vector store's row order, to detect an index built for other rows."""
+    digest = hashlib.blake2b(digest_size=16)
+    for product_id in product_ids:
+        digest.update(product_id if isinstance(product_id, bytes) else str(product_id).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+def _price(value: Any) -> float:
+    try:
+        return float(str(value).replace('$', '').replace(',', '').strip()) if value is not None else np.nan
+    except ValueError:
+        return np.nan
+
+
+class AttributeIndex:
+    """Sorted posting lists per attribute term plus each row's price."""
+
+    def __init__(self, count: int, digest: str, postings: Dict[str, Dict[str, np.ndarray]],
+                 prices: np.ndarray):
+        self.count = count
+        self.digest = digest
+        self.postings = postings
+        self.prices = prices
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def build(cls, product_ids: Iterable[Any], products: Iterable[Dict[str, Any]]) -> 'AttributeIndex':
+        """Index products by the row their ID has in product_ids (the vector store order)."""
+        product_ids = [p.decode('ascii') if isinstance(p, bytes) else str(p) for p in product_ids]
+        rows = {product_id: row for row, product_id in enumerate(product_ids)}
+        lists: Dict[str, Dict[str, List[int]]] = {attribute: {} for attribute in ATTRIBUTES}
+        prices = np.full(len(product_ids), np.nan, dtype=np.float32)
+        for product in products:
+            row = rows.get(str(product.get('product_id')))
+            if row is None:
+                continue
+            for attribute in ATTRIBUTES:
+                for term in set(normalize_terms(product.get(attribute))):
+                    lists[attribute].setdefault(term, []).append(row)
+            prices[row] = _price(product.get('price'))
+        postings = {attribute: {term: np.unique(np.asarray(term_rows, dtype=np.int64))
+                                for term, term_rows in terms.items()}
+                    for attribute, terms in lists.items()}
+        return cls(len(product_ids), ids_digest(product_ids), postings, prices)
+
+    def save(self, path: str = ATTRIBUTE_INDEX_PATH):
+        arrays = {'prices': self.prices,
+                  'meta': np.array(json.dumps({'count': self.count, 'digest': self.digest}))}
+        for attribute, terms in self.postings.items():
+            names = sorted(terms)
+            lengths = [len(terms[name]) for name in names]
+            arrays[f'{attribute}_terms'] = np.array(names, dtype=str)
+            arrays[f'{attribute}_offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            arrays[f'{attribute}_rows'] = (np.concatenate([terms[name] for name in names]) if names
+                                           else np.empty(0, dtype=np.int64)).astype(np.int32)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+            np.savez(f, **arrays)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: str = ATTRIBUTE_INDEX_PATH) -> 'AttributeIndex':
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data['meta']))
+        postings = {}
+        for attribute in ATTRIBUTES:
+            terms, offsets, rows = data[f'{attribute}_terms'], data[f'{attribute}_offsets'], data[f'{attribute}_rows']
+            postings[attribute] = {str(term): rows[offsets[i]:offsets[i + 1]].astype(np.int64)
+                                   for i, term in enumerate(terms)}
+        return cls(meta['count'], meta['digest'], postings, data['prices'])
+
+    def terms(self, attribute: str) -> Dict[str, int]:
+        """Each term of an attribute with its number of products."""
+        return {term: len(rows) for term, rows in self.postings.get(attribute, {}).items()}
+
+    def price_mask(self, min_price: Optional[float] = None, max_price: Optional[float] = None) -> np.ndarray:
+        """Whether each row's price is within the range; rows without a price never are."""
+        mask = ~np.isnan(self.prices)
+        if min_price is not None:
+            mask &= self.prices >= min_price
+        if max_price is not None:
+            mask &= self.prices <= max_price
+        return mask
+
+    def _intersect(self, selected: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        if len(rows) < len(selected):
+            selected, rows = rows, selected
+        allowed = np.zeros(self.count, dtype=bool)
+        allowed[rows] = True
+        return selected[allowed[selected]]
+
+    def filter(self, filters: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """Sorted rows matching every constraint, or None when nothing is constrained."""
+        if not filters:
+            return None
+        selected = None
+        for attribute in ATTRIBUTES:
+            terms = normalize_terms(filters.get(attribute))
+            if not terms:
+                continue
+            postings = self.postings.get(attribute, {})
+            matches = [postings[term] for term in dict.fromkeys(terms) if term in postings]
+            if len(matches) == 1:
+                rows = matches[0]
+            else:
+                rows = np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+            selected = rows if selected is None else self._intersect(selected, rows)
+        min_price, max_price = filters.get('min_price'), filters.get('max_price')
+        if min_price is not None or max_price is not None:
+            mask = self.price_mask(None if min_price is None else float(min_price),
+                                   None if max_price is None else float(max_price))
+            selected = np.flatnonzero(mask) if selected is None else selected[mask[selected]]
+        return selected
+
+
+def attribute_index_version(path: str = ATTRIBUTE_INDEX_PATH) -> str:
+    """Identify the attribute index file by name and mtime; empty if there is none."""
+    if not os.path.exists(path):
+        return ''
+    return f"{os.path.basename(path)}@{os.path.getmtime(path)}"
+
+
+def load_attribute_index(product_ids, path: str = ATTRIBUTE_INDEX_PATH) -> Optional[AttributeIndex]:
+    """Load the index if it was built for exactly these vector store rows."""
+    if not os.path.exists(path):
+        return None
+    try:
+        index = AttributeIndex.load(path)
+    except Exception as e:
+        print(f"[INDEX] Could not load attribute index: {e}", file=sys.stderr)
+        return None
+    if index.count != len(product_ids) or index.digest != ids_digest(product_ids):
+        print(f"[INDEX] Attribute index at {path} was built for other products; rebuild it", file=sys.stderr)
+        return None
+    print(f"[INDEX] Loaded attribute index over {index.count} products", file=sys.stderr)
+    return index
+
+
+def build_attribute_index(product_ids, pages: Iterable[List[Dict[str, Any]]],
+                          path: str = ATTRIBUTE_INDEX_PATH) -> AttributeIndex:
+    """Index the catalog pages against the vector store rows and save the index."""
+    index = AttributeIndex.build(product_ids, (product for page in pages for product in page))
+    index.save(path)
+    print(f"Indexed {', '.join(ATTRIBUTES)} and price of {index.count} products in {path}")
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the product attribute index')
+    parser.add_argument('command', choices=['build', 'info'],
+                        help='build: index the catalog against the vector store; info: list terms per attribute')
+    parser.add_argument('--path', type=str, default=ATTRIBUTE_INDEX_PATH, help='Attribute index path')
+    parser.add_argument('--remote', action='store_true',
+                        help='Read products from Supabase even if there is a catalog snapshot')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        index = AttributeIndex.load(args.path)
+        print(json.dumps({attribute: index.terms(attribute) for attribute in ATTRIBUTES}, indent=2))
+        return
+
+    from catalog_snapshot import product_pages
+    from vector_store import load_product_vectors
+    product_ids, _, _ = load_product_vectors()
+    build_attribute_index(product_ids, product_pages(remote=args.remote), args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""
+batch_recommender.py
+
+Style recommendations for many users at once, e.g. for emails or pre-filling
+the home page.
+
+Users are processed in blocks. For each block every distinct preference
+string is encoded once, each user's query vector is built (the mean of their
+preference embeddings, or their stored embeddings when they gave none, with
+their adapter and online preference vector applied), and the whole block is scored against the catalog
+with one matrix multiply and a batched top-k; users whose material
+preferences narrow the catalog are searched over just those products.
+Product details for the block
+are fetched in one lookup and results are yielded user by user, so output
+starts streaming after the first block.
+
+    python recommender/batch_recommender.py --input users.jsonl --output recommendations.jsonl
+
+Each input line is {"user_id": ..., "user_preferences": [...]}, optionally
+with "user_materials": [...]; each output
+line is {"user_id": ..., "count": ..., "recommendations": [...]}.
+"""
+
+import argparse
+import json
+import sys
+import time
+from itertools import islice
+from typing import Any, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+from ann_index import ExactIndex
+from embedding_cache import query_cache
+from model_registry import model_registry
+from preference_vectors import ONLINE_WEIGHT, preference_store
+from product_cache import get_supabase_client, product_cache
+from style_recommender import StyleRecommender, format_recommendation
+
+DEFAULT_BLOCK_SIZE = 1024
+
+
+def _query_vectors(recommender: StyleRecommender, users: List[Dict[str, Any]]) -> List[Any]:
+    """One query vector per user, or None for users with nothing to query with."""
+    user_models = [model_registry.get(user['user_id']) if user.get('user_id') else None for user in users]
+    preferences_by_user = {}
+    if preference_store is not None:
+        try:
+            preferences_by_user = preference_store.get_many(user['user_id'] for user in users if user.get('user_id'))
+        except Exception as e:
+            print(f"[BATCH] Could not read preference vectors: {str(e)}", file=sys.stderr)
+
+    # Encode every distinct preference string once per model
+    models = {}
+    texts_by_key: Dict[str, List[str]] = {}
+    for user, user_model in zip(users, user_models):
+        if not user.get('user_preferences'):
+            continue
+        if user_model is not None and user_model.model is not None:
+            model, model_key = user_model.model, user_model.model_key
+        else:
+            model, model_key = recommender.model, recommender.model_key
+        models[model_key] = model
+        texts_by_key.setdefault(model_key, []).extend(user['user_preferences'])
+    encoded = {}
+    for model_key, texts in texts_by_key.items():
+        texts = list(dict.fromkeys(texts))
+        for text, vector in zip(texts, query_cache.encode(models[model_key], texts, model_key)):
+            encoded[(model_key, text)] = vector
+
+    vectors = []
+    for user, user_model in zip(users, user_models):
+        preferences = user.get('user_preferences')
+        preference = preferences_by_user.get(user.get('user_id'))
+        if preferences:
+            if user_model is not None and user_model.model is not None:
+                model_key = user_model.model_key
+            else:
+                model_key = recommender.model_key
+            vector = np.mean([encoded[(model_key, text)] for text in preferences], axis=0)
+        elif user_model is not None and user_model.user_embeddings is not None:
+            vector = np.mean(user_model.user_embeddings, axis=0)
+        elif preference is not None:
+            vector, preference = preference.vector, None
+        else:
+            vectors.append(None)
+            continue
+        if user_model is not None and user_model.adapter is not None:
+            vector = user_model.adapter.apply(vector)
+        if preference is not None:
+            vector = preference.blend(vector, ONLINE_WEIGHT)
+        vectors.append(vector)
+    return vectors
+
+
+def recommend_batch(recommender: StyleRecommender, users: Iterable[Dict[str, Any]], top_k: int = 10,
+                    block_size: int = DEFAULT_BLOCK_SIZE, include_details: bool = True) -> Iterator[Dict[str, Any]]:
+    """Yield one result per user, in input order, scoring users a block at a time."""
+    # Every index type holds the normalised catalog; a batch is cheapest as one exact matmul,
+    # or one per shard when the sharded index already has a pool of threads for them
+    index = recommender.index
+    if index.kind != 'sharded':
+        index = ExactIndex(index.embeddings, normalized=True)
+    users = iter(users)
+    while True:
+        block = list(islice(users, block_size))
+        if not block:
+            return
+
+        vectors = _query_vectors(recommender, block)
+        results: Dict[int, List[tuple]] = {}
+        unfiltered = []
+        for i, vector in enumerate(vectors):
+            if vector is None:
+                continue
+            allowed = recommender._filter_rows(block[i].get('user_materials'))
+            if allowed is None:
+                unfiltered.append(i)
+                continue
+            indices, scores = index.search(vector, top_k, rows=allowed)
+            results[i] = [(recommender._product_id(idx), score) for idx, score in zip(indices.tolist(), scores.tolist())]
+        if unfiltered:
+            top_indices, top_scores = index.search_batch(np.stack([vectors[i] for i in unfiltered]), top_k)
+            for i, indices, scores in zip(unfiltered, top_indices.tolist(), top_scores.tolist()):
+                results[i] = [(recommender._product_id(idx), score) for idx, score in zip(indices, scores)]
+
+        details = {}
+        if include_details and results:
+            product_ids = list(dict.fromkeys(product_id for ranked in results.values() for product_id, _ in ranked))
+            try:
+                details = product_cache.fetch(product_ids, get_supabase_client())
+            except Exception as e:
+                print(f"[BATCH] Error getting product details: {str(e)}", file=sys.stderr)
+
+        for i, user in enumerate(block):
+            if i not in results:
+                yield {"user_id": user.get('user_id'), "count": 0, "recommendations": [],
+                       "error": "No preferences, stored embeddings or swipes for user"}
+                continue
+            recommendations = [format_recommendation(product_id, score, details.get(product_id))
+                               for product_id, score in results[i]]
+            yield {"user_id": user.get('user_id'), "count": len(recommendations), "recommendations": recommendations}
+
+
+def _read_users(stream) -> Iterator[Dict[str, Any]]:
+    for line_number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            user = json.loads(line)
+        except ValueError as e:
+            print(f"[BATCH] Skipping line {line_number}: {e}", file=sys.stderr)
+            continue
+        for field in ('user_preferences', 'user_materials'):
+            values = user.get(field)
+            if not (isinstance(values, list) and all(isinstance(v, str) for v in values)):
+                user[field] = []
+        yield user
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate style recommendations for many users')
+    parser.add_argument('--input', type=str, default='-', help='JSONL file of users, or - for stdin')
+    parser.add_argument('--output', type=str, default='-', help='JSONL file to write, or - for stdout')
+    parser.add_argument('--limit', type=int, default=10, help='Recommendations per user')
+    parser.add_argument('--block_size', type=int, default=DEFAULT_BLOCK_SIZE, help='Users scored per matrix multiply')
+    parser.add_argument('--ids_only', action='store_true', help='Return product IDs and scores without details')
+    args = parser.parse_args()
+
+    start = time.time()
+    recommender = StyleRecommender()
+    input_stream = sys.stdin if args.input == '-' else open(args.input)
+    output_stream = sys.stdout if args.output == '-' else open(args.output, 'w')
+    count = 0
+    try:
+        for result in recommend_batch(recommender, _read_users(input_stream), top_k=args.limit,
+                                      block_size=args.block_size, include_details=not args.ids_only):
+            output_stream.write(json.dumps(result) + '\n')
+            count += 1
+    finally:
+        if input_stream is not sys.stdin:
+            input_stream.close()
+        if output_stream is not sys.stdout:
+            output_stream.close()
+        query_cache.save()
+
+    elapsed = time.time() - start
+    print(f"[BATCH] Recommended for {count} users in {elapsed:.2f}s "
+          f"({count / elapsed if elapsed else 0:.0f} users/s)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
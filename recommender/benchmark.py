@@ -0,0 +1,571 @@
+#!/usr/bin/env python
+"""
+benchmark.py
+
+Repeatable benchmarks for the style and size recommenders on synthetic data.
+
+Nothing here talks to Supabase or needs credentials: each run generates a
+synthetic catalog of the requested sizes (clustered, normalised 384-d
+embeddings, product rows with size charts) and serves it through
+InMemorySupabase, a local stand-in that answers the query shapes the
+recommender uses (select/order/gt/in_/eq/limit). Measured:
+
+    style_recommend   StyleRecommender.recommend, per index type (exact, ivf,
+                      quantized or sharded), every query new to the query cache
+    style_cached      the same for queries the query cache already holds
+    style_filtered    style_recommend with a material and price filter
+    size_single       get_size_recommendation, parsing each product's chart
+    size_compiled     the compiled size chart store lookup for one product
+    size_catalog      SizeChartMatrix.recommend over every compiled chart
+    embedding_build   a full vector store build, then an incremental one
+                      after a fraction of the catalog changes
+
+Each result has throughput, latency percentiles and the peak memory
+(tracemalloc) of its setup and a few sampled calls. Results are written as
+JSON; pass a previous run as --baseline to flag regressions:
+
+    python recommender/benchmark.py --sizes 1000,10000,100000 --output bench.json
+    python recommender/benchmark.py --sizes 1000,10000,100000 --baseline bench.json
+
+The default encoder is a deterministic hash of the text, so runs measure the
+recommender rather than the transformer; --encoder model uses the real
+SentenceTransformer.
+"""
+
+import os
+
+# Keep benchmark runs away from the persisted query cache, materialised lists and catalog snapshot
+os.environ.setdefault('RECOMMENDER_QUERY_CACHE', '')
+os.environ.setdefault('RECOMMENDER_MATERIALIZED_DB', '')
+os.environ.setdefault('RECOMMENDER_CATALOG_SNAPSHOT', '')
+
+import argparse
+import contextlib
+import hashlib
+import json
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from ann_index import ExactIndex, IVFIndex
+from attribute_index import AttributeIndex
+from embedding_builder import build_vector_store, iter_product_pages, paged_records
+from embedding_cache import query_cache
+from product_cache import product_cache, set_supabase_client
+from quantized_index import QuantizedIndex
+from sharded_index import ShardedIndex
+from size_chart_store import CompiledSizeCharts, compile_size_charts, write_size_chart_store
+from size_recommender import get_size_recommendation
+from style_recommender import StyleRecommender
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+DIM = 384
+STYLE_WORDS = ('casual', 'formal', 'vintage', 'minimalist', 'bohemian', 'streetwear', 'preppy', 'sporty',
+               'elegant', 'oversized', 'cropped', 'tailored', 'relaxed', 'retro', 'classic', 'edgy')
+ITEM_WORDS = ('dress', 'shirt', 'jeans', 'jacket', 'skirt', 'sweater', 'blazer', 'trousers', 'coat', 'top')
+MATERIALS = ('cotton', 'linen', 'wool', 'silk', 'denim', 'polyester', 'leather', 'cashmere')
+SIZE_LABELS = ('XXS', 'XS', 'S', 'M', 'L', 'XL', 'XXL')
+# About 4% of a synthetic catalog
+STYLE_FILTERS = {'material': ['linen'], 'max_price': 100}
+
+
+class HashEncoder:
+    """Deterministic stand-in for SentenceTransformer: a text's vector is seeded by its hash."""
+
+    def __init__(self, dim: int = DIM):
+        self.dim = dim
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dim
+
+    def encode(self, texts, batch_size: int = 32, **kwargs) -> np.ndarray:
+        single = isinstance(texts, str)
+        rows = []
+        for text in ([texts] if single else texts):
+            seed = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'little')
+            rows.append(np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32))
+        vectors = np.stack(rows) if rows else np.empty((0, self.dim), dtype=np.float32)
+        return vectors[0] if single else vectors
+
+
+class SyntheticCatalog:
+    """A products table whose rows and embeddings are generated on demand from their index."""
+
+    key = 'product_id'
+
+    def __init__(self, size: int, dim: int = DIM, seed: int = 0):
+        self.size = size
+        self.dim = dim
+        self.seed = seed
+        self.revisions: Dict[int, int] = {}
+        self._embeddings = None
+
+    def __len__(self):
+        return self.size
+
+    def product_id(self, i: int) -> str:
+        return f"bench-{i:08d}"
+
+    def _index(self, product_id: Any) -> Optional[int]:
+        try:
+            i = int(str(product_id).rsplit('-', 1)[1])
+        except (IndexError, ValueError):
+            return None
+        return i if 0 <= i < self.size else None
+
+    def row(self, i: int) -> Dict[str, Any]:
+        rng = random.Random(self.seed * 1000003 + i)
+        style, item, material = rng.choice(STYLE_WORDS), rng.choice(ITEM_WORDS), rng.choice(MATERIALS)
+        description = f"{style} {material} {item} in {rng.choice(STYLE_WORDS)} cut"
+        if i in self.revisions:
+            description += f" (revision {self.revisions[i]})"
+        return {
+            'product_id': self.product_id(i),
+            'name': f"{style.title()} {item}",
+            'description': description,
+            'category': item,
+            'image_url': f"https://example.com/{self.product_id(i)}.jpg",
+            'price': round(rng.uniform(10, 300), 2),
+            'material': material,
+            'sizes_with_measurements': synthetic_size_chart(rng),
+        }
+
+    def after(self, last: Any, limit: int) -> List[Dict[str, Any]]:
+        if last is None:
+            start = 0
+        else:
+            index = self._index(last)
+            start = self.size if index is None else index + 1
+        return [self.row(i) for i in range(start, min(self.size, start + limit))]
+
+    def lookup(self, values: Iterable[Any]) -> List[Dict[str, Any]]:
+        indices = (self._index(value) for value in values)
+        return [self.row(i) for i in indices if i is not None]
+
+    def touch(self, fraction: float) -> int:
+        """Change the description of a fraction of the products; returns how many changed."""
+        rng = np.random.default_rng(self.seed + len(self.revisions) + 1)
+        changed = rng.choice(self.size, max(1, int(self.size * fraction)), replace=False)
+        for i in changed.tolist():
+            self.revisions[i] = self.revisions.get(i, 0) + 1
+        return len(changed)
+
+    def embeddings(self, block: int = 65536) -> np.ndarray:
+        """Normalised float32 vectors scattered around sqrt(size) cluster centres."""
+        if self._embeddings is None:
+            rng = np.random.default_rng(self.seed)
+            centres = rng.standard_normal((max(1, int(np.sqrt(self.size))), self.dim), dtype=np.float32)
+            vectors = np.empty((self.size, self.dim), dtype=np.float32)
+            for start in range(0, self.size, block):
+                n = min(block, self.size - start)
+                rows = centres[rng.integers(len(centres), size=n)]
+                rows += 0.5 * rng.standard_normal((n, self.dim), dtype=np.float32)
+                vectors[start:start + n] = rows / np.linalg.norm(rows, axis=1, keepdims=True)
+            self._embeddings = vectors
+        return self._embeddings
+
+
+def synthetic_size_chart(rng: random.Random) -> str:
+    """A sizes_with_measurements string in one of the formats parse_measurements accepts."""
+    labels = list(SIZE_LABELS[rng.randrange(0, 2):rng.randrange(5, len(SIZE_LABELS) + 1)])
+    waist, hip, bust = rng.uniform(24, 30), rng.uniform(34, 40), rng.uniform(30, 36)
+    layout = rng.random()
+    if layout < 0.6:
+        # {size: {measurement: 'value"'}}
+        return json.dumps({label: {'waist': f'{waist + 2 * i:.1f}"', 'hip': f'{hip + 2 * i:.1f}"',
+                                   'bust': f'{bust + 2 * i:.1f}"'}
+                           for i, label in enumerate(labels)})
+    if layout < 0.9:
+        # [{size, measurements}]
+        return json.dumps([{'size': label, 'measurements': {'waist': round(waist + 2 * i, 1),
+                                                            'hip': round(hip + 2 * i, 1)}}
+                           for i, label in enumerate(labels)])
+    # Flat chart: base measurements, expanded per size by the parser
+    return json.dumps({'waist': round(waist + 4, 1), 'bust': round(bust + 4, 1), 'sizes': labels})
+
+
+class _Query:
+    def __init__(self, table, latency: float):
+        self._table = table
+        self._latency = latency
+        self._columns = None
+        self._after = None
+        self._in = None
+        self._eq = None
+        self._limit = None
+
+    def select(self, columns: str = '*') -> '_Query':
+        names = [name.strip() for name in columns.split(',')]
+        self._columns = None if '*' in names else names
+        return self
+
+    def order(self, key: str, **kwargs) -> '_Query':
+        if key != self._table.key:
+            raise ValueError(f"InMemorySupabase can only order by the table key {self._table.key}")
+        return self
+
+    def gt(self, key: str, value: Any) -> '_Query':
+        self._after = value
+        return self
+
+    def in_(self, key: str, values: Sequence[Any]) -> '_Query':
+        if key != self._table.key:
+            raise ValueError(f"InMemorySupabase can only filter on the table key {self._table.key}")
+        self._in = list(values)
+        return self
+
+    def eq(self, key: str, value: Any) -> '_Query':
+        self._eq = (key, value)
+        return self
+
+    def limit(self, count: int) -> '_Query':
+        self._limit = count
+        return self
+
+    def execute(self) -> SimpleNamespace:
+        if self._latency:
+            time.sleep(self._latency)
+        if self._in is not None:
+            rows = self._table.lookup(self._in)
+        elif self._eq is not None and self._eq[0] == self._table.key:
+            rows = self._table.lookup([self._eq[1]])
+        else:
+            rows = self._table.after(self._after, self._limit if self._limit is not None else len(self._table))
+        if self._eq is not None:
+            rows = [row for row in rows if row.get(self._eq[0]) == self._eq[1]]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        if self._columns is not None:
+            rows = [{column: row.get(column) for column in self._columns} for row in rows]
+        return SimpleNamespace(data=rows)
+
+
+class InMemorySupabase:
+    """Local stand-in for the Supabase client.
+
+    Tables are objects with a key attribute, after(last_key, limit) for
+    keyset pages and lookup(keys), like SyntheticCatalog. latency (seconds)
+    is added to every query to model the network round trip.
+    """
+
+    def __init__(self, tables: Dict[str, Any], latency: float = 0.0):
+        self.tables = tables
+        self.latency = latency
+
+    def table(self, name: str) -> _Query:
+        if name not in self.tables:
+            raise KeyError(f"InMemorySupabase has no table '{name}'")
+        return _Query(self.tables[name], self.latency)
+
+
+def traced_peak_mb(fn: Callable[[], Any]) -> tuple:
+    """Run fn under tracemalloc; return (its result, peak traced memory in MB)."""
+    tracemalloc.start()
+    try:
+        result = fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak / (1024 * 1024)
+
+
+def summarize(name: str, catalog_size: int, latencies: Sequence[float], units: int = 1,
+              peak_mb: float = 0.0, **extra) -> Dict[str, Any]:
+    """Throughput and latency percentiles of timed operations, each covering units items."""
+    latencies = np.asarray(latencies, dtype=np.float64)
+    total = float(latencies.sum())
+    result = {
+        'name': name,
+        'catalog_size': catalog_size,
+        'operations': int(len(latencies)),
+        'seconds': round(total, 6),
+        'throughput': round(len(latencies) * units / total, 3) if total > 0 else None,
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 4),
+        'p90_ms': round(float(np.percentile(latencies, 90)) * 1000, 4),
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 4),
+        'max_ms': round(float(latencies.max()) * 1000, 4),
+        'peak_mb': round(peak_mb, 2),
+    }
+    result.update(extra)
+    return result
+
+
+def time_calls(fn: Callable[[int], Any], iterations: int, warmup: int) -> List[float]:
+    for i in range(warmup):
+        fn(i)
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        fn(warmup + i)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def distinct_queries(rng: random.Random, count: int) -> List[List[str]]:
+    """count style queries of one to three phrases, no phrase used twice, so none hits the query cache."""
+    seen, queries = set(), []
+    while len(queries) < count:
+        query = []
+        for _ in range(rng.randint(1, 3)):
+            phrase = ' '.join(rng.sample(STYLE_WORDS, rng.randint(2, 4)) + [rng.choice(ITEM_WORDS)])
+            if phrase not in seen:
+                seen.add(phrase)
+                query.append(phrase)
+        if query:
+            queries.append(query)
+    return queries
+
+
+def bench_style(catalog: SyntheticCatalog, encoder, encoder_name: str, index_kinds: List[str],
+                iterations: int, warmup: int, top_k: int, memory_samples: int) -> List[Dict[str, Any]]:
+    rng = random.Random(catalog.seed)
+    calls = iterations + warmup
+    # Model keys differ per run, so each run sees these as new queries
+    queries = distinct_queries(rng, memory_samples + 2 * calls)
+    setup_queries, timed, filtered = (queries[:memory_samples], queries[memory_samples:memory_samples + calls],
+                                      queries[memory_samples + calls:])
+    # The most recently encoded timed queries are still in the query cache afterwards
+    repeated = timed[-max(1, min(64, iterations // 4)):]
+    embeddings = catalog.embeddings()
+    product_ids = np.array([catalog.product_id(i) for i in range(len(catalog))])
+    attributes = AttributeIndex.build(product_ids, (catalog.row(i) for i in range(len(catalog))))
+    results = []
+    for kind in index_kinds:
+        def setup():
+            start = time.perf_counter()
+            if kind == 'ivf':
+                index = IVFIndex.build(embeddings)
+            elif kind == 'quantized':
+                index = QuantizedIndex.build(embeddings, normalized=True)
+            elif kind == 'sharded':
+                index = ShardedIndex(embeddings, normalized=True)
+            else:
+                index = ExactIndex(embeddings, normalized=True)
+            # A model key per run keeps query-cache hits from carrying over between runs
+            base = SimpleNamespace(model=encoder, model_key=f"{encoder_name}:{len(catalog)}:{kind}",
+                                   product_ids=product_ids, product_embeddings=embeddings, index=index,
+                                   attributes=attributes, neighbours=None, catalog_version=f"benchmark:{len(catalog)}")
+            recommender = StyleRecommender(base=base)
+            for query in setup_queries:
+                recommender.recommend(query=query, top_k=top_k)
+            return recommender, time.perf_counter() - start
+
+        product_cache.clear()
+        (recommender, setup_seconds), peak = traced_peak_mb(setup)
+        product_cache.clear()
+        hits_before, misses_before = query_cache.hits, query_cache.misses
+        latencies = time_calls(lambda i: recommender.recommend(query=timed[i], top_k=top_k), iterations, warmup)
+        results.append(summarize('style_recommend', len(catalog), latencies, peak_mb=peak, index=kind,
+                                 setup_seconds=round(setup_seconds, 3),
+                                 query_cache_hits=query_cache.hits - hits_before,
+                                 query_cache_misses=query_cache.misses - misses_before,
+                                 detail_cache=product_cache.stats()))
+
+        hits_before, misses_before = query_cache.hits, query_cache.misses
+        latencies = time_calls(lambda i: recommender.recommend(query=repeated[i % len(repeated)], top_k=top_k),
+                               iterations, warmup)
+        results.append(summarize('style_cached', len(catalog), latencies, index=kind, queries=len(repeated),
+                                 query_cache_hits=query_cache.hits - hits_before,
+                                 query_cache_misses=query_cache.misses - misses_before))
+
+        latencies = time_calls(lambda i: recommender.recommend(query=filtered[i], top_k=top_k,
+                                                               filters=STYLE_FILTERS),
+                               iterations, warmup)
+        results.append(summarize('style_filtered', len(catalog), latencies, index=kind,
+                                 matching=int(len(attributes.filter(STYLE_FILTERS)))))
+    return results
+
+
+def bench_size(catalog: SyntheticCatalog, iterations: int, warmup: int, chart_count: int,
+               memory_samples: int, workdir: str) -> List[Dict[str, Any]]:
+    rng = random.Random(catalog.seed + 1)
+    products = [catalog.row(i) for i in range(min(chart_count, len(catalog)))]
+    users = [{'waist': rng.uniform(24, 36), 'hip': rng.uniform(34, 46), 'bust': rng.uniform(30, 42)}
+             for _ in range(64)]
+
+    def single(i):
+        return get_size_recommendation(165, 60, users[i % len(users)], products[i % len(products)])
+
+    _, peak = traced_peak_mb(lambda: [single(i) for i in range(memory_samples)])
+    results = [summarize('size_single', len(catalog), time_calls(single, iterations, warmup), peak_mb=peak,
+                         charts=len(products))]
+
+    path = os.path.join(workdir, 'size_charts.store')
+
+    def compile_store():
+        start = time.perf_counter()
+        charts, hashes, report = compile_size_charts(products)
+        write_size_chart_store(charts, hashes, path)
+        return CompiledSizeCharts.open(path), report, time.perf_counter() - start
+
+    (compiled, report, compile_seconds), peak = traced_peak_mb(compile_store)
+
+    def lookup(i):
+        product = products[i % len(products)]
+        if compiled.is_current(product):
+            return compiled.recommend_size(product['product_id'], users[i % len(users)])
+
+    results.append(summarize('size_compiled', len(catalog), time_calls(lookup, iterations, warmup),
+                             peak_mb=peak, charts=report['compiled'], compile_seconds=round(compile_seconds, 3)))
+
+    _, peak = traced_peak_mb(lambda: [compiled.charts.recommend(users[i % len(users)])
+                                      for i in range(memory_samples)])
+    latencies = time_calls(lambda i: compiled.charts.recommend(users[i % len(users)]),
+                           max(1, iterations // 10), warmup)
+    results.append(summarize('size_catalog', len(catalog), latencies, units=len(compiled), peak_mb=peak,
+                             charts=len(compiled), throughput_unit='charts/s'))
+    return results
+
+
+def bench_build(catalog: SyntheticCatalog, encoder, encoder_name: str, change_fraction: float,
+                page_size: int, workdir: str) -> List[Dict[str, Any]]:
+    client = InMemorySupabase({'products': catalog})
+    path = os.path.join(workdir, 'product_vectors.store')
+
+    def to_record(product):
+        return str(product['product_id']), (product.get('name') or '') + " " + (product.get('description') or '')
+
+    def build(incremental):
+        pages = iter_product_pages(client, 'product_id, name, description', page_size=page_size)
+        start = time.perf_counter()
+        # Build progress goes to stdout; keep stdout for the results table
+        with contextlib.redirect_stdout(sys.stderr):
+            stats = build_vector_store(paged_records(pages, to_record), encoder, encoder_name, path,
+                                       incremental=incremental)
+        return stats, time.perf_counter() - start
+
+    results = []
+    (stats, seconds), peak = traced_peak_mb(lambda: build(False))
+    results.append(summarize('embedding_build', len(catalog), [seconds], units=stats['total'], peak_mb=peak,
+                             mode='full', encoded=stats['encoded'], throughput_unit='products/s'))
+    catalog.touch(change_fraction)
+    (stats, seconds), peak = traced_peak_mb(lambda: build(True))
+    results.append(summarize('embedding_build', len(catalog), [seconds], units=stats['total'], peak_mb=peak,
+                             mode='incremental', encoded=stats['encoded'], throughput_unit='products/s'))
+    return results
+
+
+def result_key(result: Dict[str, Any]) -> tuple:
+    return (result['name'], result['catalog_size'], result.get('index'), result.get('mode'))
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Describe results whose p50 latency got worse than the baseline by more than tolerance."""
+    previous = {result_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None or not old.get('p50_ms'):
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1.0
+        result['p50_change'] = round(change, 4)
+        if change > tolerance:
+            regressions.append(f"{result['name']} {'/'.join(str(k) for k in result_key(result)[1:] if k)}: "
+                               f"p50 {old['p50_ms']:.3f}ms -> {result['p50_ms']:.3f}ms ({change:+.1%})")
+    return regressions
+
+
+def print_table(results: List[Dict[str, Any]]):
+    print(f"{'benchmark':<28}{'catalog':>10}{'ops':>7}{'throughput':>14}{'p50 ms':>10}{'p90 ms':>10}"
+          f"{'p99 ms':>10}{'peak MB':>10}{'vs base':>9}")
+    for result in results:
+        label = '/'.join([result['name']] + [str(v) for v in (result.get('index'), result.get('mode')) if v])
+        throughput = f"{result['throughput']:.1f}" if result['throughput'] is not None else '-'
+        change = f"{result['p50_change']:+.1%}" if 'p50_change' in result else ''
+        print(f"{label:<28}{result['catalog_size']:>10}{result['operations']:>7}{throughput:>14}"
+              f"{result['p50_ms']:>10.3f}{result['p90_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+              f"{result['peak_mb']:>10.1f}{change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the recommenders on synthetic catalogs')
+    parser.add_argument('--sizes', type=str, default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma-separated catalog sizes (products)')
+    parser.add_argument('--benchmarks', type=str, default='style,size,build',
+                        help='Comma-separated subset of style, size, build')
+    parser.add_argument('--index', type=str, default='exact,ivf', help='Index types for the style benchmark: exact, ivf, quantized, sharded')
+    parser.add_argument('--encoder', choices=['hash', 'model'], default='hash',
+                        help='hash: deterministic stand-in encoder; model: all-MiniLM-L6-v2')
+    parser.add_argument('--iterations', type=int, default=200, help='Timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed calls before timing')
+    parser.add_argument('--top_k', type=int, default=10, help='Recommendations per style request')
+    parser.add_argument('--size_charts', type=int, default=10000,
+                        help='Products whose size charts are used by the size benchmarks')
+    parser.add_argument('--change_fraction', type=float, default=0.01,
+                        help='Fraction of products changed before the incremental build')
+    parser.add_argument('--page_size', type=int, default=500, help='Products per page in the build benchmark')
+    parser.add_argument('--supabase_latency_ms', type=float, default=0.0,
+                        help='Simulated round trip added to every in-memory Supabase query')
+    parser.add_argument('--memory_samples', type=int, default=5, help='Calls traced for peak memory')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic data')
+    parser.add_argument('--output', type=str, help='Write results as JSON to this file')
+    parser.add_argument('--baseline', type=str, help='Previous --output file to compare p50 latencies against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Allowed p50 slowdown against the baseline before it counts as a regression')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+    benchmarks = {name.strip() for name in args.benchmarks.split(',')}
+    index_kinds = [kind.strip() for kind in args.index.split(',') if kind.strip()]
+    if args.encoder == 'model':
+        from sentence_transformers import SentenceTransformer
+        encoder, encoder_name = SentenceTransformer('all-MiniLM-L6-v2'), 'all-MiniLM-L6-v2'
+    else:
+        encoder, encoder_name = HashEncoder(), 'benchmark-hash'
+
+    results = []
+    for size in sizes:
+        catalog = SyntheticCatalog(size, seed=args.seed)
+        set_supabase_client(InMemorySupabase({'products': catalog}, latency=args.supabase_latency_ms / 1000.0))
+        workdir = tempfile.mkdtemp(prefix='recommender-bench-')
+        try:
+            print(f"[BENCH] Catalog of {size} products", file=sys.stderr)
+            if 'style' in benchmarks:
+                results.extend(bench_style(catalog, encoder, encoder_name, index_kinds, args.iterations,
+                                           args.warmup, args.top_k, args.memory_samples))
+            if 'size' in benchmarks:
+                results.extend(bench_size(catalog, args.iterations, args.warmup, args.size_charts,
+                                          args.memory_samples, workdir))
+            if 'build' in benchmarks:
+                results.extend(bench_build(catalog, encoder, encoder_name, args.change_fraction,
+                                           args.page_size, workdir))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+
+    print_table(results)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    if args.output:
+        report = {
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'encoder': encoder_name,
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,27 @@
 """
 build_product_embeddings.py
 
-This script loads the product catalog from Supabase (table: 'products'),
-combines name and description into a text field, encodes the texts using a
-pretrained SentenceTransformer model, and saves the embeddings to
-'models/product_embeddings.npy'.
+This script streams the product catalog from the local catalog snapshot, or
+from Supabase (table: 'products') when there is none, page by page, combines name and description into a text field, encodes the
+texts using a pretrained SentenceTransformer model, and appends the embeddings
+to the memory-mapped product vector store ('models/product_vectors.store').
+
+By default only new or changed products are encoded; pass --full to
+re-encode the whole catalog.
 """
 
+import argparse
 import os
 import sys
-import numpy as np
-import pandas as pd
 from sentence_transformers import SentenceTransformer
 
+from ann_index import refresh_ivf_index
+from attribute_index import build_attribute_index
+from catalog_snapshot import catalog_snapshot
+from embedding_builder import DEFAULT_PAGE_SIZE, build_vector_store, iter_product_pages, paged_records
+from neighbour_graph import build_neighbour_graph
+from vector_store import STORE_PATH, load_product_vectors
+
 # If you haven't installed supabase-py:
 #   pip install supabase
 
@@ -25,57 +34,78 @@ except ImportError:
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Build product embeddings from Supabase')
+    parser.add_argument('--full', action='store_true', help='Re-encode every product instead of only changed ones')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Products fetched and encoded per page')
+    parser.add_argument('--remote', action='store_true', help='Read products from Supabase even if there is a catalog snapshot')
+    args = parser.parse_args()
+
     # Ensure the models directory exists
     os.makedirs("models", exist_ok=True)
 
-    # --- SUPABASE CLIENT SETUP ---
-    # Adjust these environment variable names to match how you store them
-    url = os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
-    key = os.environ.get("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+    snapshot = None if args.remote else catalog_snapshot()
+    if snapshot is None:
+        # --- SUPABASE CLIENT SETUP ---
+        # Adjust these environment variable names to match how you store them
+        url = os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
+        key = os.environ.get("NEXT_PUBLIC_SUPABASE_ANON_KEY")
 
-    if not url or not key:
-        print("Error: Supabase URL/Key environment variables not set.", file=sys.stderr)
-        sys.exit(1)
+        if not url or not key:
+            print("Error: Supabase URL/Key environment variables not set.", file=sys.stderr)
+            sys.exit(1)
+
+        # Create Supabase client
+        supabase: Client = create_client(url, key)
 
-    # Create Supabase client
-    supabase: Client = create_client(url, key)
+    # Load the SentenceTransformer model
+    model = SentenceTransformer("all-MiniLM-L6-v2")
+
+    # --- STREAM PRODUCTS FROM SUPABASE AND ENCODE THEM PAGE BY PAGE ---
+    def to_record(product):
+        # Combine name and description into one text field
+        text = (product.get('name') or '') + " " + (product.get('description') or '')
+        return str(product['product_id']), text
 
-    # --- FETCH PRODUCTS FROM SUPABASE ---
+    print("Encoding product descriptions...")
+    if snapshot is not None:
+        print(f"Reading {len(snapshot)} products from the catalog snapshot")
+        pages = snapshot.iter_pages("product_id, name, description", page_size=args.page_size)
+    else:
+        pages = iter_product_pages(supabase, "product_id, name, description", page_size=args.page_size)
     try:
-        response = supabase.table("products").select("product_id, name, description").execute()
-        data = response.data
-        if not data:
-            print("No products found in the 'products' table.", file=sys.stderr)
-            sys.exit(0)
+        stats = build_vector_store(paged_records(pages, to_record), model, "all-MiniLM-L6-v2",
+                                   STORE_PATH, incremental=not args.full)
     except Exception as e:
-        print(f"Error fetching products from Supabase: {e}", file=sys.stderr)
+        print(f"Error building product embeddings: {e}", file=sys.stderr)
         sys.exit(1)
 
-    # Convert fetched data to a pandas DataFrame
-    df = pd.DataFrame(data)
-
-    # Combine name and description into one text field
-    df['text'] = df['name'].fillna('') + " " + df['description'].fillna('')
+    if not stats['total']:
+        print("No products found in the 'products' table.", file=sys.stderr)
+        sys.exit(0)
 
-    # Filter out empty texts
-    df = df[df['text'].str.strip().astype(bool)]
-    print(f"Loaded {len(df)} products from Supabase.")
+    print(f"Product embeddings and IDs saved to '{STORE_PATH}'.")
 
-    # Load the SentenceTransformer model
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-
-    # Encode all product texts
-    print("Encoding product descriptions...")
-    product_texts = df['text'].tolist()
-    embeddings = model.encode(product_texts, show_progress_bar=True)
+    # Index material, category, tag, colour and price against the new store's rows
+    try:
+        if snapshot is not None:
+            pages = snapshot.iter_pages(page_size=args.page_size)
+        else:
+            pages = iter_product_pages(supabase, page_size=args.page_size)
+        build_attribute_index(load_product_vectors(STORE_PATH)[0], pages)
+    except Exception as e:
+        print(f"Error building attribute index: {e}", file=sys.stderr)
 
-    # Optionally, save product IDs alongside embeddings to match them later
-    product_ids = df['product_id'].tolist()
-    np.save("models/product_embeddings.npy", embeddings)
-    np.save("models/product_ids.npy", product_ids)
+    # Update the "more like this" neighbour lists for new, changed and removed products
+    try:
+        build_neighbour_graph(STORE_PATH, incremental=not args.full)
+    except Exception as e:
+        print(f"Error building neighbour graph: {e}", file=sys.stderr)
 
-    print("Product embeddings saved to 'models/product_embeddings.npy'.")
-    print("Associated product IDs saved to 'models/product_ids.npy'.")
+    # An IVF index built for the old rows would mislead search; rebuild it if there is one
+    try:
+        refresh_ivf_index(STORE_PATH)
+    except Exception as e:
+        print(f"Error rebuilding IVF index: {e}", file=sys.stderr)
 
 if __name__ == "__main__":
     main()
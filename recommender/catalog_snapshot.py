@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+catalog_snapshot.py
+
+Local, memory-mapped snapshot of the products table.
+
+The recommenders used to read product fields from Supabase whenever they
+needed them: detail lookups for every recommendation list, the whole
+catalog for size charts and embedding builds. This module keeps a copy of
+the products table in an Arrow IPC file, models/catalog.arrow, that every
+component reads through a memory map, so serving needs no database round
+trips and the same file is shared by all processes on the host.
+
+The snapshot is refreshed with delta pulls: only products whose change
+column (updated_at by default) is at or after the newest value already in
+the snapshot are fetched, plus one ID-only pass to drop deleted products.
+Rows at the high-water mark itself are pulled again, since another row may
+have committed later with the same timestamp.
+Tables without the change column are pulled in full.
+
+    python recommender/catalog_snapshot.py sync            # delta pull, or full on first run
+    python recommender/catalog_snapshot.py sync --full
+    python recommender/catalog_snapshot.py info
+
+RECOMMENDER_CATALOG_SNAPSHOT sets the snapshot path (empty to disable it)
+and RECOMMENDER_SNAPSHOT_CHANGE_COLUMN the change column. Reading and
+writing snapshots needs pyarrow (pip install pyarrow); without it every
+component reads from Supabase as before.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+except ImportError:
+    pa = None
+
+from embedding_builder import DEFAULT_PAGE_SIZE, iter_product_pages
+from vector_store import MODELS_DIR
+
+SNAPSHOT_PATH = os.path.join(MODELS_DIR, 'catalog.arrow')
+DEFAULT_CHANGE_COLUMN = 'updated_at'
+METADATA_KEY = b'catalog_snapshot'
+FORMAT_VERSION = 1
+
+
+def _columns(columns: str) -> Optional[List[str]]:
+    """Parse a Supabase-style column list; None for every column."""
+    names = [name.strip() for name in columns.split(',') if name.strip()]
+    return None if not names or '*' in names else names
+
+
+class CatalogSnapshot:
+    """Read-only, memory-mapped Arrow snapshot of the products table."""
+
+    def __init__(self, path: str, table, metadata: Dict[str, Any]):
+        self.path = path
+        self.table = table
+        self.metadata = metadata
+        self.json_columns = set(metadata.get('json_columns', []))
+        self._rows = None
+        self._rows_lock = threading.Lock()
+
+    def __len__(self):
+        return self.table.num_rows
+
+    @property
+    def high_water(self) -> Optional[str]:
+        return self.metadata.get('high_water')
+
+    @classmethod
+    def open(cls, path: str = SNAPSHOT_PATH) -> 'CatalogSnapshot':
+        if pa is None:
+            raise RuntimeError("Catalog snapshots need pyarrow: pip install pyarrow")
+        # Record batches reference the mapped file directly; nothing is copied
+        table = pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+        raw = (table.schema.metadata or {}).get(METADATA_KEY)
+        if raw is None:
+            raise ValueError(f"{path} is not a catalog snapshot")
+        return cls(path, table, json.loads(raw.decode('utf-8')))
+
+    def _row_index(self) -> Dict[str, int]:
+        if self._rows is None:
+            with self._rows_lock:
+                if self._rows is None:
+                    ids = self.table.column('product_id').to_pylist()
+                    self._rows = {str(product_id): row for row, product_id in enumerate(ids)}
+        return self._rows
+
+    def _decode(self, records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Restore the list and dict values that were stored as JSON text."""
+        for record in records:
+            for column in self.json_columns.intersection(record):
+                if record[column] is not None:
+                    record[column] = json.loads(record[column])
+        return records
+
+    def _select(self, table, columns: Optional[List[str]]):
+        if columns is None:
+            return table
+        return table.select([column for column in columns if column in table.column_names])
+
+    def get_many(self, product_ids: Iterable[str], columns: str = '*') -> Dict[str, Dict[str, Any]]:
+        """Rows of the given products that are in the snapshot, keyed by product ID."""
+        index = self._row_index()
+        found = [(str(product_id), index[str(product_id)]) for product_id in product_ids
+                 if str(product_id) in index]
+        if not found:
+            return {}
+        rows = self._select(self.table.take([row for _, row in found]), _columns(columns)).to_pylist()
+        return {product_id: record for (product_id, _), record in zip(found, self._decode(rows))}
+
+    def iter_pages(self, columns: str = '*', page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[Dict[str, Any]]]:
+        """Yield the snapshot page by page in product_id order, like iter_product_pages."""
+        table = self._select(self.table, _columns(columns))
+        for batch in table.to_batches(max_chunksize=page_size):
+            if batch.num_rows:
+                yield self._decode(batch.to_pylist())
+
+
+def _arrow_table(rows: List[Dict[str, Any]], metadata: Dict[str, Any]):
+    """Build an Arrow table from product rows; lists and dicts are stored as JSON text."""
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    json_columns, arrays = [], []
+    for name in names:
+        values = [row.get(name) for row in rows]
+        if any(isinstance(value, (dict, list)) for value in values):
+            json_columns.append(name)
+            values = [None if value is None else json.dumps(value) for value in values]
+        try:
+            arrays.append(pa.array(values))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            # Mixed types in one column (e.g. numbers and strings): keep them as text
+            arrays.append(pa.array([None if value is None else str(value) for value in values]))
+    metadata = dict(metadata, json_columns=json_columns)
+    schema = pa.schema([pa.field(name, array.type) for name, array in zip(names, arrays)],
+                       metadata={METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_snapshot(rows: List[Dict[str, Any]], path: str = SNAPSHOT_PATH,
+                   change_column: Optional[str] = DEFAULT_CHANGE_COLUMN) -> Dict[str, Any]:
+    """Write product rows to path as an Arrow IPC file, atomically replacing any existing snapshot."""
+    if pa is None:
+        raise RuntimeError("Catalog snapshots need pyarrow: pip install pyarrow")
+    rows = sorted(rows, key=lambda row: str(row['product_id']))
+    changes = [str(row[change_column]) for row in rows if change_column and row.get(change_column) is not None]
+    metadata = {
+        'version': FORMAT_VERSION,
+        'synced_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'count': len(rows),
+        'change_column': change_column if changes else None,
+        'high_water': max(changes) if changes else None,
+    }
+    table = _arrow_table(rows, metadata)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.catalog-', delete=False) as f:
+        try:
+            with pa.ipc.new_file(f, table.schema) as writer:
+                writer.write_table(table, max_chunksize=DEFAULT_PAGE_SIZE)
+            f.flush()
+            os.fsync(f.fileno())
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+    # NamedTemporaryFile creates the file owner-only; readers may be other users
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return metadata
+
+
+def iter_changed_pages(supabase, change_column: str, since: str, columns: str = '*',
+                       page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[dict]]:
+    """Yield products whose change column is at or after since, keyset-paginated on product_id."""
+    last_id = None
+    while True:
+        # gte, not gt: a row committed after the last sync can carry the high-water timestamp itself
+        query = supabase.table('products').select(columns).gte(change_column, since).order('product_id')
+        if last_id is not None:
+            query = query.gt('product_id', last_id)
+        rows = query.limit(page_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1]['product_id']
+
+
+def sync_snapshot(supabase, path: str = SNAPSHOT_PATH, change_column: Optional[str] = DEFAULT_CHANGE_COLUMN,
+                  full: bool = False, page_size: int = DEFAULT_PAGE_SIZE) -> Dict[str, Any]:
+    """Bring the snapshot at path up to date with the products table and return sync counts."""
+    previous = None
+    if not full and os.path.exists(path):
+        try:
+            previous = CatalogSnapshot.open(path)
+        except Exception as e:
+            print(f"[SNAPSHOT] Ignoring unreadable snapshot {path}: {e}", file=sys.stderr)
+    if previous is not None and (not change_column or previous.high_water is None
+                                 or previous.metadata.get('change_column') != change_column):
+        print(f"[SNAPSHOT] Snapshot has no '{change_column}' high-water mark; pulling the full table",
+              file=sys.stderr)
+        previous = None
+
+    if previous is not None:
+        try:
+            changed = [row for page in iter_changed_pages(supabase, change_column, previous.high_water,
+                                                          page_size=page_size) for row in page]
+        except Exception as e:
+            print(f"[SNAPSHOT] Delta pull failed ({e}); pulling the full table", file=sys.stderr)
+            previous = None
+
+    if previous is None:
+        rows = [row for page in iter_product_pages(supabase, '*', page_size=page_size) for row in page]
+        stats = {'mode': 'full', 'pulled': len(rows), 'removed': 0}
+    else:
+        # Deletions do not show up in a delta pull; one ID-only pass finds them
+        current = {str(row['product_id'])
+                   for page in iter_product_pages(supabase, 'product_id', page_size=page_size) for row in page}
+        by_id = {str(row['product_id']): row for page in previous.iter_pages(page_size=page_size) for row in page}
+        removed = [product_id for product_id in by_id if product_id not in current]
+        for product_id in removed:
+            del by_id[product_id]
+        for row in changed:
+            by_id[str(row['product_id'])] = row
+        rows = list(by_id.values())
+        stats = {'mode': 'delta', 'pulled': len(changed), 'removed': len(removed)}
+
+    if not rows:
+        print("[SNAPSHOT] The products table is empty; keeping the existing snapshot", file=sys.stderr)
+        return dict(stats, total=0)
+    metadata = write_snapshot(rows, path, change_column)
+    if change_column and metadata['change_column'] is None:
+        print(f"[SNAPSHOT] Products have no '{change_column}' column; every sync will pull the full table",
+              file=sys.stderr)
+    return dict(stats, total=metadata['count'])
+
+
+_snapshot = None
+_snapshot_mtime = None
+_snapshot_lock = threading.Lock()
+
+
+def catalog_snapshot(path: Optional[str] = None) -> Optional[CatalogSnapshot]:
+    """Return the memory-mapped snapshot, reopening it after a sync; None if there is none."""
+    global _snapshot, _snapshot_mtime
+    path = path if path is not None else os.getenv('RECOMMENDER_CATALOG_SNAPSHOT', SNAPSHOT_PATH)
+    if not path or pa is None:
+        return None
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _snapshot is None or mtime != _snapshot_mtime or _snapshot.path != path:
+        with _snapshot_lock:
+            if _snapshot is None or mtime != _snapshot_mtime or _snapshot.path != path:
+                try:
+                    _snapshot = CatalogSnapshot.open(path)
+                    print(f"[SNAPSHOT] Opened catalog snapshot of {len(_snapshot)} products", file=sys.stderr)
+                except Exception as e:
+                    print(f"[SNAPSHOT] Could not open catalog snapshot {path}: {e}", file=sys.stderr)
+                    _snapshot = None
+                _snapshot_mtime = mtime
+    return _snapshot
+
+
+def product_pages(supabase=None, columns: str = '*', page_size: int = DEFAULT_PAGE_SIZE,
+                  remote: bool = False) -> Iterator[List[dict]]:
+    """Yield the catalog page by page from the snapshot, or from Supabase if there is none (or remote)."""
+    snapshot = None if remote else catalog_snapshot()
+    if snapshot is not None:
+        return snapshot.iter_pages(columns, page_size)
+    if supabase is None:
+        from product_cache import get_supabase_client
+        supabase = get_supabase_client()
+    if supabase is None:
+        return iter([])
+    return iter_product_pages(supabase, columns, page_size=page_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync the products table into a local Arrow snapshot')
+    parser.add_argument('command', choices=['sync', 'info'],
+                        help='sync: pull changes from Supabase; info: print the snapshot metadata')
+    parser.add_argument('--path', type=str,
+                        default=os.getenv('RECOMMENDER_CATALOG_SNAPSHOT') or SNAPSHOT_PATH,
+                        help='Snapshot path')
+    parser.add_argument('--full', action='store_true', help='Pull the whole table instead of a delta')
+    parser.add_argument('--change_column', type=str,
+                        default=os.getenv('RECOMMENDER_SNAPSHOT_CHANGE_COLUMN', DEFAULT_CHANGE_COLUMN),
+                        help='Products column that increases whenever a row changes (empty: always pull in full)')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Rows fetched per request')
+    args = parser.parse_args()
+
+    if pa is None:
+        print("Catalog snapshots need pyarrow: pip install pyarrow", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'info':
+        snapshot = CatalogSnapshot.open(args.path)
+        print(json.dumps(dict(snapshot.metadata, columns=snapshot.table.column_names), indent=2))
+        return
+
+    from product_cache import get_supabase_client
+    client = get_supabase_client()
+    if client is None:
+        sys.exit(1)
+    start = time.time()
+    stats = sync_snapshot(client, args.path, args.change_column or None, full=args.full,
+                          page_size=args.page_size)
+    print(f"Synced {stats['total']} products to {args.path} in {time.time() - start:.2f}s "
+          f"({stats['mode']}: {stats['pulled']} pulled, {stats['removed']} removed)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+embedding_builder.py
+
+Shared build step for the product embedding scripts.
+
+Products are streamed from Supabase in pages (keyset-paginated on
+product_id) and each page is encoded and appended to the vector store as
+soon as it arrives, while the next page is fetched on a background thread.
+Only one page of rows and vectors is held in memory at a time, whatever the
+catalog size.
+
+Each product's embedding text is hashed and the hash is stored next to its
+vector, so an incremental build only sends new or changed products to the
+encoder, copies unchanged vectors from the previous store and drops products
+that no longer exist.
+"""
+
+import hashlib
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from metrics import increment, stage
+from vector_store import DEFAULT_ID_WIDTH, STORE_PATH, VectorStore, VectorStoreWriter
+
+DEFAULT_PAGE_SIZE = 500
+
+
+def content_hash(text: str) -> str:
+    """Hex digest identifying the exact text a product was embedded from."""
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def iter_table_pages(supabase, table: str, key: str, columns: str = '*',
+                     page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[dict]]:
+    """Yield a table page by page, ordered by (and keyset-paginated on) a unique key."""
+    last_id = None
+    while True:
+        query = supabase.table(table).select(columns).order(key)
+        if last_id is not None:
+            query = query.gt(key, last_id)
+        rows = query.limit(page_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1][key]
+
+
+def iter_product_pages(supabase, columns: str = '*', page_size: int = DEFAULT_PAGE_SIZE) -> Iterator[List[dict]]:
+    """Yield the products table page by page, ordered by product_id."""
+    return iter_table_pages(supabase, 'products', 'product_id', columns, page_size)
+
+
+def prefetch(pages: Iterable) -> Iterator:
+    """Iterate pages while the next one is fetched on a background thread."""
+    iterator = iter(pages)
+    sentinel = object()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(next, iterator, sentinel)
+        while True:
+            page = pending.result()
+            if page is sentinel:
+                return
+            pending = executor.submit(next, iterator, sentinel)
+            yield page
+
+
+def paged_records(pages: Iterable[List[dict]],
+                  to_record: Callable[[dict], Tuple[str, str]]) -> Iterator[List[Tuple[str, str]]]:
+    """Turn pages of product rows into pages of (product_id, text), skipping empty texts."""
+    for page in pages:
+        records = [to_record(product) for product in page]
+        yield [(product_id, text) for product_id, text in records if product_id and text.strip()]
+
+
+def _previous_rows(path: str, model_name: str) -> Tuple[VectorStore, Dict[str, Tuple[int, str]]]:
+    """Map product ID to (row, hash) in the existing store, if it can be reused."""
+    if not os.path.exists(path):
+        return None, {}
+    store = VectorStore.open(path)
+    if store.hashes is None:
+        print("Existing vector store has no content hashes; re-encoding everything.")
+        return None, {}
+    if store.model != model_name:
+        print(f"Existing vector store was built with {store.model}, not {model_name}; re-encoding everything.")
+        return None, {}
+    rows = {}
+    for row, (product_id, digest) in enumerate(zip(store.ids, store.hashes)):
+        rows[product_id.decode('ascii')] = (row, digest.decode('ascii'))
+    return store, rows
+
+
+def build_vector_store(pages: Iterable[List[Tuple[str, str]]], model, model_name: str,
+                       path: str = STORE_PATH, incremental: bool = True,
+                       batch_size: int = 64, dtype: str = 'float32',
+                       id_width: int = DEFAULT_ID_WIDTH) -> Dict[str, int]:
+    """Write a vector store from pages of (product_id, text) pairs and return build counts.
+
+    With incremental=True, products whose ID and text hash match the existing
+    store keep their stored vector and only the rest are encoded. Pages are
+    consumed one at a time; pass a generator to keep memory flat.
+    """
+    start = time.time()
+    previous, previous_rows = _previous_rows(path, model_name) if incremental else (None, {})
+    dim = model.get_sentence_embedding_dimension()
+    if previous is not None and previous.dim != dim:
+        previous, previous_rows = None, {}
+
+    stats = {'total': 0, 'reused': 0, 'encoded': 0, 'added': 0, 'changed': 0, 'removed': 0}
+    seen = set()
+    if previous is not None:
+        # Start at the previous store's width; the writer widens the column if a longer ID arrives
+        id_width = max(id_width, previous.header['id_width'])
+    writer = VectorStoreWriter(path, dim=dim, model=model_name, dtype=dtype, id_width=id_width, with_hashes=True)
+    try:
+        for page in prefetch(pages):
+            if not page:
+                continue
+            ids = [str(product_id) for product_id, _ in page]
+            hashes = [content_hash(text) for _, text in page]
+            rows = np.empty((len(page), dim), dtype=np.float32)
+
+            to_encode = []
+            for i, (product_id, digest) in enumerate(zip(ids, hashes)):
+                old = previous_rows.get(product_id)
+                if old is not None and old[1] == digest:
+                    rows[i] = previous.vectors[old[0]]
+                else:
+                    to_encode.append(i)
+                    stats['changed' if old is not None else 'added'] += 1
+
+            if to_encode:
+                with stage('encode', source='catalog_build'):
+                    vectors = np.asarray(model.encode([page[i][1] for i in to_encode], batch_size=batch_size),
+                                         dtype=np.float32)
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                rows[to_encode] = vectors / norms
+
+            with stage('store_write'):
+                writer.append(ids, rows, hashes, normalized=True)
+            seen.update(ids)
+            increment('recommender_catalog_vectors_total', len(to_encode), result='encoded')
+            increment('recommender_catalog_vectors_total', len(page) - len(to_encode), result='reused')
+            stats['total'] += len(page)
+            stats['encoded'] += len(to_encode)
+            print(f"Processed {stats['total']} products ({stats['encoded']} encoded)")
+    except Exception:
+        writer.abort()
+        raise
+
+    if stats['total'] == 0:
+        # Never replace an existing store with an empty one
+        writer.abort()
+        return stats
+
+    writer.close()
+    stats['reused'] = stats['total'] - stats['encoded']
+    stats['removed'] = sum(1 for product_id in previous_rows if product_id not in seen)
+    print(f"Wrote {stats['total']} product vectors to {path} in {time.time() - start:.2f}s "
+          f"({stats['added']} new, {stats['changed']} changed, {stats['removed']} removed)")
+    return stats
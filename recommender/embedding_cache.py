@@ -0,0 +1,171 @@
+"""
+embedding_cache.py
+
+Memoised embeddings for preference strings.
+
+Most style queries come from the small onboarding vocabulary ("Casual",
+"Modern", short style phrases), so the same strings are encoded over and
+over. QueryEmbeddingCache keys vectors by (model identity, exact text),
+keeps at most max_entries of them in LRU order, and sends only the misses to
+the encoder, in one batch. It can be saved to and loaded from an .npz file so
+separate processes (e.g. the per-request CLI) benefit as well.
+
+RECOMMENDER_QUERY_CACHE sets the file the shared cache is persisted to (set
+it to an empty string to keep the cache in memory only) and
+RECOMMENDER_QUERY_CACHE_SIZE the number of entries kept.
+"""
+
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+
+from vector_store import MODELS_DIR
+
+DEFAULT_CACHE_PATH = os.path.join(MODELS_DIR, 'query_cache.npz')
+
+
+class QueryEmbeddingCache:
+    """Bounded LRU cache of text embeddings, keyed by model identity and text."""
+
+    def __init__(self, max_entries: int = 4096, path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def encode(self, model, texts: Union[str, List[str]], model_key: str) -> np.ndarray:
+        """Return one embedding row per text, encoding only the texts not cached."""
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        vectors, missing = self._lookup(texts, model_key)
+        if missing:
+            # Duplicate texts in one request are encoded once
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            self._fill(texts, vectors, missing, unique, model.encode(unique), model_key)
+        return np.stack(vectors)
+
+    def submit(self, model, texts: Union[str, List[str]], model_key: str) -> Future:
+        """Like encode, but returns a Future; the misses go to model.submit (an EncodeBatcher) without waiting."""
+        if isinstance(texts, str):
+            texts = [texts]
+        result: Future = Future()
+        if not texts:
+            result.set_result(np.empty((0, 0), dtype=np.float32))
+            return result
+        vectors, missing = self._lookup(texts, model_key)
+        if not missing:
+            result.set_result(np.stack(vectors))
+            return result
+        unique = list(dict.fromkeys(texts[i] for i in missing))
+
+        def done(encoded: Future):
+            # The vectors are cached even if the caller has cancelled in the meantime
+            try:
+                self._fill(texts, vectors, missing, unique, encoded.result(), model_key)
+                outcome, error = np.stack(vectors), None
+            except Exception as e:
+                outcome, error = None, e
+            try:
+                if error is None:
+                    result.set_result(outcome)
+                else:
+                    result.set_exception(error)
+            except InvalidStateError:
+                pass
+        model.submit(unique).add_done_callback(done)
+        return result
+
+    def _lookup(self, texts: List[str], model_key: str) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """Cached vectors per text (None for misses) and the indices of the misses."""
+        self._ensure_loaded()
+        vectors: List[Optional[np.ndarray]] = [None] * len(texts)
+        missing = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                cached = self._entries.get((model_key, text))
+                if cached is None:
+                    missing.append(i)
+                else:
+                    self._entries.move_to_end((model_key, text))
+                    vectors[i] = cached
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return vectors, missing
+
+    def _fill(self, texts: List[str], vectors: List[Optional[np.ndarray]], missing: List[int],
+              unique: List[str], encoded, model_key: str):
+        """Put the encoded misses into vectors and the cache."""
+        encoded = np.asarray(encoded, dtype=np.float32).reshape(len(unique), -1)
+        by_text = dict(zip(unique, encoded))
+        for i in missing:
+            vectors[i] = by_text[texts[i]]
+        with self._lock:
+            for text, vector in by_text.items():
+                self._entries[(model_key, text)] = vector
+                self._entries.move_to_end((model_key, text))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path or not os.path.exists(self.path):
+                return
+            try:
+                data = np.load(self.path, allow_pickle=False)
+                for model_key, text, vector in zip(data['model_keys'], data['texts'], data['vectors']):
+                    self._entries[(str(model_key), str(text))] = vector
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                print(f"[QUERY CACHE] Loaded {len(self._entries)} cached query embeddings", file=sys.stderr)
+            except Exception as e:
+                print(f"[QUERY CACHE] Ignoring unreadable cache file {self.path}: {e}", file=sys.stderr)
+
+    def save(self):
+        """Write the cache to its path if anything was added since it was loaded."""
+        if not self.path or not self._dirty:
+            return
+        with self._lock:
+            keys = list(self._entries.keys())
+            vectors = np.stack(list(self._entries.values())) if keys else np.empty((0, 0), dtype=np.float32)
+            self._dirty = False
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+                np.savez(f,
+                         model_keys=np.array([model_key for model_key, _ in keys]),
+                         texts=np.array([text for _, text in keys]),
+                         vectors=vectors)
+            os.replace(f.name, self.path)
+        except Exception as e:
+            print(f"[QUERY CACHE] Could not save cache to {self.path}: {e}", file=sys.stderr)
+
+    def stats(self):
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+query_cache = QueryEmbeddingCache(
+    max_entries=int(os.getenv('RECOMMENDER_QUERY_CACHE_SIZE', '4096')),
+    path=os.getenv('RECOMMENDER_QUERY_CACHE', DEFAULT_CACHE_PATH) or None,
+)
@@ -0,0 +1,150 @@
+"""
+encode_batcher.py
+
+Micro-batching of query encoding across concurrent requests.
+
+Each style request encodes a handful of short preference strings, and the
+query cache only sends the misses to the model, so under load the encoder
+runs many forward passes over one to three texts each. A transformer
+encodes 32 short texts in little more time than one. EncodeBatcher wraps
+the model: a caller's texts are queued, and a single dispatcher thread
+collects every request that arrives within `window_ms` of the first one
+(or until `max_batch` texts are waiting). It then encodes the distinct
+texts in one forward pass and hands each caller its own rows.
+
+The wrapper has the model's encode() signature, so it can stand in for the
+model wherever the query cache is given one:
+
+    model = EncodeBatcher(load_encoder()[0], window_ms=2, max_batch=64)
+
+Callers that must not block a thread while their batch waits (the asyncio
+pipeline) use submit() and wait on the returned Future instead.
+
+The service wraps the base model when it loads. RECOMMENDER_ENCODE_WINDOW_MS
+(default 2) sets the window and RECOMMENDER_ENCODE_MAX_BATCH (default 64)
+the batch size; with a window of 0, only requests that queued while the
+previous batch was encoding are batched. Batch sizes and time spent queued
+are exported as the recommender_encode_batch_size and
+recommender_encode_queue_seconds histograms.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Union
+
+import numpy as np
+
+from metrics import metrics, stage
+
+DEFAULT_WINDOW_MS = 2.0
+DEFAULT_MAX_BATCH = 64
+
+metrics.describe('recommender_encode_batch_size', 'Distinct texts per batched encoder forward pass',
+                 buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+metrics.describe('recommender_encode_queue_seconds', 'Time an encode request waited for its batch to start')
+
+
+class _EncodeRequest:
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.submitted = time.perf_counter()
+        self.future: Future = Future()
+
+
+class EncodeBatcher:
+    """Wraps an encoder so concurrent encode() calls share forward passes."""
+
+    def __init__(self, model, window_ms: float = DEFAULT_WINDOW_MS, max_batch: int = DEFAULT_MAX_BATCH):
+        self.model = model
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+        self._queue: "queue.Queue[_EncodeRequest]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.texts = 0
+
+    def __getattr__(self, name):
+        # Everything but encode (e.g. get_sentence_embedding_dimension) goes to the model
+        if name == 'model':
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def encode(self, texts: Union[str, List[str]], **kwargs) -> np.ndarray:
+        """Encode texts in the next batch; returns what model.encode would."""
+        if kwargs:
+            # Calls with encoder options (batch_size, show_progress_bar, ...) bypass the queue
+            return self.model.encode(texts, **kwargs)
+        single = isinstance(texts, str)
+        items = [texts] if single else list(texts)
+        if not items:
+            return self.model.encode(texts)
+        vectors = self.submit(items).result()
+        return vectors[0] if single else vectors
+
+    def submit(self, texts: List[str]) -> Future:
+        """Queue texts for the next batch without waiting; the Future resolves to one row per text."""
+        request = _EncodeRequest(list(texts))
+        self._ensure_thread()
+        self._queue.put(request)
+        return request.future
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='encode-batcher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0].texts)
+            deadline = time.perf_counter() + self.window
+            while count < self.max_batch:
+                try:
+                    remaining = deadline - time.perf_counter()
+                    request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request.texts)
+            self._encode(batch)
+
+    def _encode(self, batch: List[_EncodeRequest]):
+        started = time.perf_counter()
+        for request in batch:
+            metrics.observe('recommender_encode_queue_seconds', started - request.submitted)
+        # Callers often share onboarding phrases; each distinct text is encoded once
+        unique = list(dict.fromkeys(text for request in batch for text in request.texts))
+        metrics.observe('recommender_encode_batch_size', len(unique))
+        try:
+            with stage('encode_batch'):
+                encoded = np.asarray(self.model.encode(unique), dtype=np.float32).reshape(len(unique), -1)
+        except Exception as e:
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        rows = {text: row for row, text in enumerate(unique)}
+        for request in batch:
+            request.future.set_result(encoded[[rows[text] for text in request.texts]])
+        self.batches += 1
+        self.requests += len(batch)
+        self.texts += len(unique)
+
+    def stats(self):
+        return {'batches': self.batches, 'requests': self.requests, 'texts': self.texts,
+                'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else 0.0,
+                'window_ms': self.window * 1000.0, 'max_batch': self.max_batch}
+
+
+def batching_encoder(model):
+    """Wrap the model in an EncodeBatcher configured from the environment."""
+    return EncodeBatcher(model,
+                         window_ms=float(os.getenv('RECOMMENDER_ENCODE_WINDOW_MS', DEFAULT_WINDOW_MS)),
+                         max_batch=int(os.getenv('RECOMMENDER_ENCODE_MAX_BATCH', DEFAULT_MAX_BATCH)))
@@ -2,59 +2,65 @@
 """
 generate_embeddings.py
 
-This script fetches all products from the Supabase database and generates embeddings
-for each product using the Sentence Transformer model. The embeddings are then saved
-as numpy files in the models directory.
+This script streams all products from the local catalog snapshot (or from the
+Supabase database when there is none) in pages and generates
+embeddings for each product using the Sentence Transformer model. The embeddings are
+appended to the memory-mapped product vector store in the models directory as each
+page is encoded, so memory use does not grow with the catalog.
+
+Only products whose text changed since the last run are re-encoded; pass
+--full to re-encode everything.
 """
 
+import argparse
 import os
 import sys
-import numpy as np
 from sentence_transformers import SentenceTransformer
 from supabase import create_client
 from dotenv import load_dotenv
 
+from ann_index import refresh_ivf_index
+from attribute_index import build_attribute_index
+from catalog_snapshot import catalog_snapshot
+from embedding_builder import DEFAULT_PAGE_SIZE, build_vector_store, iter_product_pages, paged_records
+from neighbour_graph import build_neighbour_graph
+from vector_store import STORE_PATH, load_product_vectors
+
 # Load environment variables
 load_dotenv()
 
 def main():
+    parser = argparse.ArgumentParser(description='Generate product embeddings from Supabase')
+    parser.add_argument('--full', action='store_true', help='Re-encode every product instead of only changed ones')
+    parser.add_argument('--page_size', type=int, default=DEFAULT_PAGE_SIZE, help='Products fetched and encoded per page')
+    parser.add_argument('--remote', action='store_true', help='Read products from Supabase even if there is a catalog snapshot')
+    args = parser.parse_args()
+
     print("Generating product embeddings...")
     
+    snapshot = None if args.remote else catalog_snapshot()
+
     # Get Supabase credentials
     supabase_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
     supabase_key = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
     
-    if not supabase_url or not supabase_key:
+    if snapshot is None and (not supabase_url or not supabase_key):
         print("Error: Supabase credentials not found in environment variables.")
         print("Make sure NEXT_PUBLIC_SUPABASE_URL and NEXT_PUBLIC_SUPABASE_ANON_KEY are set.")
         sys.exit(1)
     
     try:
-        # Connect to Supabase
-        print("Connecting to Supabase...")
-        supabase = create_client(supabase_url, supabase_key)
-        
-        # Fetch all products
-        print("Fetching products from database...")
-        response = supabase.table('products').select('*').execute()
-        products = response.data
-        
-        if not products:
-            print("No products found in the database.")
-            sys.exit(1)
-        
-        print(f"Found {len(products)} products.")
+        if snapshot is None:
+            # Connect to Supabase
+            print("Connecting to Supabase...")
+            supabase = create_client(supabase_url, supabase_key)
         
         # Initialize the model
         print("Loading Sentence Transformer model...")
         model = SentenceTransformer('all-MiniLM-L6-v2')
         
-        # Prepare product texts for embedding
-        product_ids = []
-        product_texts = []
-        
-        for product in products:
-            product_id = product.get('id')
+        def to_record(product):
+            product_id = product.get('product_id') or product.get('id')
             name = product.get('name', '')
             description = product.get('description', '')
             category = product.get('category', '')
@@ -62,22 +68,37 @@ def main():
             
             # Create a rich text representation of the product
             product_text = f"{name}. {description} Category: {category}. Material: {material}"
-            
-            product_ids.append(product_id)
-            product_texts.append(product_text)
+            return str(product_id), product_text
         
-        # Generate embeddings for all products
-        print("Generating embeddings for all products...")
-        product_embeddings = model.encode(product_texts)
+        # Stream products page by page; each page is encoded while the next one is fetched
+        print("Fetching products and generating embeddings for new and changed products...")
+        if snapshot is not None:
+            print(f"Reading {len(snapshot)} products from the catalog snapshot...")
+            pages = snapshot.iter_pages('*', page_size=args.page_size)
+        else:
+            pages = iter_product_pages(supabase, '*', page_size=args.page_size)
+        stats = build_vector_store(paged_records(pages, to_record), model, 'all-MiniLM-L6-v2',
+                                   STORE_PATH, incremental=not args.full)
         
-        # Save embeddings and IDs
-        print("Saving embeddings to models/product_embeddings.npy...")
-        os.makedirs('models', exist_ok=True)
-        np.save('models/product_embeddings.npy', product_embeddings)
-        np.save('models/product_ids.npy', np.array(product_ids))
+        if not stats['total']:
+            print("No products found in the database.")
+            sys.exit(1)
         
         print("Successfully generated and saved product embeddings!")
-        print(f"Saved embeddings for {len(product_ids)} products.")
+        print(f"Saved embeddings for {stats['total']} products ({stats['encoded']} encoded).")
+
+        # Index material, category, tag, colour and price against the new store's rows
+        if snapshot is not None:
+            pages = snapshot.iter_pages(page_size=args.page_size)
+        else:
+            pages = iter_product_pages(supabase, page_size=args.page_size)
+        build_attribute_index(load_product_vectors(STORE_PATH)[0], pages)
+
+        # Update the "more like this" neighbour lists for new, changed and removed products
+        build_neighbour_graph(STORE_PATH, incremental=not args.full)
+
+        # An IVF index built for the old rows would mislead search; rebuild it if there is one
+        refresh_ivf_index(STORE_PATH)
         
     except Exception as e:
         print(f"Error generating embeddings: {str(e)}")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+materialized.py
+
+Precomputed per-user style recommendation lists.
+
+A user's recommendations only change when their inputs do: their adapter or
+model (retrained after swipes), their online preference vector (updated on
+every swipe), their profile styles and materials, or the product catalog. Each stored list is keyed by user ID and tagged with a
+fingerprint of those inputs, so serving a user is one primary-key lookup in
+a local SQLite file, and a list is recomputed only when its fingerprint no
+longer matches (or it is older than the TTL).
+
+Refresh every user's list in bulk, e.g. from a nightly cron job:
+
+    python recommender/materialized.py refresh --limit 20
+
+Users are read from the profiles table, or from a JSONL file with --users.
+RECOMMENDER_MATERIALIZED_DB sets the database file (empty to disable) and
+RECOMMENDER_MATERIALIZED_TTL the maximum age of a list in seconds.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from model_registry import artefact_version
+from preference_vectors import preference_version
+from vector_store import MODELS_DIR
+
+DEFAULT_DB_PATH = os.path.join(MODELS_DIR, 'recommendations.sqlite')
+DEFAULT_LIMIT = 20
+
+
+def user_fingerprint(user_id: str, user_preferences: List[str], user_materials: List[str],
+                     catalog: str) -> str:
+    """Digest of everything a user's recommendation list depends on."""
+    payload = json.dumps([user_id, artefact_version(user_id) or '', preference_version(user_id),
+                          sorted(user_preferences or []), sorted(user_materials or []), catalog])
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class RecommendationStore:
+    """SQLite table of each user's latest top-N list and the fingerprint it was computed for."""
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, ttl_seconds: float = 86400.0):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_recommendations (
+                                user_id TEXT PRIMARY KEY,
+                                fingerprint TEXT NOT NULL,
+                                list_limit INTEGER NOT NULL,
+                                recommendations TEXT NOT NULL,
+                                computed_at REAL NOT NULL)''')
+            self._conn = conn
+        return self._conn
+
+    def get(self, user_id: str, fingerprint: str, limit: int) -> Optional[List[Dict[str, Any]]]:
+        """Return the user's stored list if it is current and long enough, else None."""
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT fingerprint, list_limit, recommendations, computed_at '
+                'FROM user_recommendations WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            stored_fingerprint, list_limit, recommendations, computed_at = row
+            if (stored_fingerprint != fingerprint or list_limit < limit
+                    or time.time() - computed_at > self.ttl_seconds):
+                self.stale += 1
+                return None
+            self.hits += 1
+        return json.loads(recommendations)[:limit]
+
+    def put(self, user_id: str, fingerprint: str, limit: int, recommendations: List[Dict[str, Any]]):
+        self.put_many([(user_id, fingerprint, limit, recommendations)])
+
+    def put_many(self, entries: Iterable[Tuple[str, str, int, List[Dict[str, Any]]]]) -> int:
+        """Store (user_id, fingerprint, limit, recommendations) entries in one transaction."""
+        now = time.time()
+        rows = [(user_id, fingerprint, limit, json.dumps(recommendations), now)
+                for user_id, fingerprint, limit, recommendations in entries]
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO user_recommendations VALUES (?, ?, ?, ?, ?)', rows)
+        return len(rows)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            conn = self._connection()
+            with conn:
+                conn.execute('DELETE FROM user_recommendations WHERE user_id = ?', (user_id,))
+
+    def stats(self) -> Dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'stale': self.stale}
+
+
+_db_path = os.getenv('RECOMMENDER_MATERIALIZED_DB', DEFAULT_DB_PATH)
+recommendation_store = RecommendationStore(
+    _db_path,
+    ttl_seconds=float(os.getenv('RECOMMENDER_MATERIALIZED_TTL', '86400')),
+) if _db_path else None
+
+
+def _string_list(value: Any) -> List[str]:
+    """Profile styles/materials are stored either as JSON strings or arrays."""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return []
+    if isinstance(value, list):
+        return [v for v in value if isinstance(v, str)]
+    return []
+
+
+def iter_profile_users(supabase, page_size: int = 1000) -> Iterator[Dict[str, Any]]:
+    """Yield {user_id, user_preferences, user_materials} for every profile."""
+    from embedding_builder import iter_table_pages
+    for page in iter_table_pages(supabase, 'profiles', 'user_id', 'user_id,styles,materials', page_size):
+        for profile in page:
+            yield {"user_id": profile['user_id'],
+                   "user_preferences": _string_list(profile.get('styles')),
+                   "user_materials": _string_list(profile.get('materials'))}
+
+
+def refresh(recommender, users: Iterable[Dict[str, Any]], store: RecommendationStore,
+            limit: int = DEFAULT_LIMIT, force: bool = False, block_size: int = 1024) -> Dict[str, int]:
+    """Recompute and store the lists of users whose fingerprint changed (or all, with force)."""
+    from batch_recommender import recommend_batch
+
+    stats = {'users': 0, 'refreshed': 0, 'current': 0}
+    # recommend_batch yields results in input order, so fingerprints are consumed FIFO
+    pending: "deque[str]" = deque()
+
+    def stale_users() -> Iterator[Dict[str, Any]]:
+        for user in users:
+            if not user.get('user_id'):
+                continue
+            stats['users'] += 1
+            fingerprint = user_fingerprint(user['user_id'], user.get('user_preferences') or [],
+                                           user.get('user_materials') or [], recommender.catalog_version)
+            if not force and store.get(user['user_id'], fingerprint, limit) is not None:
+                stats['current'] += 1
+                continue
+            pending.append(fingerprint)
+            yield user
+
+    batch = []
+    for result in recommend_batch(recommender, stale_users(), top_k=limit, block_size=block_size):
+        fingerprint = pending.popleft()
+        if result.get('error'):
+            continue
+        batch.append((result['user_id'], fingerprint, limit, result['recommendations']))
+        if len(batch) >= block_size:
+            stats['refreshed'] += store.put_many(batch)
+            batch = []
+    stats['refreshed'] += store.put_many(batch)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage materialised per-user recommendation lists')
+    parser.add_argument('command', choices=['refresh', 'invalidate'],
+                        help='refresh: recompute stale lists; invalidate: drop one user\'s list')
+    parser.add_argument('--users', type=str, help='JSONL file of users instead of the profiles table')
+    parser.add_argument('--user_id', type=str, help='User to invalidate')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help='Recommendations stored per user')
+    parser.add_argument('--force', action='store_true', help='Recompute every list, even current ones')
+    args = parser.parse_args()
+
+    if recommendation_store is None:
+        print("RECOMMENDER_MATERIALIZED_DB is empty; nothing to do", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'invalidate':
+        if not args.user_id:
+            parser.error('invalidate needs --user_id')
+        recommendation_store.invalidate(args.user_id)
+        return
+
+    from embedding_cache import query_cache
+    from product_cache import get_supabase_client
+    from style_recommender import StyleRecommender
+
+    start = time.time()
+    recommender = StyleRecommender()
+    if args.users:
+        with open(args.users) as f:
+            users = [json.loads(line) for line in f if line.strip()]
+    else:
+        client = get_supabase_client()
+        if client is None:
+            sys.exit(1)
+        users = iter_profile_users(client)
+
+    stats = refresh(recommender, users, recommendation_store, limit=args.limit, force=args.force)
+    query_cache.save()
+    print(f"Refreshed {stats['refreshed']} of {stats['users']} users "
+          f"({stats['current']} already current) in {time.time() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+metrics.py
+
+In-process counters and latency histograms for the recommender's hot paths,
+rendered in the Prometheus text exposition format (the service serves them
+on GET /metrics).
+
+    with stage('encode'):
+        vectors = model.encode(texts)
+    increment('recommender_detail_cache_misses_total', len(missing))
+
+Every stage is recorded in the recommender_stage_seconds histogram, labelled
+by stage name. debug() is for verbose output: its arguments are only
+formatted when RECOMMENDER_DEBUG=1, so pass values as %-style arguments
+rather than pre-formatting them with an f-string.
+"""
+
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
+DEBUG = os.getenv('RECOMMENDER_DEBUG', '0') == '1'
+
+# Seconds; spans sub-millisecond cache hits to multi-second model loads
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def debug(message: str, *args):
+    """Print a debug line to stderr, formatting it only when debugging is enabled."""
+    if DEBUG:
+        print(message % args if args else message, file=sys.stderr)
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """Thread-safe store of counters and histograms keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._help: Dict[str, str] = {}
+        self._buckets: Dict[str, Sequence[float]] = {}
+
+    def describe(self, name: str, help_text: str, buckets: Optional[Sequence[float]] = None):
+        """Set a metric's help text and, for histograms not measured in seconds, its buckets."""
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def increment(self, name: str, value: float = 1.0, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self._buckets.get(name, DEFAULT_BUCKETS))
+            histogram.observe(value)
+
+    def render(self, gauges: Iterable[Tuple[str, Dict[str, str], float]] = ()) -> str:
+        """All metrics in the Prometheus text exposition format.
+
+        gauges are point-in-time (name, labels, value) readings the caller
+        collects at scrape time, such as cache sizes.
+        """
+        lines = []
+        gauge_series: Dict[str, Dict[Labels, float]] = {}
+        for name, labels, value in gauges:
+            gauge_series.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+        for name, series in sorted(gauge_series.items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(series.items()):
+                lines.append(f"{_series_name(name, labels)} {_format_value(value)}")
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{_series_name(name, labels)} {_format_value(value)}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{_series_name(name + '_bucket', labels + (('le', _format_value(bound)),))} "
+                                     f"{cumulative}")
+                    lines.append(f"{_series_name(name + '_bucket', labels + (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{_series_name(name + '_sum', labels)} {_format_value(histogram.sum)}")
+                    lines.append(f"{_series_name(name + '_count', labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _series_name(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+    escaped = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                       for key, value in labels)
+    return f"{name}{{{escaped}}}"
+
+
+metrics = MetricsRegistry()
+metrics.describe('recommender_stage_seconds', 'Time spent in each recommender stage')
+metrics.describe('recommender_request_seconds', 'Service request latency by endpoint')
+
+
+def increment(name: str, value: float = 1.0, **labels):
+    metrics.increment(name, value, **labels)
+
+
+@contextmanager
+def stage(name: str, **labels) -> Iterator[None]:
+    """Time the enclosed block into recommender_stage_seconds{stage=name}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('recommender_stage_seconds', time.perf_counter() - start, stage=name, **labels)
+
@@ -0,0 +1,195 @@
+"""
+model_registry.py
+
+On-demand, memory-bounded registry of loaded user models.
+
+StyleRecommender used to read a user's personalisation from disk every time
+it was constructed, and nothing limited how many users' models a long-lived
+process could end up holding. The registry loads a user's artefact on first
+use and keeps it resident in LRU order until the total estimated size of the
+resident entries exceeds the memory budget, at which point the least
+recently used entries are evicted.
+
+Adapters are a few kilobytes and run on the shared base encoder, which is
+never loaded or counted here. Legacy full per-user models (a
+models/<user_id>_model directory) are sized by their parameter tensors. An
+entry is reloaded when its file on disk changes, so retraining a user takes
+effect on their next request.
+
+RECOMMENDER_MODEL_BUDGET_MB sets the budget of the shared registry.
+"""
+
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+from user_adapters import MODELS_DIR, UserAdapter, adapter_path, load_adapter
+
+
+class UserModel:
+    """Everything loaded for one user, and its estimated resident size."""
+
+    def __init__(self, user_id: str, version: str, adapter: Optional[UserAdapter] = None,
+                 model=None, model_key: Optional[str] = None,
+                 user_embeddings: Optional[np.ndarray] = None, user_texts: Optional[np.ndarray] = None):
+        self.user_id = user_id
+        self.version = version
+        self.adapter = adapter
+        self.model = model
+        self.model_key = model_key
+        self.user_embeddings = user_embeddings
+        self.user_texts = user_texts
+        self.nbytes = self._estimate_nbytes()
+
+    def _estimate_nbytes(self) -> int:
+        if self.adapter is not None:
+            # user_embeddings is a view of the adapter's own vector
+            return self.adapter.nbytes
+        total = 0
+        if self.model is not None:
+            try:
+                total += sum(p.numel() * p.element_size() for p in self.model.parameters())
+            except Exception:
+                pass
+        for array in (self.user_embeddings, self.user_texts):
+            if array is not None:
+                total += array.nbytes
+        return total
+
+
+def legacy_model_dir(user_id: str) -> str:
+    return os.path.join(MODELS_DIR, f"{user_id}_model")
+
+
+def artefact_version(user_id: str) -> Optional[str]:
+    """Identify the user's current artefact on disk, or None if they have none."""
+    for path in (adapter_path(user_id), legacy_model_dir(user_id)):
+        try:
+            return f"{path}@{os.path.getmtime(path)}"
+        except OSError:
+            continue
+    return None
+
+
+def _load_user_model(user_id: str, version: str) -> UserModel:
+    adapter = load_adapter(user_id)
+    if adapter is not None:
+        print(f"[REGISTRY] Loaded {adapter.nbytes} byte adapter for user {user_id}", file=sys.stderr)
+        return UserModel(user_id, version, adapter=adapter,
+                         user_embeddings=adapter.user_embedding[np.newaxis, :])
+
+    user_model_dir = legacy_model_dir(user_id)
+    print(f"[REGISTRY] Loading user model from: {user_model_dir}", file=sys.stderr)
+    model = None
+    try:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(user_model_dir)
+        print(f"[REGISTRY] Successfully loaded user model from {user_model_dir}", file=sys.stderr)
+    except Exception as e:
+        print(f"[REGISTRY] Error loading model from {user_model_dir}: {str(e)}", file=sys.stderr)
+        print(f"[REGISTRY] Falling back to default model", file=sys.stderr)
+
+    user_embeddings = user_texts = None
+    user_embeddings_path = os.path.join(user_model_dir, "embeddings.npy")
+    if os.path.exists(user_embeddings_path):
+        try:
+            user_embeddings = np.load(user_embeddings_path)
+            user_texts = np.load(os.path.join(user_model_dir, "texts.npy"))
+            print(f"[REGISTRY] Loaded {len(user_embeddings)} user embeddings", file=sys.stderr)
+        except Exception as e:
+            print(f"[REGISTRY] Error loading user embeddings: {str(e)}", file=sys.stderr)
+            user_embeddings = user_texts = None
+
+    # Retraining rewrites the directory, so the version distinguishes model versions
+    return UserModel(user_id, version, model=model, model_key=version if model is not None else None,
+                     user_embeddings=user_embeddings, user_texts=user_texts)
+
+
+class ModelRegistry:
+    """Thread-safe LRU of loaded user models under a memory budget in bytes."""
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, UserModel]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._loading: Dict[str, threading.Lock] = {}
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: str) -> Optional[UserModel]:
+        """Return the user's loaded model, loading it on a miss; None if they have none."""
+        version = artefact_version(user_id)
+        if version is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry.version == version:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry
+            load_lock = self._loading.setdefault(user_id, threading.Lock())
+
+        # One load per user at a time; concurrent requests for the same user wait for it
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(user_id)
+                if entry is not None and entry.version == version:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+            entry = _load_user_model(user_id, version)
+            with self._lock:
+                self._remove(user_id)
+                self._entries[user_id] = entry
+                self.resident_bytes += entry.nbytes
+                self._evict()
+                self._loading.pop(user_id, None)
+        return entry
+
+    def _remove(self, user_id: str):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self.resident_bytes -= entry.nbytes
+
+    def _evict(self):
+        # The entry just loaded stays resident even if it alone exceeds the budget
+        while self.resident_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.resident_bytes -= entry.nbytes
+            self.evictions += 1
+
+    def invalidate(self, user_id: str):
+        """Drop a user's entry, e.g. after retraining them in this process."""
+        with self._lock:
+            self._remove(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.resident_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'resident_bytes': self.resident_bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+model_registry = ModelRegistry(
+    max_bytes=int(float(os.getenv('RECOMMENDER_MODEL_BUDGET_MB', '512')) * 1024 * 1024),
+)
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+neighbour_graph.py
+
+Precomputed "more like this": every product's nearest neighbours.
+
+A product page asks for products similar to the one on it. Searching the
+index with the product's own embedding scores the catalog on every view,
+although the answer only changes when the catalog does. This graph stores
+each product's `k` nearest neighbours (by cosine over the vector store
+embeddings, excluding itself) as two fixed-width arrays aligned with the
+vector store rows:
+
+    neighbours  count x k int32 rows of the neighbours, best first
+    scores      count x k float16 cosine similarities
+
+so a lookup is one row slice. At k=20 the lists take 120 bytes per product.
+
+Builds are incremental. The graph keeps the content hash of each product's
+vector. A product that is new or whose text changed gets a fresh list from a
+full scan, as does any product whose list contained a changed or removed
+product. Every other product keeps its list, merged with its scores against
+the new and changed products only. The result is the same as a full build.
+
+The embedding scripts rebuild the graph after each store build; on its own:
+
+    python recommender/neighbour_graph.py build --k 20
+    python recommender/neighbour_graph.py similar <product_id>
+
+StyleRecommender.similar serves it, falling back to an index search when
+the graph is missing, stale or shorter than the request.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from ann_index import top_k_rows
+from attribute_index import ids_digest
+from metrics import stage
+from vector_store import MODELS_DIR, STORE_PATH, VectorStore
+
+NEIGHBOUR_GRAPH_PATH = os.path.join(MODELS_DIR, 'product_neighbours.npz')
+DEFAULT_K = 20
+
+# Scores held at once while scanning, so a block of rows against the whole
+# catalog stays around 128 MB of float32
+_SCAN_ELEMENTS = 1 << 25
+
+
+def _scan(vectors: np.ndarray, rows: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Exact k nearest neighbours of the given rows against every row, excluding themselves."""
+    neighbours = np.empty((len(rows), k), dtype=np.int32)
+    scores = np.empty((len(rows), k), dtype=np.float32)
+    block = max(1, _SCAN_ELEMENTS // len(vectors))
+    for start in range(0, len(rows), block):
+        chunk = rows[start:start + block]
+        block_scores = vectors[chunk] @ vectors.T
+        block_scores[np.arange(len(chunk)), chunk] = -np.inf
+        best = top_k_rows(block_scores, k)
+        neighbours[start:start + len(chunk)] = best
+        scores[start:start + len(chunk)] = np.take_along_axis(block_scores, best, axis=1)
+    return neighbours, scores
+
+
+class NeighbourGraph:
+    """Fixed-width k-nearest-neighbour lists over the vector store rows."""
+
+    def __init__(self, neighbours: np.ndarray, scores: np.ndarray, digest: str,
+                 hashes: Optional[np.ndarray] = None, ids: Optional[np.ndarray] = None):
+        self.neighbours = neighbours
+        self.scores = scores
+        self.digest = digest
+        self.hashes = hashes
+        self.ids = ids
+
+    def __len__(self):
+        return len(self.neighbours)
+
+    @property
+    def k(self) -> int:
+        return self.neighbours.shape[1]
+
+    def lookup(self, row: int, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """(rows, scores) of a product's top_k neighbours, best first."""
+        return self.neighbours[row, :top_k], self.scores[row, :top_k].astype(np.float32)
+
+    @classmethod
+    def build(cls, ids: np.ndarray, vectors: np.ndarray, k: int = DEFAULT_K,
+              hashes: Optional[np.ndarray] = None,
+              previous: Optional['NeighbourGraph'] = None) -> Tuple['NeighbourGraph', Dict[str, int]]:
+        """Build the graph over normalised vectors, reusing previous lists where they still hold."""
+        n = len(vectors)
+        if n < 2:
+            raise ValueError("Need at least two products to build a neighbour graph")
+        k = min(k, n - 1)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        neighbours = np.empty((n, k), dtype=np.int32)
+        scores = np.empty((n, k), dtype=np.float32)
+
+        stable = np.zeros(n, dtype=bool)
+        new_to_old = np.full(n, -1, dtype=np.int64)
+        if (previous is not None and previous.k == k and hashes is not None
+                and previous.hashes is not None and previous.ids is not None):
+            old_rows = {product_id: row for row, product_id in enumerate(previous.ids.tolist())}
+            for row, (product_id, digest) in enumerate(zip(ids.tolist(), hashes.tolist())):
+                old = old_rows.get(product_id)
+                if old is not None and previous.hashes[old] == digest:
+                    new_to_old[row] = old
+            stable = new_to_old >= 0
+
+        dirty = np.flatnonzero(~stable)
+        kept = np.empty(0, dtype=np.int64)
+        if stable.any():
+            old_to_new = np.full(len(previous), -1, dtype=np.int64)
+            old_to_new[new_to_old[stable]] = np.flatnonzero(stable)
+            stable_rows = np.flatnonzero(stable)
+            remapped = old_to_new[previous.neighbours[new_to_old[stable_rows]]]
+            # A list that held a changed or removed product has lost its k-th neighbour
+            lost = (remapped < 0).any(axis=1)
+            kept = stable_rows[~lost]
+            neighbours[kept] = remapped[~lost]
+            scores[kept] = previous.scores[new_to_old[kept]]
+            dirty = np.concatenate([dirty, stable_rows[lost]])
+
+            changed = np.flatnonzero(~stable)
+            if len(changed) and len(kept):
+                # Unchanged products can only gain new or changed products as neighbours. Their
+                # current neighbours are re-scored in float32, so the merge ranks exactly as a scan
+                block = max(1, _SCAN_ELEMENTS // max(len(changed), k * vectors.shape[1]))
+                for start in range(0, len(kept), block):
+                    chunk = kept[start:start + block]
+                    current = np.einsum('id,ikd->ik', vectors[chunk], vectors[neighbours[chunk]])
+                    candidates = np.concatenate([neighbours[chunk], np.broadcast_to(changed, (len(chunk), len(changed)))],
+                                                axis=1)
+                    candidate_scores = np.concatenate([current, vectors[chunk] @ vectors[changed].T], axis=1)
+                    best = top_k_rows(candidate_scores, k)
+                    neighbours[chunk] = np.take_along_axis(candidates, best, axis=1)
+                    scores[chunk] = np.take_along_axis(candidate_scores, best, axis=1)
+
+        if len(dirty):
+            dirty = np.sort(dirty)
+            neighbours[dirty], scores[dirty] = _scan(vectors, dirty, k)
+
+        graph = cls(neighbours, scores.astype(np.float16), ids_digest(ids), hashes, ids)
+        return graph, {'products': n, 'reused': len(kept), 'scanned': len(dirty)}
+
+    def save(self, path: str = NEIGHBOUR_GRAPH_PATH):
+        arrays = {'neighbours': self.neighbours, 'scores': self.scores,
+                  'meta': np.array(json.dumps({'digest': self.digest, 'k': self.k}))}
+        if self.ids is not None:
+            arrays['ids'] = self.ids
+        if self.hashes is not None:
+            arrays['hashes'] = self.hashes
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+            np.savez(f, **arrays)
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+
+    @classmethod
+    def load(cls, path: str = NEIGHBOUR_GRAPH_PATH) -> 'NeighbourGraph':
+        data = np.load(path, allow_pickle=False)
+        meta = json.loads(str(data['meta']))
+        return cls(data['neighbours'], data['scores'], meta['digest'],
+                   data['hashes'] if 'hashes' in data else None, data['ids'] if 'ids' in data else None)
+
+
+def load_neighbour_graph(product_ids, path: str = NEIGHBOUR_GRAPH_PATH) -> Optional[NeighbourGraph]:
+    """Load the graph if it was built for exactly these vector store rows."""
+    if not os.path.exists(path):
+        return None
+    try:
+        graph = NeighbourGraph.load(path)
+    except Exception as e:
+        print(f"[INDEX] Could not load neighbour graph: {e}", file=sys.stderr)
+        return None
+    if len(graph) != len(product_ids) or graph.digest != ids_digest(product_ids):
+        print(f"[INDEX] Neighbour graph at {path} was built for other products; rebuild it", file=sys.stderr)
+        return None
+    print(f"[INDEX] Loaded neighbour graph with {graph.k} neighbours for {len(graph)} products", file=sys.stderr)
+    return graph
+
+
+def build_neighbour_graph(store_path: str = STORE_PATH, path: str = NEIGHBOUR_GRAPH_PATH, k: int = DEFAULT_K,
+                          incremental: bool = True) -> Dict[str, int]:
+    """Build the graph for the vector store and save it, reusing the existing graph if possible."""
+    start = time.time()
+    store = VectorStore.open(store_path)
+    previous = None
+    if incremental and os.path.exists(path):
+        try:
+            previous = NeighbourGraph.load(path)
+        except Exception as e:
+            print(f"Ignoring unreadable neighbour graph {path}: {e}")
+    with stage('neighbour_graph_build'):
+        graph, stats = NeighbourGraph.build(store.ids, store.vectors, k=k, hashes=store.hashes, previous=previous)
+    graph.save(path)
+    print(f"Built {graph.k}-neighbour graph for {stats['products']} products in {time.time() - start:.2f}s "
+          f"({stats['reused']} lists reused, {stats['scanned']} scanned), saved to {path}")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the product neighbour graph')
+    parser.add_argument('command', choices=['build', 'similar'],
+                        help='build: (re)build the graph for the vector store; similar: print a product\'s neighbours')
+    parser.add_argument('product_id', type=str, nargs='?', help='Product to look up (similar only)')
+    parser.add_argument('--k', type=int, default=DEFAULT_K, help='Neighbours kept per product')
+    parser.add_argument('--full', action='store_true', help='Rescan every product instead of updating the graph')
+    parser.add_argument('--path', type=str, default=NEIGHBOUR_GRAPH_PATH, help='Neighbour graph path')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build_neighbour_graph(path=args.path, k=args.k, incremental=not args.full)
+        return
+
+    if not args.product_id:
+        parser.error('similar needs a product_id')
+    store = VectorStore.open()
+    graph = load_neighbour_graph(store.ids, args.path)
+    if graph is None:
+        sys.exit(1)
+    rows = {product_id: row for row, product_id in enumerate(store.product_ids())}
+    if args.product_id not in rows:
+        print(f"Product {args.product_id} is not in the vector store", file=sys.stderr)
+        sys.exit(1)
+    neighbours, scores = graph.lookup(rows[args.product_id], args.k)
+    print(json.dumps([{'product_id': store.product_id(row), 'score': round(float(score), 4)}
+                      for row, score in zip(neighbours.tolist(), scores.tolist())], indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+onnx_encoder.py
+
+Query encoding with an exported ONNX graph instead of PyTorch.
+
+Encoding queries through SentenceTransformer('all-MiniLM-L6-v2') needs torch,
+which takes seconds to import, and on CPU the forward pass dominates the
+compute of a recommendation. ONNXEncoder runs the same transformer with
+onnxruntime and tokenises with the model's fast tokenizer (the `tokenizers`
+package, saved next to the graph), then applies the same mean pooling and
+normalisation, so neither torch nor transformers is imported at serving time.
+
+Export the graph (this step needs torch and sentence-transformers), a
+dynamically int8-quantised copy, and the tokenizer:
+
+    python recommender/onnx_encoder.py export
+
+Export validates both graphs against the PyTorch model on sample texts and
+records the lowest cosine similarity in models/onnx/<model>/encoder.json; a
+graph below --tolerance is not used. Re-check with:
+
+    python recommender/onnx_encoder.py validate --texts queries.txt
+
+RECOMMENDER_ENCODER selects the backend: "torch" (default), "onnx" or
+"onnx-int8". When the ONNX files, onnxruntime or a passing validation are
+missing, the recommender falls back to torch.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from user_adapters import BASE_MODEL, MODELS_DIR
+
+ONNX_DIR = os.path.join(MODELS_DIR, 'onnx', BASE_MODEL)
+BACKENDS = ('torch', 'onnx', 'onnx-int8')
+GRAPH_FILES = {'onnx': 'model.onnx', 'onnx-int8': 'model.int8.onnx'}
+TOKENIZER_FILE = 'tokenizer.json'
+METADATA_FILE = 'encoder.json'
+MAX_SEQ_LENGTH = 256
+# Lowest cosine similarity to the PyTorch embedding a graph may have
+DEFAULT_TOLERANCE = 0.99
+
+# Texts of the kind the recommender encodes, for validation when none are given
+SAMPLE_TEXTS = [
+    "casual summer linen shirt",
+    "elegant black evening dress",
+    "oversized wool winter coat with large buttons",
+    "high waisted straight leg jeans",
+    "minimalist white sneakers",
+    "boho floral maxi skirt",
+    "Soft breathable cotton t-shirt with a relaxed fit, perfect for everyday wear.",
+    "streetwear",
+    "vintage leather jacket",
+    "professional tailored blazer for the office",
+    "cozy knit sweater",
+    "sporty athleisure leggings with pockets",
+]
+
+
+class ONNXEncoder:
+    """Sentence embeddings from an ONNX transformer graph, mean-pooled and normalised."""
+
+    def __init__(self, model_path: str, tokenizer_path: str, max_length: int = MAX_SEQ_LENGTH,
+                 threads: Optional[int] = None):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length)
+        pad_id = self.tokenizer.token_to_id('[PAD]')
+        self.tokenizer.enable_padding(pad_id=pad_id if pad_id is not None else 0, pad_token='[PAD]')
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.model_path = model_path
+        self._dimension = None
+
+    def get_sentence_embedding_dimension(self) -> int:
+        if self._dimension is None:
+            self._dimension = int(self.encode('dimension probe').shape[-1])
+        return self._dimension
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        input_ids = np.array([encoding.ids for encoding in encodings], dtype=np.int64)
+        attention_mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        feeds = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if 'token_type_ids' in self.input_names:
+            feeds['token_type_ids'] = np.zeros_like(input_ids)
+        hidden = self.session.run(None, feeds)[0]
+        # Mean over the real (unpadded) tokens, as the model's pooling layer does
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        return (pooled / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    def encode(self, sentences: Union[str, Sequence[str]], batch_size: int = 32, **kwargs) -> np.ndarray:
+        """Same contract as SentenceTransformer.encode: one normalised row per text."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        # Batch texts of similar length together so little padding is scored
+        order = np.argsort([-len(text) for text in texts], kind='stable')
+        vectors = np.empty((len(texts), 0), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            batch = order[start:start + batch_size]
+            encoded = self._encode_batch([texts[i] for i in batch])
+            if not vectors.shape[1]:
+                vectors = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            vectors[batch] = encoded
+        return vectors[0] if single else vectors
+
+
+def _metadata(directory: str = ONNX_DIR) -> Dict[str, Any]:
+    path = os.path.join(directory, METADATA_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_metadata(metadata: Dict[str, Any], directory: str = ONNX_DIR):
+    path = os.path.join(directory, METADATA_FILE)
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(metadata, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def _torch_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(BASE_MODEL)
+
+
+def load_encoder(backend: Optional[str] = None, directory: str = ONNX_DIR) -> Tuple[Any, str]:
+    """Return (encoder, model key) for the configured backend, falling back to torch.
+
+    The model key names the backend, so cached query embeddings from one
+    backend are never served for another.
+    """
+    backend = backend or os.getenv('RECOMMENDER_ENCODER', 'torch')
+    if backend not in BACKENDS:
+        print(f"[ENCODER] Unknown encoder backend '{backend}'", file=sys.stderr)
+    elif backend != 'torch':
+        model_path = os.path.join(directory, GRAPH_FILES[backend])
+        metadata = _metadata(directory)
+        validation = metadata.get('validation', {}).get(backend)
+        if not os.path.exists(model_path):
+            print(f"[ENCODER] No {backend} graph at {model_path}; run onnx_encoder.py export", file=sys.stderr)
+        elif not validation or not validation.get('passed'):
+            print(f"[ENCODER] {backend} graph has not passed validation against PyTorch", file=sys.stderr)
+        else:
+            try:
+                encoder = ONNXEncoder(model_path, os.path.join(directory, TOKENIZER_FILE),
+                                      max_length=metadata.get('max_seq_length', MAX_SEQ_LENGTH))
+                print(f"[ENCODER] Using {backend} encoder (min cosine {validation['min_cosine']:.4f} "
+                      f"to PyTorch)", file=sys.stderr)
+                return encoder, f"{BASE_MODEL}:{backend}"
+            except Exception as e:
+                print(f"[ENCODER] Could not load {backend} encoder: {e}", file=sys.stderr)
+    print("[ENCODER] Using PyTorch encoder", file=sys.stderr)
+    return _torch_model(), BASE_MODEL
+
+
+def validate(encoder, reference, texts: Sequence[str], tolerance: float = DEFAULT_TOLERANCE) -> Dict[str, Any]:
+    """Cosine similarity of the encoder's embeddings to the reference model's, per text."""
+    actual = np.asarray(encoder.encode(list(texts)), dtype=np.float32)
+    expected = np.asarray(reference.encode(list(texts)), dtype=np.float32)
+    actual /= np.maximum(np.linalg.norm(actual, axis=1, keepdims=True), 1e-12)
+    expected /= np.maximum(np.linalg.norm(expected, axis=1, keepdims=True), 1e-12)
+    cosines = np.sum(actual * expected, axis=1)
+    return {'texts': len(texts), 'min_cosine': round(float(cosines.min()), 6),
+            'mean_cosine': round(float(cosines.mean()), 6), 'tolerance': tolerance,
+            'passed': bool(cosines.min() >= tolerance)}
+
+
+def time_encoder(encoder, texts: Sequence[str], repeats: int = 3) -> float:
+    """Milliseconds per single-text encode, as a query is encoded."""
+    encoder.encode(texts[0])
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            encoder.encode(text)
+    return (time.perf_counter() - start) * 1000 / (repeats * len(texts))
+
+
+def export(directory: str = ONNX_DIR, quantize: bool = True, opset: int = 14) -> Dict[str, str]:
+    """Export the base model's transformer to ONNX, with an int8 copy and its tokenizer."""
+    import torch
+
+    model = _torch_model()
+    transformer = model[0].auto_model.eval()
+    os.makedirs(directory, exist_ok=True)
+
+    class LastHiddenState(torch.nn.Module):
+        def __init__(self, module):
+            super().__init__()
+            self.module = module
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            return self.module(input_ids=input_ids, attention_mask=attention_mask,
+                               token_type_ids=token_type_ids).last_hidden_state
+
+    sample = model.tokenizer(['an example query for tracing'], return_tensors='pt')
+    inputs = (sample['input_ids'], sample['attention_mask'],
+              sample.get('token_type_ids', torch.zeros_like(sample['input_ids'])))
+    paths = {'onnx': os.path.join(directory, GRAPH_FILES['onnx'])}
+    axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(transformer), inputs, paths['onnx'],
+                          input_names=['input_ids', 'attention_mask', 'token_type_ids'],
+                          output_names=['last_hidden_state'],
+                          dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'token_type_ids': axes,
+                                        'last_hidden_state': axes},
+                          opset_version=opset)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        paths['onnx-int8'] = os.path.join(directory, GRAPH_FILES['onnx-int8'])
+        quantize_dynamic(paths['onnx'], paths['onnx-int8'], weight_type=QuantType.QInt8)
+    model.tokenizer.backend_tokenizer.save(os.path.join(directory, TOKENIZER_FILE))
+    _write_metadata({'base_model': BASE_MODEL, 'max_seq_length': model.max_seq_length, 'opset': opset,
+                     'exported_at': datetime.now().isoformat(), 'graphs': sorted(paths)}, directory)
+    return paths
+
+
+def validate_graphs(directory: str = ONNX_DIR, texts: Optional[Sequence[str]] = None,
+                    tolerance: float = DEFAULT_TOLERANCE, reference=None) -> Dict[str, Dict[str, Any]]:
+    """Validate every exported graph against PyTorch and record the results in encoder.json."""
+    texts = list(texts or SAMPLE_TEXTS)
+    reference = reference or _torch_model()
+    metadata = _metadata(directory)
+    max_length = metadata.get('max_seq_length', MAX_SEQ_LENGTH)
+    results = {}
+    for backend, filename in GRAPH_FILES.items():
+        path = os.path.join(directory, filename)
+        if not os.path.exists(path):
+            continue
+        encoder = ONNXEncoder(path, os.path.join(directory, TOKENIZER_FILE), max_length=max_length)
+        results[backend] = validate(encoder, reference, texts, tolerance)
+        results[backend]['ms_per_query'] = round(time_encoder(encoder, texts), 3)
+    results['torch'] = {'ms_per_query': round(time_encoder(reference, texts), 3)}
+    metadata['validation'] = {backend: result for backend, result in results.items() if backend != 'torch'}
+    metadata['validated_at'] = datetime.now().isoformat()
+    _write_metadata(metadata, directory)
+    return results
+
+
+def _read_texts(path: Optional[str]) -> Optional[List[str]]:
+    if not path:
+        return None
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export and validate the ONNX query encoder')
+    parser.add_argument('command', choices=['export', 'validate'],
+                        help='export: write the ONNX graphs and tokenizer, then validate; validate: re-check them')
+    parser.add_argument('--output', type=str, default=ONNX_DIR, help='Directory of the exported encoder')
+    parser.add_argument('--no_quantize', action='store_true', help='Skip the int8 graph')
+    parser.add_argument('--texts', type=str, help='File of texts to validate on, one per line')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Lowest acceptable cosine similarity to the PyTorch embeddings')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        start = time.time()
+        paths = export(args.output, quantize=not args.no_quantize)
+        for backend, path in paths.items():
+            print(f"Exported {backend} graph to {path} ({os.path.getsize(path) / 1e6:.1f} MB)")
+        print(f"Exported in {time.time() - start:.2f}s", file=sys.stderr)
+
+    results = validate_graphs(args.output, _read_texts(args.texts), args.tolerance)
+    for backend, result in results.items():
+        if backend == 'torch':
+            continue
+        print(f"{backend}: min cosine {result['min_cosine']:.4f}, mean {result['mean_cosine']:.4f} over "
+              f"{result['texts']} texts ({'passed' if result['passed'] else 'FAILED'}), "
+              f"{result['ms_per_query']:.2f} ms/query vs {results['torch']['ms_per_query']:.2f} ms with torch")
+    if not all(result.get('passed', True) for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
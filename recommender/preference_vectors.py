@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+"""
+preference_vectors.py
+
+Online per-user preference vectors, updated on every swipe.
+
+Adapters are retrained from a user's interactions every few swipes, so a
+like or dislike only changed recommendations after the next training run.
+Alongside the adapter, each user now has a preference vector kept in a
+local SQLite file: the decayed, signed sum of the catalog embeddings of the
+products they swiped on,
+
+    v = decay * v + weight[action] * e_product
+
+with like +1, save +1.5 and dislike -0.5, and decay set so a swipe counts
+half as much after DEFAULT_HALF_LIFE more swipes. An update reads one row
+from the vector store and touches d floats, so it is cheap enough to apply
+inline, and StyleRecommender.recommend blends the vector into the query
+(or uses it alone for users with no query or stored embeddings), so a swipe
+affects the very next recommendation.
+
+The service applies swipes on POST /interactions; from the command line:
+
+    python recommender/preference_vectors.py swipe <user_id> <product_id> like
+    python recommender/preference_vectors.py rebuild <user_id>
+
+rebuild replays the user's style_interactions rows in order. Set
+RECOMMENDER_PREFERENCE_DB to move the database (empty to disable) and
+RECOMMENDER_ONLINE_WEIGHT to change how strongly it steers queries.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from user_adapters import DISLIKE_WEIGHT
+from vector_store import MODELS_DIR
+
+DEFAULT_DB_PATH = os.path.join(MODELS_DIR, 'preference_vectors.sqlite')
+ACTION_WEIGHTS = {'like': 1.0, 'save': 1.5, 'dislike': -DISLIKE_WEIGHT}
+# Swipes after which an earlier swipe counts half as much
+DEFAULT_HALF_LIFE = 20
+DEFAULT_ONLINE_WEIGHT = 0.5
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class PreferenceVector:
+    """A user's decayed sum of swiped product embeddings."""
+
+    def __init__(self, user_id: str, vector: np.ndarray, swipes: int, updated_at: float):
+        self.user_id = user_id
+        self.vector = vector
+        self.swipes = swipes
+        self.updated_at = updated_at
+
+    @property
+    def version(self) -> str:
+        return f"{self.swipes}@{self.updated_at}"
+
+    def blend(self, query_embedding: np.ndarray, weight: float = DEFAULT_ONLINE_WEIGHT) -> np.ndarray:
+        """Steer a query towards the user's recent likes and away from their dislikes."""
+        return _normalize(_normalize(np.asarray(query_embedding, dtype=np.float32))
+                          + weight * _normalize(self.vector))
+
+
+class PreferenceStore:
+    """SQLite table of each user's preference vector, updated in place per swipe."""
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, half_life: float = DEFAULT_HALF_LIFE):
+        self.path = path
+        self.decay = 0.5 ** (1.0 / half_life)
+        self._lock = threading.Lock()
+        self._conn = None
+        self.updates = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            # Autocommit, so an update can hold a write lock across its read and write
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS user_preference_vectors (
+                                user_id TEXT PRIMARY KEY,
+                                vector BLOB NOT NULL,
+                                swipes INTEGER NOT NULL,
+                                updated_at REAL NOT NULL)''')
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _from_row(row) -> PreferenceVector:
+        user_id, vector, swipes, updated_at = row
+        return PreferenceVector(user_id, np.frombuffer(vector, dtype=np.float32), swipes, updated_at)
+
+    def get(self, user_id: str) -> Optional[PreferenceVector]:
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT user_id, vector, swipes, updated_at FROM user_preference_vectors WHERE user_id = ?',
+                (user_id,)).fetchone()
+        return self._from_row(row) if row is not None else None
+
+    def get_many(self, user_ids: Iterable[str]) -> Dict[str, PreferenceVector]:
+        user_ids = list(dict.fromkeys(user_ids))
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            # Stay under SQLite's bound-parameter limit
+            for start in range(0, len(user_ids), 500):
+                chunk = user_ids[start:start + 500]
+                rows = conn.execute(
+                    'SELECT user_id, vector, swipes, updated_at FROM user_preference_vectors '
+                    f'WHERE user_id IN ({",".join("?" * len(chunk))})', chunk).fetchall()
+                for row in rows:
+                    found[row[0]] = self._from_row(row)
+        return found
+
+    def update(self, user_id: str, action: str, embedding: np.ndarray) -> PreferenceVector:
+        """Decay the user's vector and add one swiped product's embedding."""
+        return self.update_many(user_id, [(action, embedding)])
+
+    def update_many(self, user_id: str, swipes: Iterable[Tuple[str, np.ndarray]],
+                    reset: bool = False) -> PreferenceVector:
+        """Apply swipes in order in one transaction; reset starts from an empty vector."""
+        swipes = list(swipes)
+        for action, _ in swipes:
+            if action not in ACTION_WEIGHTS:
+                raise ValueError(f"Unknown interaction type: {action}")
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = None if reset else conn.execute(
+                    'SELECT user_id, vector, swipes, updated_at FROM user_preference_vectors WHERE user_id = ?',
+                    (user_id,)).fetchone()
+                vector, count = None, 0
+                if row is not None:
+                    current = self._from_row(row)
+                    vector, count = current.vector.copy(), current.swipes
+                for action, embedding in swipes:
+                    embedding = np.asarray(embedding, dtype=np.float32)
+                    if vector is None or vector.shape != embedding.shape:
+                        vector = np.zeros_like(embedding)
+                    vector *= self.decay
+                    vector += ACTION_WEIGHTS[action] * embedding
+                    count += 1
+                if vector is None:
+                    raise ValueError("No swipes to apply")
+                now = time.time()
+                conn.execute('INSERT OR REPLACE INTO user_preference_vectors VALUES (?, ?, ?, ?)',
+                             (user_id, vector.astype(np.float32).tobytes(), count, now))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            self.updates += len(swipes)
+        return PreferenceVector(user_id, vector, count, now)
+
+    def reset(self, user_id: str):
+        with self._lock:
+            self._connection().execute('DELETE FROM user_preference_vectors WHERE user_id = ?', (user_id,))
+
+    def stats(self) -> Dict[str, int]:
+        return {'updates': self.updates}
+
+
+_db_path = os.getenv('RECOMMENDER_PREFERENCE_DB', DEFAULT_DB_PATH)
+preference_store = PreferenceStore(_db_path) if _db_path else None
+ONLINE_WEIGHT = float(os.getenv('RECOMMENDER_ONLINE_WEIGHT', str(DEFAULT_ONLINE_WEIGHT)))
+
+
+def preference_version(user_id: str) -> str:
+    """Identify the user's current preference vector; empty if they have none."""
+    if preference_store is None or not user_id:
+        return ''
+    try:
+        preference = preference_store.get(user_id)
+    except sqlite3.Error as e:
+        print(f"[PREFERENCE] Could not read preference vector: {e}", file=sys.stderr)
+        return ''
+    return preference.version if preference is not None else ''
+
+
+def _product_embeddings(product_ids: List[str]) -> Dict[str, np.ndarray]:
+    """Normalised catalog embeddings of the given products, from the vector store."""
+    from vector_store import load_product_vectors
+    store_ids, embeddings, normalized = load_product_vectors()
+    wanted = set(product_ids)
+    found = {}
+    for row, product_id in enumerate(store_ids):
+        product_id = product_id.decode('ascii') if isinstance(product_id, bytes) else str(product_id)
+        if product_id in wanted:
+            vector = np.asarray(embeddings[row], dtype=np.float32)
+            found[product_id] = vector if normalized else _normalize(vector)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage online user preference vectors')
+    parser.add_argument('command', choices=['swipe', 'rebuild', 'reset', 'show'],
+                        help='swipe: apply one interaction; rebuild: replay the user\'s interactions; '
+                             'reset: drop the user\'s vector; show: print it')
+    parser.add_argument('user_id', type=str, help='User ID')
+    parser.add_argument('product_id', type=str, nargs='?', help='Swiped product (swipe only)')
+    parser.add_argument('action', type=str, nargs='?', choices=sorted(ACTION_WEIGHTS),
+                        help='Interaction type (swipe only)')
+    args = parser.parse_args()
+
+    if preference_store is None:
+        print("RECOMMENDER_PREFERENCE_DB is empty; nothing to do", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'reset':
+        preference_store.reset(args.user_id)
+        return
+    if args.command == 'show':
+        preference = preference_store.get(args.user_id)
+        print(json.dumps(None if preference is None else
+                         {'user_id': preference.user_id, 'swipes': preference.swipes,
+                          'updated_at': preference.updated_at, 'norm': float(np.linalg.norm(preference.vector))}))
+        return
+
+    if args.command == 'swipe':
+        if not args.product_id or not args.action:
+            parser.error('swipe needs a product_id and an action')
+        interactions = [{'product_id': args.product_id, 'action': args.action}]
+    else:
+        from product_cache import get_supabase_client
+        client = get_supabase_client()
+        if client is None:
+            sys.exit(1)
+        interactions = (client.table('style_interactions').select('product_id,action')
+                        .eq('user_id', args.user_id).order('timestamp').execute().data or [])
+
+    embeddings = _product_embeddings([i['product_id'] for i in interactions])
+    swipes = [(i['action'], embeddings[i['product_id']]) for i in interactions
+              if i['product_id'] in embeddings and i['action'] in ACTION_WEIGHTS]
+    skipped = len(interactions) - len(swipes)
+    if skipped:
+        print(f"[PREFERENCE] Skipped {skipped} interactions with products not in the vector store", file=sys.stderr)
+    if not swipes:
+        print("[PREFERENCE] Nothing to apply", file=sys.stderr)
+        sys.exit(1)
+    preference = preference_store.update_many(args.user_id, swipes, reset=args.command == 'rebuild')
+    print(f"Applied {len(swipes)} swipes for {args.user_id} ({preference.swipes} in total)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+product_cache.py
+
+Local cache of the product fields returned with recommendations, and the
+shared Supabase client used to fill it.
+
+StyleRecommender.recommend used to create a new Supabase client and query
+the products table for every call. Details are now served from an in-process
+LRU cache with a TTL. Products missing from it are read from the local
+catalog snapshot when there is one, and only the rest are fetched from
+Supabase (in one query, on one shared client). The cache can be warmed in
+bulk from the snapshot or by paging through the products table.
+
+RECOMMENDER_DETAIL_CACHE_SIZE and RECOMMENDER_DETAIL_CACHE_TTL (seconds)
+configure the shared cache.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+try:
+    from supabase import create_client, Client
+except ImportError:
+    print("Please install supabase-py: pip install supabase", file=sys.stderr)
+    sys.exit(1)
+
+from catalog_snapshot import catalog_snapshot
+from embedding_builder import iter_product_pages
+
+# Fields returned with each recommendation; nothing else is cached
+DETAIL_FIELDS = ('product_id', 'name', 'description', 'category', 'image_url', 'price', 'material')
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_supabase_client() -> Optional[Client]:
+    """Return the process-wide Supabase client, or None if credentials are not set."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
+                key = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
+                if not url or not key:
+                    print("[CACHE] Supabase environment variables not set", file=sys.stderr)
+                    return None
+                _client = create_client(url, key)
+    return _client
+
+
+def set_supabase_client(client):
+    """Use this client for every lookup instead of one created from the environment."""
+    global _client
+    with _client_lock:
+        _client = client
+
+
+class ProductDetailCache:
+    """Thread-safe LRU cache of product details with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 600.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, product_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Return the cached, unexpired details for the given IDs."""
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for product_id in product_ids:
+                entry = self._entries.get(product_id)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                expires_at, details = entry
+                if expires_at < now:
+                    del self._entries[product_id]
+                    self.misses += 1
+                    continue
+                self._entries.move_to_end(product_id)
+                found[product_id] = details
+                self.hits += 1
+        return found
+
+    def put_many(self, products: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """Cache the detail fields of each product and return them by ID."""
+        expires_at = time.monotonic() + self.ttl_seconds
+        stored = {}
+        with self._lock:
+            for product in products:
+                product_id = str(product['product_id'])
+                details = {field: product.get(field) for field in DETAIL_FIELDS}
+                details['product_id'] = product_id
+                self._entries[product_id] = (expires_at, details)
+                self._entries.move_to_end(product_id)
+                stored[product_id] = details
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return stored
+
+    def fetch(self, product_ids: List[str], client: Optional[Client] = None) -> Dict[str, Dict[str, Any]]:
+        """Return details for the IDs, reading cache misses from the snapshot, then Supabase."""
+        found = self.get_many(product_ids)
+        missing = [product_id for product_id in product_ids if product_id not in found]
+        snapshot = catalog_snapshot() if missing else None
+        if snapshot is not None:
+            found.update(self.put_many(snapshot.get_many(missing, ','.join(DETAIL_FIELDS)).values()))
+            missing = [product_id for product_id in missing if product_id not in found]
+        if missing and client is not None:
+            response = client.table('products').select(','.join(DETAIL_FIELDS)).in_('product_id', missing).execute()
+            found.update(self.put_many(response.data or []))
+        return found
+
+    def warm(self, products: Iterable[Dict[str, Any]]) -> int:
+        """Bulk-load details, e.g. from a catalog snapshot. Returns the number loaded."""
+        count = 0
+        batch = []
+        for product in products:
+            batch.append(product)
+            if len(batch) >= 1000:
+                self.put_many(batch)
+                count += len(batch)
+                batch = []
+        self.put_many(batch)
+        return count + len(batch)
+
+    def warm_from_supabase(self, client: Client, page_size: int = 1000) -> int:
+        """Page through the products table and cache every product's details."""
+        count = 0
+        for page in iter_product_pages(client, ','.join(DETAIL_FIELDS), page_size=page_size):
+            count += self.warm(page)
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+product_cache = ProductDetailCache(
+    max_entries=int(os.getenv('RECOMMENDER_DETAIL_CACHE_SIZE', '10000')),
+    ttl_seconds=float(os.getenv('RECOMMENDER_DETAIL_CACHE_TTL', '600')),
+)
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+"""
+quantized_index.py
+
+Two-stage search over a compressed copy of the product embeddings.
+
+Exact and IVF search read full-precision vectors for every scored product,
+so memory and bandwidth grow with the catalog. QuantizedIndex keeps a compact
+copy of the catalog for a first pass over every product, then re-scores
+only the best `rerank` candidates against the full vectors, which stay in
+the memory-mapped store and are read just for those rows.
+
+Vectors are centred on the catalog mean and optionally projected onto their
+top `pca` principal components, then encoded with one of:
+
+    int8      one signed byte per dimension, scaled per dimension
+    pq        product quantisation: `subvectors` one-byte codes, each
+              naming one of 256 centroids of its slice of the vector
+    float32   no quantisation (useful with pca alone)
+
+Centring shifts every product's score for a query by the same amount, so it
+does not change the ranking. With 384-dimensional embeddings, int8 is 4x
+smaller than float32, int8 with pca=96 16x, and pq with 48 subvectors 32x.
+
+Build the index, and compare configurations by recall@k against exact
+search:
+
+    python recommender/quantized_index.py build --codec int8 --pca 128
+    python recommender/quantized_index.py evaluate --configs int8,int8/pca128,pq48,pq24/pca192
+
+Serve it with RECOMMENDER_INDEX=quantized; RECOMMENDER_RERANK sets the
+number of candidates re-scored exactly (0 returns the first-pass ranking).
+The index records a digest of the product IDs it was built for; after the
+catalog changes it is not loaded until it is rebuilt.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ann_index import ExactIndex, normalize_rows, recall_at_k, search_rows, top_k_indices
+from attribute_index import ids_digest
+from metrics import stage
+from vector_store import MODELS_DIR, load_product_vectors
+
+QUANTIZED_INDEX_PATH = os.path.join(MODELS_DIR, 'product_index_quantized.npz')
+CODECS = ('int8', 'pq', 'float32')
+DEFAULT_CODEC = 'int8'
+DEFAULT_SUBVECTORS = 48
+DEFAULT_RERANK = 200
+PQ_CENTROIDS = 256
+
+# Rows encoded per block when building
+_ENCODE_BLOCK = 32768
+# Rows of int8 codes widened to float32 at a time in the first pass; small
+# enough that the widened block stays in cache for the multiply
+_SCAN_BLOCK = 2048
+# Vectors sampled to fit the PCA projection, scales and PQ codebooks
+_TRAIN_SAMPLE = 50000
+# Sample vectors per PQ centroid when training the codebooks
+_PQ_POINTS_PER_CENTROID = 64
+
+
+def _kmeans(vectors: np.ndarray, k: int, n_iter: int, rng: np.random.Generator) -> np.ndarray:
+    """Euclidean k-means centroids of the rows."""
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(n_iter):
+        distances = (np.sum(centroids ** 2, axis=1) - 2 * vectors @ centroids.T)
+        assignment = np.argmin(distances, axis=1)
+        sums = np.stack([np.bincount(assignment, weights=vectors[:, i], minlength=k)
+                         for i in range(vectors.shape[1])], axis=1)
+        counts = np.bincount(assignment, minlength=k)
+        empty = counts == 0
+        if empty.any():
+            sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+            counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+class QuantizedIndex:
+    """Compressed first-pass scan over the catalog, then exact re-scoring of the best candidates."""
+
+    kind = 'quantized'
+
+    def __init__(self, embeddings: np.ndarray, codec: str, codes: np.ndarray, mean: np.ndarray,
+                 components: Optional[np.ndarray] = None, scale: Optional[np.ndarray] = None,
+                 centroids: Optional[np.ndarray] = None, rerank: int = DEFAULT_RERANK,
+                 normalized: bool = False):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec '{codec}'; expected one of {', '.join(CODECS)}")
+        self.embeddings = embeddings if normalized else normalize_rows(embeddings)
+        self.codec = codec
+        # int8 and float32 codes are (n, dims); pq codes are (subvectors, n) so each slice is contiguous
+        self.codes = codes
+        self.mean = mean
+        self.components = components
+        self.scale = scale
+        self.centroids = centroids
+        self.rerank = rerank
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def dims(self) -> int:
+        """Dimensions kept after the optional PCA projection."""
+        return self.components.shape[1] if self.components is not None else len(self.mean)
+
+    @property
+    def bytes_per_vector(self) -> int:
+        return self.codes.nbytes // max(1, len(self))
+
+    @property
+    def compression(self) -> float:
+        """Full-precision bytes per product over compressed bytes per product."""
+        return self.embeddings.shape[1] * 4 / max(1, self.bytes_per_vector)
+
+    def describe(self) -> str:
+        parts = [self.codec if self.codec != 'pq' else f"pq{self.centroids.shape[0]}"]
+        if self.components is not None:
+            parts.append(f"pca{self.dims}")
+        return '/'.join(parts)
+
+    def _project(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32) - self.mean
+        return vectors @ self.components if self.components is not None else vectors
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, codec: str = DEFAULT_CODEC, pca: Optional[int] = None,
+              subvectors: int = DEFAULT_SUBVECTORS, rerank: int = DEFAULT_RERANK, n_iter: int = 15,
+              seed: int = 0, normalized: bool = False) -> 'QuantizedIndex':
+        """Fit the projection and codec on a sample of the catalog, then encode every product."""
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec '{codec}'; expected one of {', '.join(CODECS)}")
+        vectors = embeddings if normalized else normalize_rows(embeddings)
+        n, d = vectors.shape
+        rng = np.random.default_rng(seed)
+        sample = np.asarray(vectors[np.sort(rng.choice(n, min(n, _TRAIN_SAMPLE), replace=False))],
+                             dtype=np.float32)
+        mean = sample.mean(axis=0)
+
+        components = None
+        if pca is not None and pca < d:
+            _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+            components = np.ascontiguousarray(vt[:pca].T, dtype=np.float32)
+        index = cls(vectors, codec, np.empty(0), mean, components, rerank=rerank, normalized=True)
+        projected = index._project(sample)
+        dims = projected.shape[1]
+
+        if codec == 'int8':
+            index.scale = np.maximum(np.abs(projected).max(axis=0), 1e-12).astype(np.float32) / 127
+        elif codec == 'pq':
+            if dims % subvectors:
+                raise ValueError(f"{dims} dimensions do not split into {subvectors} subvectors")
+            width = dims // subvectors
+            training = projected[rng.permutation(len(projected))[:PQ_CENTROIDS * _PQ_POINTS_PER_CENTROID]]
+            index.centroids = np.stack([
+                _kmeans(training[:, j * width:(j + 1) * width], PQ_CENTROIDS, n_iter, rng)
+                for j in range(subvectors)])
+
+        blocks = [index._encode(index._project(vectors[start:start + _ENCODE_BLOCK]))
+                  for start in range(0, n, _ENCODE_BLOCK)]
+        index.codes = np.concatenate(blocks, axis=1 if codec == 'pq' else 0)
+        return index
+
+    def _encode(self, projected: np.ndarray) -> np.ndarray:
+        if self.codec == 'int8':
+            return np.clip(np.rint(projected / self.scale), -127, 127).astype(np.int8)
+        if self.codec == 'pq':
+            subvectors, _, width = self.centroids.shape
+            codes = np.empty((subvectors, len(projected)), dtype=np.uint8)
+            for j in range(subvectors):
+                part = projected[:, j * width:(j + 1) * width]
+                centroids = self.centroids[j]
+                codes[j] = np.argmin(np.sum(centroids ** 2, axis=1) - 2 * part @ centroids.T, axis=1)
+            return codes
+        return projected.astype(np.float32)
+
+    def save(self, path: str = QUANTIZED_INDEX_PATH, product_ids=None):
+        """Save the index; product_ids (the vector store rows) let load() reject another catalog."""
+        meta = {'codec': self.codec}
+        if product_ids is not None:
+            meta['digest'] = ids_digest(product_ids)
+        arrays = {'codes': self.codes, 'mean': self.mean,
+                  'shape': np.array(self.embeddings.shape, dtype=np.int64),
+                  'meta': np.array(json.dumps(meta))}
+        for name in ('components', 'scale', 'centroids'):
+            if getattr(self, name) is not None:
+                arrays[name] = getattr(self, name)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, embeddings: np.ndarray, path: str = QUANTIZED_INDEX_PATH, rerank: int = DEFAULT_RERANK,
+             normalized: bool = False, product_ids=None) -> 'QuantizedIndex':
+        data = np.load(path, allow_pickle=False)
+        if tuple(data['shape']) != tuple(np.shape(embeddings)):
+            raise ValueError(f"Quantized index at {path} was built for embeddings of shape "
+                             f"{tuple(int(v) for v in data['shape'])}, not {tuple(np.shape(embeddings))}; rebuild it")
+        meta = json.loads(str(data['meta']))
+        # Codes of other products would send the re-scoring step the wrong candidates
+        if product_ids is not None and meta.get('digest') != ids_digest(product_ids):
+            raise ValueError(f"Quantized index at {path} was built for other products; rebuild it")
+        optional = {name: data[name] if name in data.files else None for name in ('components', 'scale', 'centroids')}
+        return cls(embeddings, meta['codec'], data['codes'], data['mean'], rerank=rerank,
+                   normalized=normalized, **optional)
+
+    def approximate_scores(self, query: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """First-pass scores of every product (or of rows) from the compressed codes.
+
+        Scores are offset from cosine similarity by a constant per query.
+        """
+        projected = self._project(query)
+        if self.codec == 'pq':
+            subvectors, _, width = self.centroids.shape
+            table = np.einsum('jcw,jw->jc', self.centroids, projected.reshape(subvectors, width))
+            count = len(self) if rows is None else len(rows)
+            scores = np.zeros(count, dtype=np.float32)
+            for j in range(subvectors):
+                codes = self.codes[j] if rows is None else self.codes[j][rows]
+                scores += table[j].take(codes)
+            return scores
+        weights = projected * self.scale if self.codec == 'int8' else projected
+        if rows is not None:
+            return self.codes[rows].astype(np.float32) @ weights
+        if self.codec == 'float32':
+            return self.codes @ weights
+        scores = np.empty(len(self), dtype=np.float32)
+        for start in range(0, len(self), _SCAN_BLOCK):
+            scores[start:start + _SCAN_BLOCK] = self.codes[start:start + _SCAN_BLOCK].astype(np.float32) @ weights
+        return scores
+
+    def search(self, query: np.ndarray, top_k: int,
+               rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row indices, cosine scores) of the top_k products, best first.
+
+        The best max(top_k, rerank) products by compressed score are
+        re-scored exactly; with rerank 0 the compressed ranking and scores
+        are returned as they are. With rows, only those products are
+        candidates, and a subset no larger than the re-score budget is
+        scored exactly straight away.
+        """
+        query = normalize_rows(query)
+        candidate_count = max(top_k, self.rerank) if self.rerank else top_k
+        if rows is not None and self.rerank and len(rows) <= candidate_count:
+            return search_rows(self.embeddings, query, rows, top_k, self.kind)
+        with stage('approx_similarity', index=self.kind, codec=self.codec):
+            scores = self.approximate_scores(query, rows)
+        with stage('top_k', index=self.kind):
+            best = top_k_indices(scores, candidate_count)
+            candidates = best if rows is None else rows[best]
+        if not self.rerank:
+            return candidates, scores[best]
+        with stage('rerank', index=self.kind):
+            # Sorted rows read the memory-mapped store sequentially
+            candidates = np.sort(candidates)
+            exact = np.asarray(self.embeddings[candidates], dtype=np.float32) @ query
+            best = top_k_indices(exact, top_k)
+        return candidates[best], exact[best]
+
+
+def parse_config(config: str) -> Dict[str, Any]:
+    """'int8', 'int8/pca128', 'pq48' or 'pq24/pca192' as build arguments."""
+    options: Dict[str, Any] = {}
+    for part in config.strip().lower().split('/'):
+        if part.startswith('pca'):
+            options['pca'] = int(part[3:])
+        elif part.startswith('pq'):
+            options['codec'] = 'pq'
+            if part[2:]:
+                options['subvectors'] = int(part[2:])
+        elif part in CODECS:
+            options['codec'] = part
+        else:
+            raise ValueError(f"Unknown index configuration '{part}' in '{config}'")
+    options.setdefault('codec', 'float32' if 'pca' in options else DEFAULT_CODEC)
+    return options
+
+
+def evaluate(embeddings: np.ndarray, configs: List[str], top_k: int = 10, rerank: int = DEFAULT_RERANK,
+             queries: int = 200, normalized: bool = False, seed: int = 0) -> List[Dict[str, Any]]:
+    """Compression, recall@k (first pass alone and re-scored) and latency of each configuration."""
+    reference = ExactIndex(embeddings, normalized=normalized)
+    rng = np.random.default_rng(seed)
+    # Perturbed catalog vectors stand in for real preference queries, as in ann_index.py
+    sample = reference.embeddings[np.sort(rng.choice(len(reference), min(queries, len(reference)), replace=False))]
+    sample = sample + rng.normal(scale=0.05, size=sample.shape).astype(np.float32)
+
+    start = time.perf_counter()
+    for query in sample:
+        reference.search(query, top_k)
+    results = [{'config': 'exact', 'bytes_per_vector': reference.embeddings.shape[1] * 4, 'compression': 1.0,
+                'recall_first_pass': 1.0, 'recall': 1.0,
+                'ms_per_query': round((time.perf_counter() - start) * 1000 / len(sample), 3)}]
+
+    for config in configs:
+        build_start = time.perf_counter()
+        index = QuantizedIndex.build(reference.embeddings, rerank=rerank, normalized=True, seed=seed,
+                                     **parse_config(config))
+        build_seconds = time.perf_counter() - build_start
+        index.rerank = 0
+        first_pass = recall_at_k(index, reference, sample, top_k)
+        index.rerank = rerank
+        recall = recall_at_k(index, reference, sample, top_k)
+        start = time.perf_counter()
+        for query in sample:
+            index.search(query, top_k)
+        results.append({'config': index.describe(), 'bytes_per_vector': index.bytes_per_vector,
+                        'compression': round(index.compression, 1), 'recall_first_pass': round(first_pass, 4),
+                        'recall': round(recall, 4),
+                        'ms_per_query': round((time.perf_counter() - start) * 1000 / len(sample), 3),
+                        'build_seconds': round(build_seconds, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or evaluate the quantized product embedding index')
+    parser.add_argument('command', choices=['build', 'evaluate'],
+                        help='build: encode the catalog and save the index; evaluate: compare configurations')
+    parser.add_argument('--codec', type=str, choices=CODECS, default=DEFAULT_CODEC, help='How vectors are encoded')
+    parser.add_argument('--pca', type=int, help='Keep only this many principal components')
+    parser.add_argument('--subvectors', type=int, default=DEFAULT_SUBVECTORS, help='PQ codes per product')
+    parser.add_argument('--configs', type=str, default='int8,int8/pca128,pq48,pq24/pca192,float32/pca96',
+                        help='Comma-separated configurations to evaluate, e.g. int8/pca128 or pq48')
+    parser.add_argument('--rerank', type=int, default=DEFAULT_RERANK, help='Candidates re-scored exactly')
+    parser.add_argument('--top_k', type=int, default=10, help='k for recall@k')
+    parser.add_argument('--queries', type=int, default=200, help='Number of sampled queries for recall')
+    parser.add_argument('--output', type=str, help='Write the evaluation as JSON to this file')
+    args = parser.parse_args()
+
+    ids, embeddings, normalized = load_product_vectors()
+
+    if args.command == 'build':
+        start = time.time()
+        index = QuantizedIndex.build(embeddings, codec=args.codec, pca=args.pca, subvectors=args.subvectors,
+                                     rerank=args.rerank, normalized=normalized)
+        index.save(QUANTIZED_INDEX_PATH, ids)
+        print(f"Built {index.describe()} index over {len(index)} products ({index.bytes_per_vector} bytes each, "
+              f"{index.compression:.1f}x smaller) in {time.time() - start:.2f}s, saved to {QUANTIZED_INDEX_PATH}")
+        return
+
+    configs = [config for config in args.configs.split(',') if config.strip()]
+    results = evaluate(embeddings, configs, top_k=args.top_k, rerank=args.rerank, queries=args.queries,
+                       normalized=normalized)
+    print(f"{'config':<16} {'bytes':>6} {'ratio':>6} {'recall@' + str(args.top_k) + ' 1st':>13} "
+          f"{'reranked':>9} {'ms/query':>9}")
+    for result in results:
+        print(f"{result['config']:<16} {result['bytes_per_vector']:>6} {result['compression']:>5.1f}x "
+              f"{result['recall_first_pass']:>13.3f} {result['recall']:>9.3f} {result['ms_per_query']:>9.3f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'top_k': args.top_k, 'rerank': args.rerank, 'products': len(embeddings),
+                       'results': results}, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+server.py
+
+Long-lived HTTP service for the recommender. Spawning style_recommender.py or
+size_recommender.py per request re-imports torch and sentence-transformers and
+reloads the model and product embeddings every time; this process loads them
+once and keeps them warm.
+
+Run it from the project root so the relative model paths resolve:
+
+    python recommender/server.py --port 5001
+
+Endpoints:
+    GET  /health           - liveness and what is loaded
+    GET  /metrics          - stage timings, request latency and cache counters (Prometheus)
+    POST /recommend/style  - same payload as style_recommender.py's JSON output; with a
+                             product_id (or product_data), products similar to it
+    POST /recommend/style/batch - many users at once, streamed as JSON lines
+    POST /recommend/size   - same payload as size_recommender.py's JSON output
+    POST /recommend/size/batch - best size for many (or all) products at once
+    POST /interactions     - apply a like/dislike/save to the user's preference vector
+    POST /training/jobs    - queue an adapter retrain for a user (coalesced per user)
+"""
+
+import argparse
+import atexit
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List
+
+from flask import Flask, Response, g, jsonify, request, stream_with_context
+
+from async_pipeline import RecommendationPipeline
+from batch_recommender import recommend_batch
+from catalog_snapshot import catalog_snapshot, product_pages
+from embedding_cache import query_cache
+from encode_batcher import batching_encoder
+from materialized import recommendation_store
+from metrics import increment, metrics, stage
+from model_registry import model_registry
+from preference_vectors import ACTION_WEIGHTS, preference_store
+from product_cache import get_supabase_client, product_cache
+from style_recommender import StyleRecommender, build_results, recommend_for_user
+from training_queue import TrainingScheduler, training_queue
+from size_chart_store import compiled_size_charts
+from size_engine import SizeChartMatrix
+from size_recommender import get_size_recommendation
+
+app = Flask(__name__)
+
+_started_at = time.time()
+_base_recommender = None
+_size_charts = None
+_pipeline = None
+
+
+def get_base_recommender() -> StyleRecommender:
+    """Return the shared recommender, loading the model on first use.
+
+    Its model is wrapped so concurrent requests' query encodes share forward passes.
+    """
+    global _base_recommender
+    if _base_recommender is None:
+        recommender = StyleRecommender()
+        recommender.model = batching_encoder(recommender.model)
+        _base_recommender = recommender
+    return _base_recommender
+
+
+def get_recommender(user_id: str = None) -> StyleRecommender:
+    """Return a recommender for the user that reuses the warm base model."""
+    base = get_base_recommender()
+    if not user_id:
+        return base
+    return StyleRecommender(user_id=user_id, base=base)
+
+
+def get_pipeline():
+    """Return the asyncio recommendation pipeline, or None if RECOMMENDER_ASYNC=0."""
+    global _pipeline
+    if _pipeline is None and os.getenv('RECOMMENDER_ASYNC', '1') == '1':
+        _pipeline = RecommendationPipeline(get_base_recommender, get_recommender)
+    return _pipeline
+
+
+def get_size_charts() -> SizeChartMatrix:
+    """Return every product's size chart as one matrix: the compiled store, or the catalog read on first use."""
+    global _size_charts
+    compiled = compiled_size_charts()
+    if compiled is not None:
+        return compiled.charts
+    if _size_charts is None:
+        products = (row for page in product_pages() for row in page)
+        _size_charts = SizeChartMatrix.from_products(products)
+        print(f"[SERVER] Loaded size charts for {len(_size_charts)} products", file=sys.stderr)
+    return _size_charts
+
+
+def _string_list(value: Any) -> List[str]:
+    if isinstance(value, list) and all(isinstance(v, str) for v in value):
+        return value
+    return []
+
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None and request.url_rule is not None:
+        metrics.observe('recommender_request_seconds', time.perf_counter() - started,
+                        endpoint=request.url_rule.rule, status=str(response.status_code))
+    return response
+
+
+def _cache_gauges():
+    """Current cache and registry counters as (name, labels, value) gauges."""
+    caches = [('detail', product_cache.stats()), ('query', query_cache.stats()),
+              ('user_models', model_registry.stats())]
+    if recommendation_store is not None:
+        caches.append(('materialized', recommendation_store.stats()))
+    if preference_store is not None:
+        caches.append(('preference_vectors', preference_store.stats()))
+    for cache, stats in caches:
+        for key, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield f"recommender_cache_{key}", {'cache': cache}, value
+
+
+def _pipeline_gauges():
+    """Requests in flight on the asyncio pipeline and its executor sizes."""
+    if _pipeline is None:
+        return
+    for key, value in _pipeline.stats().items():
+        yield f"recommender_pipeline_{key}", {}, value
+
+
+def _training_gauges():
+    """Training queue depth by status and recent job latency percentiles."""
+    if training_queue is None:
+        return
+    for key, value in training_queue.stats().items():
+        if key in ('pending', 'running', 'done', 'failed'):
+            yield 'recommender_training_jobs', {'status': key}, value
+        elif key.endswith(('_p50', '_p95')):
+            phase, _, quantile = key.partition('_seconds_p')
+            yield 'recommender_training_job_seconds', {'phase': phase, 'quantile': str(int(quantile) / 100)}, value
+        else:
+            yield f"recommender_training_{key}", {}, value
+
+
+def _snapshot_status():
+    snapshot = catalog_snapshot()
+    if snapshot is None:
+        return None
+    return {"products": len(snapshot), "synced_at": snapshot.metadata.get('synced_at')}
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    base = _base_recommender
+    return jsonify({
+        "status": "ok",
+        "uptime_seconds": round(time.time() - _started_at, 3),
+        "model_loaded": base is not None,
+        "product_count": len(base.product_ids) if base is not None else 0,
+        "detail_cache": product_cache.stats(),
+        "query_cache": query_cache.stats(),
+        "encode_batcher": base.model.stats() if base is not None else None,
+        "user_models": model_registry.stats(),
+        "materialized": recommendation_store.stats() if recommendation_store is not None else None,
+        "preference_vectors": preference_store.stats() if preference_store is not None else None,
+        "training_queue": training_queue.stats() if training_queue is not None else None,
+        "pipeline": _pipeline.stats() if _pipeline is not None else None,
+        "catalog_snapshot": _snapshot_status(),
+    })
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    gauges = list(_cache_gauges()) + list(_pipeline_gauges()) + list(_training_gauges())
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/recommend/style', methods=['POST'])
+def recommend_style():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    user_id = body.get('user_id')
+    user_preferences = _string_list(body.get('user_preferences'))
+    user_materials = _string_list(body.get('user_materials'))
+    try:
+        limit = int(body.get('limit', 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit must be an integer"}), 400
+    filters = body.get('filters')
+    if filters is not None and not isinstance(filters, dict):
+        return jsonify({"error": "filters must be an object"}), 400
+
+    product_data = body.get('product_data')
+    product_id = body.get('product_id') or (product_data.get('product_id') if isinstance(product_data, dict) else None)
+
+    pipeline = get_pipeline()
+    try:
+        recommendations = None
+        if product_id:
+            # "More like this" from the neighbour graph; unknown products fall back to preferences
+            recommendations = get_base_recommender().similar(str(product_id), top_k=limit, filters=filters)
+        if recommendations is None and pipeline is not None:
+            recommendations = pipeline.run(user_id, user_preferences, user_materials, limit,
+                                           catalog=get_base_recommender().catalog_version, filters=filters)
+        elif recommendations is None:
+            recommendations = recommend_for_user(
+                lambda: get_recommender(user_id),
+                user_id,
+                user_preferences,
+                user_materials,
+                limit,
+                catalog=get_base_recommender().catalog_version,
+                filters=filters
+            )
+    except Exception as e:
+        print(f"[SERVER] Error in style recommendation: {e}", file=sys.stderr)
+        return jsonify({
+            "data": [],
+            "count": 0,
+            "recommendations": [],
+            "error": str(e),
+            "metadata": {"user_id": user_id, "error_message": str(e)}
+        }), 500
+
+    return jsonify(build_results(recommendations, user_id, user_preferences, user_materials))
+
+
+@app.route('/recommend/style/batch', methods=['POST'])
+def recommend_style_batch():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    users = body.get('users')
+    if not isinstance(users, list) or not all(isinstance(user, dict) for user in users):
+        return jsonify({"error": "users must be a list of objects"}), 400
+    try:
+        limit = int(body.get('limit', 5))
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit must be an integer"}), 400
+    users = [{"user_id": user.get('user_id'), "user_preferences": _string_list(user.get('user_preferences')),
+              "user_materials": _string_list(user.get('user_materials'))}
+             for user in users]
+    include_details = body.get('include_details', True) is not False
+
+    recommender = get_base_recommender()
+
+    def generate():
+        for result in recommend_batch(recommender, users, top_k=limit, include_details=include_details):
+            yield json.dumps(result) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/recommend/size', methods=['POST'])
+def recommend_size():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    product = body.get('product_data')
+    if not isinstance(product, dict):
+        return jsonify({"error": "product_data is required"}), 400
+    try:
+        recommendation = get_size_recommendation(
+            float(body.get('height') or 0),
+            float(body.get('weight') or 0),
+            body.get('measurements') or {},
+            product
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 422
+    return jsonify(recommendation)
+
+
+@app.route('/recommend/size/batch', methods=['POST'])
+def recommend_size_batch():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    measurements = body.get('measurements')
+    if not isinstance(measurements, dict):
+        return jsonify({"error": "measurements is required"}), 400
+    product_ids = body.get('product_ids')
+    if product_ids is not None and not isinstance(product_ids, list):
+        return jsonify({"error": "product_ids must be a list"}), 400
+    try:
+        recommendations = get_size_charts().recommend(measurements, product_ids)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 422
+    return jsonify({"recommendations": recommendations, "count": len(recommendations)})
+
+
+@app.route('/interactions', methods=['POST'])
+def record_interaction():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    user_id, product_id = body.get('user_id'), body.get('product_id')
+    action = body.get('interaction_type') or body.get('action')
+    if not user_id or not product_id:
+        return jsonify({"error": "user_id and product_id are required"}), 400
+    if action not in ACTION_WEIGHTS:
+        return jsonify({"error": f"interaction_type must be one of {', '.join(sorted(ACTION_WEIGHTS))}"}), 400
+    if preference_store is None:
+        return jsonify({"error": "Preference vectors are disabled"}), 503
+
+    base = get_base_recommender()
+    row = base.product_row(str(product_id))
+    if row is None:
+        return jsonify({"error": f"Product {product_id} is not in the catalog"}), 404
+    try:
+        with stage('preference_update'):
+            preference = preference_store.update(str(user_id), action, base.index.embeddings[row])
+    except Exception as e:
+        print(f"[SERVER] Error updating preference vector: {e}", file=sys.stderr)
+        increment('recommender_errors_total', stage='preference_update')
+        return jsonify({"error": str(e)}), 500
+    increment('recommender_interactions_total', action=action)
+    return jsonify({"user_id": user_id, "product_id": product_id, "interaction_type": action,
+                    "swipes": preference.swipes})
+
+
+@app.route('/training/jobs', methods=['POST'])
+def enqueue_training():
+    body: Dict[str, Any] = request.get_json(silent=True) or {}
+    user_id = body.get('user_id')
+    if not user_id:
+        return jsonify({"error": "user_id is required"}), 400
+    if training_queue is None:
+        return jsonify({"error": "The training queue is disabled"}), 503
+    payload = {key: _string_list(body.get(key)) for key in ('liked', 'disliked', 'saved') if body.get(key)}
+    job_id = training_queue.enqueue(str(user_id), payload)
+    return jsonify({"user_id": user_id, "job_id": job_id, "queue": training_queue.stats()}), 202
+
+
+def warm_detail_cache():
+    """Preload product details so recommendations do not wait on Supabase."""
+    if catalog_snapshot() is not None:
+        # Cache misses are served from the memory-mapped snapshot; nothing to preload
+        return
+    client = get_supabase_client()
+    if client is None:
+        return
+    try:
+        count = product_cache.warm_from_supabase(client)
+        print(f"[SERVER] Warmed product detail cache with {count} products", file=sys.stderr)
+    except Exception as e:
+        print(f"[SERVER] Could not warm product detail cache: {e}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the recommender as a long-lived HTTP service')
+    parser.add_argument('--host', type=str, default=os.getenv('RECOMMENDER_HOST', '127.0.0.1'), help='Interface to bind')
+    parser.add_argument('--port', type=int, default=int(os.getenv('RECOMMENDER_PORT', '5001')), help='Port to listen on')
+    args = parser.parse_args()
+
+    # Load the model before accepting traffic so the first request is warm too.
+    get_base_recommender()
+    atexit.register(query_cache.save)
+    pipeline = get_pipeline()
+    if pipeline is not None:
+        atexit.register(pipeline.stop)
+    if os.getenv('RECOMMENDER_WARM_CACHE', '1') == '1':
+        warm_detail_cache()
+    training_workers = int(os.getenv('RECOMMENDER_TRAINING_WORKERS', '1'))
+    if training_queue is not None and training_workers > 0:
+        scheduler = TrainingScheduler(training_queue, workers=training_workers)
+        if scheduler.start():
+            atexit.register(scheduler.stop)
+    print(f"[SERVER] Recommender ready on http://{args.host}:{args.port}", file=sys.stderr)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+sharded_index.py
+
+Exact search split across CPU cores.
+
+ExactIndex scores the whole catalog with one matrix-vector product on one
+core. ShardedIndex splits the embedding rows into `shards` contiguous
+ranges, scores each range and takes its top_k on a thread pool, then merges
+the shards' partial results into the overall top_k. The shards are views
+into the same (usually memory-mapped) array, so nothing is copied, and
+threads are enough: numpy releases the GIL for the multiply and the
+partition, which are nearly all of the work. Results are the same as
+ExactIndex's.
+
+Serve it with RECOMMENDER_INDEX=sharded; RECOMMENDER_SHARDS sets the number
+of shards (default: one per CPU). Shards are never smaller than
+_MIN_SHARD_ROWS products, so small catalogs and small filtered subsets are
+searched on the calling thread. To see how latency scales on a host:
+
+    python recommender/sharded_index.py benchmark --shards 1,2,4,8,16
+
+OpenBLAS may also spread each multiply over its own threads; set
+OPENBLAS_NUM_THREADS=1 so the two do not compete for the same cores.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from ann_index import ExactIndex, normalize_rows, search_rows, top_k_indices, top_k_rows
+from metrics import stage
+from vector_store import load_product_vectors
+
+# Below this many rows per shard, handing work to a thread costs more than it saves
+_MIN_SHARD_ROWS = 8192
+
+
+def default_shards() -> int:
+    return int(os.getenv('RECOMMENDER_SHARDS', '0')) or os.cpu_count() or 1
+
+
+class ShardedIndex:
+    """Exact cosine search over contiguous row ranges scored in parallel."""
+
+    kind = 'sharded'
+
+    def __init__(self, embeddings: np.ndarray, shards: Optional[int] = None, normalized: bool = False):
+        self.embeddings = embeddings if normalized else normalize_rows(embeddings)
+        n = len(self.embeddings)
+        shards = max(1, min(shards or default_shards(), n // _MIN_SHARD_ROWS))
+        self.bounds = np.linspace(0, n, shards + 1).astype(np.int64)
+        self._pool = ThreadPoolExecutor(max_workers=shards, thread_name_prefix='shard') if shards > 1 else None
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    @property
+    def shards(self) -> int:
+        return len(self.bounds) - 1
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _scan(self, shard: int, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.bounds[shard], self.bounds[shard + 1]
+        scores = self.embeddings[start:end] @ query
+        best = top_k_indices(scores, top_k)
+        return best + start, scores[best]
+
+    def _scan_rows(self, rows: np.ndarray, query: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        scores = self.embeddings[rows] @ query
+        best = top_k_indices(scores, top_k)
+        return rows[best], scores[best]
+
+    def _scan_batch(self, shard: int, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.bounds[shard], self.bounds[shard + 1]
+        scores = queries @ self.embeddings[start:end].T
+        best = top_k_rows(scores, top_k)
+        return best + start, np.take_along_axis(scores, best, axis=1)
+
+    def search(self, query: np.ndarray, top_k: int,
+               rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row indices, cosine scores) of the top_k products, best first.
+
+        With rows (sorted row indices, e.g. from an attribute filter) only
+        those products are scored, split along the same shard boundaries.
+        """
+        query = normalize_rows(query)
+        if self._pool is None or (rows is not None and len(rows) < 2 * _MIN_SHARD_ROWS):
+            if rows is not None:
+                return search_rows(self.embeddings, query, rows, top_k, self.kind)
+            with stage('similarity', index=self.kind):
+                scores = self.embeddings @ query
+            with stage('top_k', index=self.kind):
+                indices = top_k_indices(scores, top_k)
+            return indices, scores[indices]
+
+        with stage('scatter', index=self.kind):
+            if rows is None:
+                futures = [self._pool.submit(self._scan, shard, query, top_k) for shard in range(self.shards)]
+            else:
+                splits = np.searchsorted(rows, self.bounds)
+                futures = [self._pool.submit(self._scan_rows, rows[splits[s]:splits[s + 1]], query, top_k)
+                           for s in range(self.shards) if splits[s + 1] > splits[s]]
+            partials = [future.result() for future in futures]
+        with stage('merge', index=self.kind):
+            candidates = np.concatenate([indices for indices, _ in partials])
+            scores = np.concatenate([shard_scores for _, shard_scores in partials])
+            best = top_k_indices(scores, top_k)
+        return candidates[best], scores[best]
+
+    def search_batch(self, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Search many queries, each shard with one matrix multiply; returns (n_queries, top_k) arrays."""
+        queries = normalize_rows(queries)
+        if self._pool is None:
+            with stage('batch_similarity', index=self.kind):
+                scores = queries @ self.embeddings.T
+            with stage('batch_top_k', index=self.kind):
+                indices = top_k_rows(scores, top_k)
+            return indices, np.take_along_axis(scores, indices, axis=1)
+
+        with stage('batch_scatter', index=self.kind):
+            partials = list(self._pool.map(lambda shard: self._scan_batch(shard, queries, top_k),
+                                           range(self.shards)))
+        with stage('batch_merge', index=self.kind):
+            candidates = np.concatenate([indices for indices, _ in partials], axis=1)
+            scores = np.concatenate([shard_scores for _, shard_scores in partials], axis=1)
+            best = top_k_rows(scores, top_k)
+        return np.take_along_axis(candidates, best, axis=1), np.take_along_axis(scores, best, axis=1)
+
+
+def benchmark(embeddings: np.ndarray, shard_counts: List[int], top_k: int = 10, queries: int = 200,
+              normalized: bool = False, seed: int = 0) -> List[dict]:
+    """Latency per query at each shard count, checked against ExactIndex."""
+    reference = ExactIndex(embeddings, normalized=normalized)
+    rng = np.random.default_rng(seed)
+    # Perturbed catalog vectors stand in for real preference queries, as in ann_index.py
+    sample = reference.embeddings[rng.choice(len(reference), min(queries, len(reference)), replace=False)]
+    sample = sample + rng.normal(scale=0.05, size=sample.shape).astype(np.float32)
+    expected = [reference.search(query, top_k)[0] for query in sample]
+
+    results = []
+    for shards in shard_counts:
+        index = ShardedIndex(reference.embeddings, shards=shards, normalized=True)
+        index.search(sample[0], top_k)
+        start = time.perf_counter()
+        found = [index.search(query, top_k)[0] for query in sample]
+        elapsed = time.perf_counter() - start
+        matches = sum(np.array_equal(np.sort(a), np.sort(b)) for a, b in zip(expected, found))
+        results.append({'shards': index.shards, 'ms_per_query': round(elapsed * 1000 / len(sample), 3),
+                        'exact_match': matches / len(sample)})
+        index.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure sharded exact search on the product embeddings')
+    parser.add_argument('command', choices=['benchmark'], help='Time search at each shard count')
+    parser.add_argument('--shards', type=str, default='1,2,4,8', help='Comma-separated shard counts')
+    parser.add_argument('--top_k', type=int, default=10, help='Results per query')
+    parser.add_argument('--queries', type=int, default=200, help='Number of sampled queries')
+    parser.add_argument('--output', type=str, help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    _, embeddings, normalized = load_product_vectors()
+    shard_counts = [int(count) for count in args.shards.split(',') if count.strip()]
+    results = benchmark(embeddings, shard_counts, top_k=args.top_k, queries=args.queries, normalized=normalized)
+    baseline = results[0]['ms_per_query']
+    for result in results:
+        speedup = baseline / result['ms_per_query'] if result['ms_per_query'] else 0.0
+        print(f"{result['shards']:>3} shards: {result['ms_per_query']:.3f} ms/query ({speedup:.1f}x), "
+              f"same results as exact for {result['exact_match']:.0%} of queries")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'top_k': args.top_k, 'products': len(embeddings), 'results': results}, f, indent=2)
+        print(f"Wrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
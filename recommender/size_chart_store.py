@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+"""
+size_chart_store.py
+
+Precompiled, memory-mapped size charts.
+
+parse_measurements re-parses a product's sizes_with_measurements string
+(json.loads, then ast.literal_eval, quote stripping, synthesised sizes for
+flat charts) on every size request. This module compiles every product's
+chart once, into the same normalised form recommend_size_from_measurements
+works on (lower-case measurement keys, float values in whatever units the
+chart gives them, only the measurements that are weighted), and writes it
+to a single binary file:
+
+    [header]       HEADER_SIZE bytes: magic, then a JSON header padded with spaces
+    [values]       count x max_sizes x measurements float64
+    [mask]         count x max_sizes x measurements bool, whether each value is present
+    [label_index]  count x max_sizes int32 index into the labels section, -1 for padding
+    [ids]          count fixed-width ASCII product IDs
+    [hashes]       count hex digests of the product fields each chart was compiled from
+    [labels]       fixed-width UTF-8 size labels
+
+The size recommender memory-maps the file and uses a product's compiled
+chart whenever its source hash still matches the product record it was
+given; otherwise it falls back to parsing. A product's fields are hashed
+once per version: after a match, requests carrying the same fields skip the
+hash. Charts that cannot be parsed are reported, with the parser's error,
+when the store is built.
+
+    python recommender/size_chart_store.py build                  # from the catalog snapshot or Supabase
+    python recommender/size_chart_store.py build --csv data/combined_cleaned_latest.csv
+
+A catalog CSV without a product_id column is matched to the catalog's
+products by name; rows whose name matches no product, or several, are
+counted in the report and skipped.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from embedding_builder import content_hash
+from size_engine import MEASUREMENT_KEYS, SizeChartMatrix, best_size, chart_values, user_values
+from size_recommender import product_size_chart
+from vector_store import DEFAULT_ID_WIDTH, HASH_WIDTH, MODELS_DIR
+
+SIZE_CHART_PATH = os.path.join(MODELS_DIR, 'size_charts.store')
+MAGIC = b'SPMSIZE1'
+HEADER_SIZE = 4096
+# Product fields product_size_chart reads, besides the flat-chart base measurements
+CHART_FIELDS = ('sizes_with_measurements', 'sizes')
+BASE_MEASUREMENT_FIELDS = ('bust', 'waist', 'hips', 'chest', 'ptp', 'shoulder')
+# CSV columns a product can be matched on when the CSV has no product IDs
+CSV_NAME_COLUMNS = ('product_name', 'name')
+
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def chart_source(product: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a product record its size chart is parsed from."""
+    return {key: value for key, value in product.items()
+            if key in CHART_FIELDS or key.lower() in BASE_MEASUREMENT_FIELDS}
+
+
+def chart_hash(product: Dict[str, Any]) -> str:
+    return content_hash(json.dumps(chart_source(product), sort_keys=True, default=str))
+
+
+def compile_size_charts(products: Iterable[Dict[str, Any]]) -> Tuple[SizeChartMatrix, List[str], Dict[str, Any]]:
+    """Parse every product's chart once; return the matrix, source hashes and a build report."""
+    charts, hashes = [], []
+    report = {'products': 0, 'compiled': 0, 'no_id': 0, 'no_chart': 0, 'failed': [], 'unscorable': []}
+    for product in products:
+        product_id = product.get('product_id') or product.get('id')
+        if product_id is None:
+            report['no_id'] += 1
+            continue
+        report['products'] += 1
+        if not any(product.get(field) for field in CHART_FIELDS):
+            report['no_chart'] += 1
+            continue
+
+        error = 'chart has no sizes'
+        try:
+            chart = chart_values(product_size_chart(product, strict=True))
+        except Exception as e:
+            chart, error = {}, f"{type(e).__name__}: {e}"
+        if not chart:
+            report['failed'].append({'product_id': str(product_id), 'error': error})
+            continue
+        if not any(key in measurements for measurements in chart.values() for key in MEASUREMENT_KEYS):
+            report['unscorable'].append(str(product_id))
+
+        charts.append((str(product_id), chart))
+        hashes.append(chart_hash(product))
+        report['compiled'] += 1
+    return SizeChartMatrix.from_charts(charts), hashes, report
+
+
+def write_size_chart_store(charts: SizeChartMatrix, hashes: List[str], path: str = SIZE_CHART_PATH) -> dict:
+    """Write the compiled charts to path, atomically replacing any existing store."""
+    count = len(charts)
+    id_width = max([DEFAULT_ID_WIDTH] + [len(product_id.encode('ascii')) for product_id in charts.product_ids])
+    labels = [str(label).encode('utf-8') for label in charts.labels]
+    label_width = max([1] + [len(label) for label in labels])
+    sections = [
+        ('values', np.ascontiguousarray(charts.values, dtype=np.float64)),
+        ('mask', np.ascontiguousarray(charts.mask, dtype=bool)),
+        ('label_index', np.ascontiguousarray(charts.label_index, dtype=np.int32)),
+        ('ids', np.array(charts.product_ids, dtype=f"S{id_width}")),
+        ('hashes', np.array(hashes, dtype=f"S{HASH_WIDTH}")),
+        ('labels', np.array(labels, dtype=f"S{label_width}")),
+    ]
+
+    header = {
+        'count': count,
+        'max_sizes': int(charts.values.shape[1]),
+        'measurements': list(MEASUREMENT_KEYS),
+        'label_count': len(labels),
+        'label_width': label_width,
+        'id_width': id_width,
+    }
+    offset = HEADER_SIZE
+    for name, array in sections:
+        offset = _align(offset)
+        header[f'{name}_offset'] = offset
+        offset += array.nbytes
+
+    encoded = MAGIC + json.dumps(header).encode('ascii')
+    if len(encoded) > HEADER_SIZE:
+        raise ValueError("Size chart store header does not fit in the reserved space")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, prefix='.size-charts-', delete=False) as f:
+        try:
+            f.write(encoded.ljust(HEADER_SIZE, b' '))
+            for name, array in sections:
+                f.write(b'\0' * (header[f'{name}_offset'] - f.tell()))
+                f.write(array.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        except Exception:
+            f.close()
+            os.unlink(f.name)
+            raise
+    # NamedTemporaryFile creates the file owner-only; readers may be other users
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, path)
+    return header
+
+
+def read_header(path: str) -> dict:
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if not raw.startswith(MAGIC):
+        raise ValueError(f"{path} is not a size chart store")
+    return json.loads(raw[len(MAGIC):].decode('ascii'))
+
+
+class CompiledSizeCharts:
+    """Read-only, memory-mapped size chart store."""
+
+    def __init__(self, path: str, header: dict, charts: SizeChartMatrix, hashes: np.ndarray):
+        self.path = path
+        self.header = header
+        self.charts = charts
+        self.hashes = hashes
+        # Plain ndarray views of the mapped sections; slicing an np.memmap costs more per row
+        self._values = np.asarray(charts.values)
+        self._mask = np.asarray(charts.mask)
+        self._label_index = np.asarray(charts.label_index)
+        # Chart fields per row last seen to match the stored hash
+        self._verified: Dict[int, Dict[str, Any]] = {}
+
+    def __len__(self):
+        return self.header['count']
+
+    @classmethod
+    def open(cls, path: str = SIZE_CHART_PATH) -> 'CompiledSizeCharts':
+        header = read_header(path)
+        if tuple(header['measurements']) != MEASUREMENT_KEYS:
+            raise ValueError(f"{path} was compiled for measurements {header['measurements']}; rebuild it")
+        count, max_sizes, measurements = header['count'], header['max_sizes'], len(MEASUREMENT_KEYS)
+
+        def section(name, dtype, shape):
+            if not int(np.prod(shape)):
+                return np.empty(shape, dtype=dtype)
+            return np.memmap(path, dtype=dtype, mode='r', offset=header[f'{name}_offset'], shape=shape)
+
+        values = section('values', np.float64, (count, max_sizes, measurements))
+        mask = section('mask', bool, (count, max_sizes, measurements))
+        label_index = section('label_index', np.int32, (count, max_sizes))
+        ids = section('ids', f"S{header['id_width']}", (count,))
+        hashes = section('hashes', f"S{HASH_WIDTH}", (count,))
+        labels = section('labels', f"S{header['label_width']}", (header['label_count'],))
+
+        charts = SizeChartMatrix([product_id.decode('ascii') for product_id in ids],
+                                 [label.decode('utf-8') for label in labels],
+                                 label_index, values, mask)
+        return cls(path, header, charts, hashes)
+
+    def is_current(self, product: Dict[str, Any]) -> bool:
+        """Whether the product has a compiled chart built from exactly these fields."""
+        product_id = product.get('product_id')
+        row = None if product_id is None else self.charts.row(product_id)
+        if row is None:
+            return False
+        source = chart_source(product)
+        if self._verified.get(row) == source:
+            return True
+        current = self.hashes[row].decode('ascii') == chart_hash(source)
+        if current:
+            self._verified[row] = source
+        return current
+
+    def recommend_size(self, product_id: str, user_measurements: Dict[str, Any]) -> Tuple[str, float]:
+        """(size, confidence) for one product, raising ValueError like recommend_size_from_measurements."""
+        row = self.charts.row(product_id)
+        user = user_values(user_measurements)
+        # Padding columns have no values present, so they are never scored
+        result = None if row is None else best_size(user, self._values[row].tolist(), self._mask[row].tolist())
+        if result is None:
+            raise ValueError("Could not calculate size distances")
+        col, confidence = result
+        return self.charts.labels[self._label_index[row, col]], confidence
+
+
+_compiled = None
+_compiled_mtime = None
+_compiled_lock = threading.Lock()
+
+
+def compiled_size_charts(path: str = SIZE_CHART_PATH) -> Optional[CompiledSizeCharts]:
+    """Return the memory-mapped store, reopening it after a rebuild; None if there is none."""
+    global _compiled, _compiled_mtime
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    if _compiled is None or mtime != _compiled_mtime:
+        with _compiled_lock:
+            if _compiled is None or mtime != _compiled_mtime:
+                try:
+                    _compiled = CompiledSizeCharts.open(path)
+                except Exception as e:
+                    print(f"[SIZE] Could not open size chart store {path}: {e}", file=sys.stderr)
+                    _compiled = None
+                _compiled_mtime = mtime
+    return _compiled
+
+
+def _name_key(name: Any) -> str:
+    return ' '.join(str(name).split()).lower()
+
+
+def _product_ids_by_name(remote: bool = False) -> Dict[str, str]:
+    """Catalog product IDs keyed by normalised name; names shared by several products are left out."""
+    from catalog_snapshot import product_pages
+    ids: Dict[str, Optional[str]] = {}
+    for page in product_pages(columns='product_id,name', remote=remote):
+        for product in page:
+            if product.get('product_id') is None or not product.get('name'):
+                continue
+            key, product_id = _name_key(product['name']), str(product['product_id'])
+            ids[key] = product_id if ids.get(key, product_id) == product_id else None
+    return {key: product_id for key, product_id in ids.items() if product_id is not None}
+
+
+def _csv_products(path: str, remote: bool = False) -> Iterable[Dict[str, Any]]:
+    """Product records from a catalog CSV, matched to catalog IDs by name if it has no ID column."""
+    import pandas as pd
+    frame = pd.read_csv(path)
+    ids, name_column = None, None
+    if 'product_id' not in frame.columns and 'id' not in frame.columns:
+        name_column = next((column for column in CSV_NAME_COLUMNS if column in frame.columns), None)
+        if name_column is None:
+            raise ValueError(f"{path} has no product_id column, and no {' or '.join(CSV_NAME_COLUMNS)} "
+                             f"column to match its rows to products by")
+        ids = _product_ids_by_name(remote)
+        if not ids:
+            raise ValueError(f"{path} has no product_id column, and no catalog product names "
+                             f"could be loaded to match its rows by {name_column}")
+        print(f"{path} has no product_id column; matching rows to {len(ids)} catalog products by {name_column}",
+              file=sys.stderr)
+
+    def records():
+        for record in frame.to_dict(orient='records'):
+            # Empty CSV cells come back as NaN; treat them as missing fields
+            record = {key: value for key, value in record.items()
+                      if not (isinstance(value, float) and np.isnan(value))}
+            if name_column is not None and name_column in record:
+                product_id = ids.get(_name_key(record[name_column]))
+                if product_id is not None:
+                    record['product_id'] = product_id
+            yield record
+    return records()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile product size charts into a memory-mapped store')
+    parser.add_argument('command', choices=['build', 'info'],
+                        help='build: compile every product\'s chart; info: print the header')
+    parser.add_argument('--path', type=str, default=SIZE_CHART_PATH, help='Size chart store path')
+    parser.add_argument('--csv', type=str, help='Read products from a catalog CSV instead of Supabase')
+    parser.add_argument('--remote', action='store_true',
+                        help='Read products (or, with --csv, the names to match) from Supabase '
+                             'even if there is a catalog snapshot')
+    parser.add_argument('--report', type=str, help='Also write the build report as JSON to this file')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        print(json.dumps(read_header(args.path), indent=2))
+        return
+
+    if args.csv:
+        try:
+            products = _csv_products(args.csv, remote=args.remote)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            sys.exit(1)
+    else:
+        from catalog_snapshot import product_pages
+        products = (product for page in product_pages(remote=args.remote) for product in page)
+
+    charts, hashes, report = compile_size_charts(products)
+    for failure in report['failed']:
+        print(f"Could not parse size chart of product {failure['product_id']}: {failure['error']}", file=sys.stderr)
+    if report['no_id']:
+        print(f"Skipped {report['no_id']} rows without a product ID", file=sys.stderr)
+    if not len(charts):
+        if not report['products']:
+            print("No rows with a product ID to compile; keeping the existing store", file=sys.stderr)
+        else:
+            print(f"None of {report['products']} products has a usable size chart ({len(report['failed'])} failed, "
+                  f"{report['no_chart']} without a chart); keeping the existing store", file=sys.stderr)
+        sys.exit(1)
+    header = write_size_chart_store(charts, hashes, args.path)
+
+    if report['unscorable']:
+        print(f"{len(report['unscorable'])} charts have none of the weighted measurements "
+              f"({', '.join(MEASUREMENT_KEYS)})", file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(f"Compiled {report['compiled']} of {report['products']} products' size charts to {args.path} "
+          f"({len(report['failed'])} failed, {report['no_chart']} without a chart, "
+          f"{header['max_sizes']} sizes max)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+size_engine.py
+
+Vectorised size recommendation for many products at once.
+
+recommend_size_from_measurements evaluates one product's sizes in Python
+dicts. SizeChartMatrix holds every product's size chart as a dense float64
+array of shape (products, sizes, measurements) with a mask of which values
+are present, and computes a user's best size and confidence for the whole
+catalog, or any subset of it, in one call.
+
+Results are identical to recommend_size_from_measurements: the same
+SIZE_WEIGHTS, summed in the same order, the same confidence clamping, and
+ties (and unscorable sizes) resolved the same way as its min() over sizes.
+"""
+
+import sys
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from size_recommender import SIZE_WEIGHTS, product_size_chart
+
+MEASUREMENT_KEYS = tuple(key for key, _ in SIZE_WEIGHTS)
+MAX_DIFF = 6.0
+MIN_CONFIDENCE = 0.3
+MAX_CONFIDENCE = 0.98
+
+
+def chart_values(product_sizes: Dict[str, Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Lower-case keys and parse values the way recommend_size_from_measurements does."""
+    chart = {}
+    for size, measurements in product_sizes.items():
+        chart[size] = {}
+        for key, value in measurements.items():
+            try:
+                if isinstance(value, str):
+                    chart[size][key.lower()] = float(value.replace('"', '').strip())
+                else:
+                    chart[size][key.lower()] = float(value)
+            except (ValueError, TypeError):
+                continue
+    return chart
+
+
+def user_values(user_measurements: Dict[str, Any]) -> Dict[str, float]:
+    """Parse user measurements, raising ValueError like the per-product recommender."""
+    if not user_measurements:
+        raise ValueError("No user measurements provided")
+    processed = {}
+    for key, value in user_measurements.items():
+        try:
+            processed[key.lower()] = float(value)
+        except (ValueError, TypeError):
+            continue
+    if not processed:
+        raise ValueError("No valid measurements after processing")
+    return processed
+
+
+def best_size(user: Dict[str, float], values: Sequence[Sequence[float]],
+              mask: Sequence[Sequence[bool]]) -> Optional[Tuple[int, float]]:
+    """(size column, confidence) for one product's chart rows, or None if no size can be scored.
+
+    This is score() for a single product in plain Python, which is quicker
+    than the array version for one row: the same sums in the same order,
+    the same clamping and the same tie-breaking.
+    """
+    terms = [(k, weight, user[key]) for k, (key, weight) in enumerate(SIZE_WEIGHTS) if key in user]
+    best, best_distance = -1, 0.0
+    for col, (size_values, present) in enumerate(zip(values, mask)):
+        total, total_weight = 0.0, 0.0
+        for k, weight, user_value in terms:
+            if present[k]:
+                total += weight * abs(user_value - size_values[k])
+                total_weight += weight
+        if total_weight > 0:
+            distance = total / total_weight
+            if best < 0 or distance < best_distance:
+                best, best_distance = col, distance
+    if best < 0:
+        return None
+    return best, max(MIN_CONFIDENCE, min(MAX_CONFIDENCE, 1.0 - (best_distance / MAX_DIFF)))
+
+
+class SizeChartMatrix:
+    """Dense (products x sizes x measurements) size charts with a presence mask."""
+
+    def __init__(self, product_ids: List[str], labels: List[str], label_index: np.ndarray,
+                 values: np.ndarray, mask: np.ndarray):
+        """label_index[p, s] indexes labels for size s of product p, or is -1 past its last size."""
+        self.product_ids = product_ids
+        self.labels = labels
+        self.label_index = label_index
+        self.values = values
+        self.mask = mask
+        self._rows = {product_id: row for row, product_id in enumerate(product_ids)}
+
+    def __len__(self):
+        return len(self.product_ids)
+
+    @classmethod
+    def from_charts(cls, charts: Iterable[Tuple[str, Dict[str, Dict[str, Any]]]]) -> 'SizeChartMatrix':
+        """Build from (product_id, {size: {measurement: value}}) pairs."""
+        product_ids, size_labels, parsed = [], [], []
+        for product_id, product_sizes in charts:
+            try:
+                chart = chart_values(product_sizes)
+            except Exception as e:
+                print(f"[SIZE] Skipping product {product_id}: {e}", file=sys.stderr)
+                continue
+            if not chart:
+                continue
+            product_ids.append(str(product_id))
+            size_labels.append(list(chart.keys()))
+            parsed.append(chart)
+
+        labels = list(dict.fromkeys(label for product_labels in size_labels for label in product_labels))
+        label_numbers = {label: i for i, label in enumerate(labels)}
+        max_sizes = max((len(product_labels) for product_labels in size_labels), default=0)
+        shape = (len(parsed), max_sizes, len(MEASUREMENT_KEYS))
+        values = np.zeros(shape, dtype=np.float64)
+        mask = np.zeros(shape, dtype=bool)
+        label_index = np.full(shape[:2], -1, dtype=np.int32)
+        for row, chart in enumerate(parsed):
+            for col, (label, measurements) in enumerate(chart.items()):
+                label_index[row, col] = label_numbers[label]
+                for k, key in enumerate(MEASUREMENT_KEYS):
+                    if key in measurements:
+                        values[row, col, k] = measurements[key]
+                        mask[row, col, k] = True
+        return cls(product_ids, labels, label_index, values, mask)
+
+    @classmethod
+    def from_products(cls, products: Iterable[Dict[str, Any]]) -> 'SizeChartMatrix':
+        """Build from product records, parsing each chart like get_size_recommendation."""
+        def charts():
+            for product in products:
+                product_id = product.get('product_id') or product.get('id')
+                if product_id is None:
+                    continue
+                try:
+                    yield product_id, product_size_chart(product)
+                except Exception as e:
+                    print(f"[SIZE] Skipping product {product_id}: {e}", file=sys.stderr)
+        return cls.from_charts(charts())
+
+    def __contains__(self, product_id) -> bool:
+        return str(product_id) in self._rows
+
+    def row(self, product_id) -> Optional[int]:
+        """The product's row, or None if it has no usable size chart."""
+        return self._rows.get(str(product_id))
+
+    def rows_for(self, product_ids: Iterable[str]) -> np.ndarray:
+        """Rows of the given products; IDs without a usable size chart are skipped."""
+        return np.array([self._rows[str(p)] for p in product_ids if str(p) in self._rows], dtype=np.int64)
+
+    def score(self, user_measurements: Dict[str, Any],
+              rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return (best size column, confidence, has_result) for each selected row."""
+        user = user_values(user_measurements)
+        values = self.values if rows is None else self.values[rows]
+        mask = self.mask if rows is None else self.mask[rows]
+
+        # Accumulate one measurement at a time, in SIZE_WEIGHTS order, so the
+        # floating-point sums match the per-product loop exactly
+        total = np.zeros(values.shape[:2], dtype=np.float64)
+        total_weight = np.zeros(values.shape[:2], dtype=np.float64)
+        for k, (key, weight) in enumerate(SIZE_WEIGHTS):
+            if key not in user:
+                continue
+            present = mask[:, :, k]
+            diff = np.abs(user[key] - values[:, :, k])
+            total = np.where(present, total + weight * diff, total)
+            total_weight = np.where(present, total_weight + weight, total_weight)
+
+        scored = total_weight > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            distance = total / np.where(scored, total_weight, 1.0)
+        raw_confidence = 1.0 - (distance / MAX_DIFF)
+        # max(MIN, min(MAX, raw)), including how Python's min/max treat NaN
+        confidence = np.where(raw_confidence < MAX_CONFIDENCE, raw_confidence, MAX_CONFIDENCE)
+        confidence = np.where(confidence > MIN_CONFIDENCE, confidence, MIN_CONFIDENCE)
+
+        # min() over sizes keeps the first size unless a later one is strictly closer
+        n = len(values)
+        best = np.full(n, -1, dtype=np.int64)
+        best_distance = np.zeros(n, dtype=np.float64)
+        for col in range(values.shape[1]):
+            take = scored[:, col] & ((best < 0) | (distance[:, col] < best_distance))
+            best = np.where(take, col, best)
+            best_distance = np.where(take, distance[:, col], best_distance)
+
+        has_result = best >= 0
+        best_confidence = np.where(has_result, confidence[np.arange(n), np.maximum(best, 0)], 0.0)
+        return best, best_confidence, has_result
+
+    def recommend(self, user_measurements: Dict[str, Any],
+                  product_ids: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, Any]]:
+        """Best size per product, keyed by product ID; products that cannot be scored are left out."""
+        rows = None if product_ids is None else self.rows_for(product_ids)
+        best, confidence, has_result = self.score(user_measurements, rows)
+        selected = range(len(self.product_ids)) if rows is None else rows.tolist()
+        results = {}
+        for i, row in enumerate(selected):
+            if has_result[i]:
+                results[self.product_ids[row]] = {
+                    "recommended_size": self.labels[self.label_index[row, best[i]]],
+                    "confidence": float(confidence[i]),
+                    "method": "measurements"
+                }
+        return results
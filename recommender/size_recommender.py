@@ -16,6 +16,8 @@ import pandas as pd
 import numpy as np
 from typing import Dict, Tuple, Any
 
+from metrics import debug, increment, stage
+
 try:
     from supabase import create_client, Client
 except ImportError:
@@ -23,6 +25,16 @@ except ImportError:
     sys.exit(1)
 
 
+# Weight of each body measurement in the size distance, in summation order
+SIZE_WEIGHTS = (
+    ('waist', 3.0),
+    ('hip', 3.0),
+    ('bust', 2.0),
+    ('chest', 2.0),
+    ('length', 1.0),
+)
+
+
 def get_user_profile(user_id: str) -> Dict[str, Any]:
     url = os.environ.get("NEXT_PUBLIC_SUPABASE_URL")
     key = os.environ.get("NEXT_PUBLIC_SUPABASE_ANON_KEY")
@@ -49,110 +61,112 @@ def get_user_profile(user_id: str) -> Dict[str, Any]:
 
 
 def parse_measurements(measurements_str: str) -> dict:
-    if not measurements_str:
-        print("Empty measurements string", file=sys.stderr)
+    """Parse a sizes_with_measurements string, printing any problem and returning {} for it."""
+    try:
+        return parse_size_chart(measurements_str)
+    except Exception as e:
+        print(f"Error in parse_measurements: {e}", file=sys.stderr)
         return {}
+
+
+def parse_size_chart(measurements_str: str) -> dict:
+    """Parse a sizes_with_measurements string into {size: {measurement: value}}, raising on failure."""
+    if not measurements_str:
+        raise ValueError("Empty measurements string")
     
+    debug("Trying to parse measurements: %.100s...", measurements_str)
     try:
-        print(f"Trying to parse measurements: {measurements_str[:100]}...", file=sys.stderr)
-        try:
-            data = json.loads(measurements_str)
-        except json.JSONDecodeError:
-            print("JSON decode error, trying ast.literal_eval", file=sys.stderr)
-            import ast
-            data = ast.literal_eval(measurements_str)
-        
-        print(f"Raw data type: {type(data)}, value: {str(data)[:200]}", file=sys.stderr)
-        
-        # Handle different measurement formats
-        if isinstance(data, dict):
-            # Format 1: Dictionary with size keys
-            if any(isinstance(value, dict) for value in data.values()):
-                print("Format: Dictionary with size keys", file=sys.stderr)
-                parsed = {}
-                for size, measures in data.items():
-                    if not isinstance(measures, dict):
-                        continue
-                    size_measures = {}
-                    for k, v in measures.items():
-                        try:
-                            size_measures[k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
-                        except (ValueError, TypeError, AttributeError):
-                            size_measures[k.lower()] = v
-                    parsed[size] = size_measures
-                return parsed
-            # Format 2: Flat dictionary of measurements
-            else:
-                print("Format: Flat dictionary of measurements", file=sys.stderr)
-                measurements_by_size = {}
-                # Instead of using a hardcoded list, use the sizes available in data if provided.
-                sizes = []
-                if "sizes" in data and isinstance(data["sizes"], list):
-                    sizes = data["sizes"]
-                else:
-                    # Fallback if no sizes provided (could also choose to error out)
-                    sizes = ["XS", "S", "M", "L", "XL"]
-                
-                # Get base measurements from the flat dictionary
-                base_measurements = {}
-                for k, v in data.items():
-                    if k.lower() in ["bust", "waist", "hips", "chest", "ptp", "shoulder"]:
-                        try:
-                            base_measurements[k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
-                        except (ValueError, TypeError, AttributeError):
-                            pass
-                
-                if not base_measurements:
-                    print("No valid measurements found in flat dictionary", file=sys.stderr)
-                    return {}
-                
-                # Create size variants with increments based on the available sizes
-                for i, size in enumerate(sizes):
-                    size_measurements = {}
-                    # Calculate an increment relative to the median size; here, assume the middle of the list is "M"
-                    try:
-                        m_index = sizes.index("M")
-                    except ValueError:
-                        m_index = len(sizes) // 2
-                    increment = (i - m_index) * 5  # e.g., -10 for smallest, -5 for next, 0 for median, etc.
-                    
-                    for k, v in base_measurements.items():
-                        size_measurements[k] = v + increment
-                    
-                    measurements_by_size[size] = size_measurements
-                
-                print(f"Created size variants: {measurements_by_size}", file=sys.stderr)
-                return measurements_by_size
-        elif isinstance(data, list):
-            print("Format: List of sizes with measurements", file=sys.stderr)
+        data = json.loads(measurements_str)
+    except json.JSONDecodeError:
+        debug("JSON decode error, trying ast.literal_eval")
+        import ast
+        data = ast.literal_eval(measurements_str)
+    
+    debug("Raw data type: %s, value: %.200s", type(data), data)
+    
+    # Handle different measurement formats
+    if isinstance(data, dict):
+        # Format 1: Dictionary with size keys
+        if any(isinstance(value, dict) for value in data.values()):
+            debug("Format: Dictionary with size keys")
             parsed = {}
-            for item in data:
-                if not isinstance(item, dict):
+            for size, measures in data.items():
+                if not isinstance(measures, dict):
                     continue
-                size = item.get("size", "M")
-                measurements = item.get("measurements", {})
-                if not measurements:
-                    continue
-                parsed[size] = {}
-                for k, v in measurements.items():
+                size_measures = {}
+                for k, v in measures.items():
                     try:
-                        parsed[size][k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
+                        size_measures[k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
                     except (ValueError, TypeError, AttributeError):
-                        pass
+                        size_measures[k.lower()] = v
+                parsed[size] = size_measures
             return parsed
-        elif isinstance(data, str):
-            print("Format: String with escaped JSON, trying to parse again", file=sys.stderr)
-            try:
-                return parse_measurements(data)
-            except Exception as e:
-                print(f"Failed to parse nested string: {e}", file=sys.stderr)
-                return {}
+        # Format 2: Flat dictionary of measurements
         else:
-            print(f"Unknown format: {type(data)}", file=sys.stderr)
-            return {}
-    except Exception as e:
-        print(f"Error in parse_measurements: {e}", file=sys.stderr)
-        return {}
+            debug("Format: Flat dictionary of measurements")
+            measurements_by_size = {}
+            # Instead of using a hardcoded list, use the sizes available in data if provided.
+            sizes = []
+            if "sizes" in data and isinstance(data["sizes"], list):
+                sizes = data["sizes"]
+            else:
+                # Fallback if no sizes provided (could also choose to error out)
+                sizes = ["XS", "S", "M", "L", "XL"]
+            
+            # Get base measurements from the flat dictionary
+            base_measurements = {}
+            for k, v in data.items():
+                if k.lower() in ["bust", "waist", "hips", "chest", "ptp", "shoulder"]:
+                    try:
+                        base_measurements[k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
+                    except (ValueError, TypeError, AttributeError):
+                        pass
+            
+            if not base_measurements:
+                raise ValueError("No valid measurements found in flat dictionary")
+            
+            # Create size variants with increments based on the available sizes
+            for i, size in enumerate(sizes):
+                size_measurements = {}
+                # Calculate an increment relative to the median size; here, assume the middle of the list is "M"
+                try:
+                    m_index = sizes.index("M")
+                except ValueError:
+                    m_index = len(sizes) // 2
+                increment = (i - m_index) * 5  # e.g., -10 for smallest, -5 for next, 0 for median, etc.
+                
+                for k, v in base_measurements.items():
+                    size_measurements[k] = v + increment
+                
+                measurements_by_size[size] = size_measurements
+            
+            debug("Created size variants: %s", measurements_by_size)
+            return measurements_by_size
+    elif isinstance(data, list):
+        debug("Format: List of sizes with measurements")
+        parsed = {}
+        for item in data:
+            if not isinstance(item, dict):
+                continue
+            size = item.get("size", "M")
+            measurements = item.get("measurements", {})
+            if not measurements:
+                continue
+            parsed[size] = {}
+            for k, v in measurements.items():
+                try:
+                    parsed[size][k.lower()] = float(v.replace('"', '').strip()) if isinstance(v, str) else float(v)
+                except (ValueError, TypeError, AttributeError):
+                    pass
+        return parsed
+    elif isinstance(data, str):
+        debug("Format: String with escaped JSON, trying to parse again")
+        try:
+            return parse_size_chart(data)
+        except Exception as e:
+            raise ValueError(f"Failed to parse nested string: {e}")
+    else:
+        raise ValueError(f"Unknown format: {type(data)}")
 
 
 def compute_shape_distance(user: Dict[str, float], product: Dict[str, float]) -> float:
@@ -236,8 +250,8 @@ def recommend_size_from_measurements(user_measurements: Dict[str, float],
         print("ERROR: No user measurements provided", file=sys.stderr)
         raise ValueError("No user measurements provided")
     
-    print(f"Starting size recommendation with user measurements: {user_measurements}", file=sys.stderr)
-    print(f"Available product sizes: {list(product_sizes.keys())}", file=sys.stderr)
+    debug("Starting size recommendation with user measurements: %s", user_measurements)
+    debug("Available product sizes: %s", list(product_sizes))
     
     # User measurements are already in the correct units (inches for body measurements, cm for height, kg for weight)
     user_processed = {}
@@ -251,7 +265,7 @@ def recommend_size_from_measurements(user_measurements: Dict[str, float],
         print("ERROR: No valid measurements after processing", file=sys.stderr)
         raise ValueError("No valid measurements after processing")
     
-    print(f"Processed user measurements: {user_processed}", file=sys.stderr)
+    debug("Processed user measurements: %s", user_processed)
     
     # Convert product measurements to inches (they might be strings)
     product_inches = {}
@@ -267,21 +281,14 @@ def recommend_size_from_measurements(user_measurements: Dict[str, float],
             except (ValueError, TypeError):
                 continue
     
-    print(f"User measurements in inches: {user_processed}", file=sys.stderr)
-    print(f"Product measurements in inches: {product_inches}", file=sys.stderr)
+    debug("User measurements in inches: %s", user_processed)
+    debug("Product measurements in inches: %s", product_inches)
     
-    # Weights for different measurements
-    weights = {
-        'waist': 3.0,
-        'hip': 3.0,
-        'bust': 2.0,
-        'chest': 2.0,
-        'length': 1.0
-    }
+    weights = dict(SIZE_WEIGHTS)
     
     size_distances = {}
     for size, size_data in product_inches.items():
-        print(f"\nEvaluating size {size} with measurements: {size_data}", file=sys.stderr)
+        debug("\nEvaluating size %s with measurements: %s", size, size_data)
         
         measurement_distance = 0.0
         total_weight = 0.0
@@ -295,12 +302,12 @@ def recommend_size_from_measurements(user_measurements: Dict[str, float],
                 differences[key] = diff
                 measurement_distance += weight * diff
                 total_weight += weight
-                print(f"{key}: User={user_value:.2f}in, Product={product_value:.2f}in, Diff={diff:.2f}in", file=sys.stderr)
+                debug("%s: User=%.2fin, Product=%.2fin, Diff=%.2fin", key, user_value, product_value, diff)
         
         if total_weight > 0:
             measurement_distance /= total_weight
-            print(f"Measurement distance for size {size}: {measurement_distance}", file=sys.stderr)
-            print(f"Individual differences: {differences}", file=sys.stderr)
+            debug("Measurement distance for size %s: %s", size, measurement_distance)
+            debug("Individual differences: %s", differences)
             
             # Modified confidence calculation to ensure it's never zero
             # At most 6 inches difference would give 0% confidence
@@ -316,11 +323,32 @@ def recommend_size_from_measurements(user_measurements: Dict[str, float],
         raise ValueError("Could not calculate size distances")
     
     best_size = min(size_distances.items(), key=lambda x: x[1][0])
-    print(f"\nBest size: {best_size[0]} with distance {best_size[1][0]} and confidence {best_size[1][1]}", file=sys.stderr)
+    debug("\nBest size: %s with distance %s and confidence %s", best_size[0], best_size[1][0], best_size[1][1])
     
     return best_size[0], best_size[1][1]
 
 
+def product_size_chart(product: Dict, strict: bool = False) -> Dict[str, Dict[str, Any]]:
+    """Parse a product record's size chart into {size: {measurement: value}}.
+
+    A chart that cannot be parsed comes back empty, or with strict raises the parse error.
+    """
+    parse = parse_size_chart if strict else parse_measurements
+    product_sizes = {}
+    if "sizes_with_measurements" in product:
+        product_sizes = parse(product["sizes_with_measurements"])
+    elif "sizes" in product:
+        if isinstance(product["sizes"], dict):
+            product_sizes = product["sizes"]
+        elif isinstance(product["sizes"], list):
+            # Use the available sizes from the catalog.
+            # Assume the product record contains base measurement keys (e.g., bust, waist, hips, etc.)
+            base_data = { key: product[key] for key in product if key.lower() in ["bust", "waist", "hips", "chest", "ptp", "shoulder"] }
+            flat_data = { **base_data, "sizes": product["sizes"] }
+            product_sizes = parse(json.dumps(flat_data))
+    return product_sizes
+
+
 def fallback_size_recommendation(user_height: float, user_weight: float) -> Dict[str, Any]:
     """Fallback size recommendation based on height and weight only"""
     print("ERROR: Fallback size recommendation is disabled", file=sys.stderr)
@@ -332,36 +360,41 @@ def get_size_recommendation(user_height: float,
                             user_measurements: Dict[str, float],
                             product: Dict) -> Dict[str, Any]:
     """Main function to get size recommendation"""
-    print(f"Getting size recommendation for height={user_height}, weight={user_weight}", file=sys.stderr)
-    print(f"User measurements: {user_measurements}", file=sys.stderr)
-    print(f"Product data: {product}", file=sys.stderr)
+    debug("Getting size recommendation for height=%s, weight=%s", user_height, user_weight)
+    debug("User measurements: %s", user_measurements)
+    debug("Product data: %s", product)
     
     try:
-        # Parse product size measurements
-        product_sizes = {}
-        if "sizes_with_measurements" in product:
-            product_sizes = parse_measurements(product["sizes_with_measurements"])
-        elif "sizes" in product:
-            if isinstance(product["sizes"], dict):
-                product_sizes = product["sizes"]
-            elif isinstance(product["sizes"], list):
-                # Use the available sizes from the catalog.
-                # Assume the product record contains base measurement keys (e.g., bust, waist, hips, etc.)
-                base_data = { key: product[key] for key in product if key.lower() in ["bust", "waist", "hips", "chest", "ptp", "shoulder"] }
-                flat_data = { **base_data, "sizes": product["sizes"] }
-                product_sizes = parse_measurements(json.dumps(flat_data))
-        print(f"Parsed product sizes: {product_sizes}", file=sys.stderr)
-        
-        if not product_sizes:
-            print("ERROR: No product size information available", file=sys.stderr)
-            raise ValueError("Product has no size measurement data")
+        # Use the precompiled chart unless the product's chart fields changed since it was built
+        from size_chart_store import compiled_size_charts
+        with stage('chart_lookup'):
+            compiled = compiled_size_charts()
+            use_compiled = compiled is not None and compiled.is_current(product)
+        if use_compiled:
+            debug("Using compiled size chart for product %s", product['product_id'])
+            product_sizes = None
+            increment('recommender_size_charts_total', source='compiled')
+        else:
+            compiled = None
+            with stage('chart_parse'):
+                product_sizes = product_size_chart(product)
+            debug("Parsed product sizes: %s", product_sizes)
+            increment('recommender_size_charts_total', source='parsed')
+            
+            if not product_sizes:
+                print("ERROR: No product size information available", file=sys.stderr)
+                raise ValueError("Product has no size measurement data")
         
         if not user_measurements:
             print("ERROR: User measurements required for size recommendation", file=sys.stderr)
             raise ValueError("User measurements required")
         
         try:
-            recommended_size, confidence = recommend_size_from_measurements(user_measurements, product_sizes)
+            with stage('size_score'):
+                if compiled is not None:
+                    recommended_size, confidence = compiled.recommend_size(product['product_id'], user_measurements)
+                else:
+                    recommended_size, confidence = recommend_size_from_measurements(user_measurements, product_sizes)
             return {
                 "recommended_size": recommended_size,
                 "confidence": confidence,
@@ -373,6 +406,7 @@ def get_size_recommendation(user_height: float,
         
     except Exception as e:
         print(f"ERROR: get_size_recommendation failed: {e}", file=sys.stderr)
+        increment('recommender_errors_total', stage='size')
         raise ValueError(f"Size recommendation failed: {str(e)}")
 
 
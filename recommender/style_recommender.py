@@ -11,15 +11,26 @@ import argparse
 import sys
 import os
 import time
-from typing import List, Dict, Any, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 from supabase import create_client
 from dotenv import load_dotenv
 
+from ann_index import load_index
+from attribute_index import FILTER_KEYS, attribute_index_version, load_attribute_index, normalize_terms
+from embedding_cache import query_cache
+from materialized import recommendation_store, user_fingerprint
+from metrics import debug, increment, stage
+from model_registry import model_registry
+from neighbour_graph import load_neighbour_graph
+from onnx_encoder import load_encoder
+from preference_vectors import ONLINE_WEIGHT, preference_store
+from product_cache import get_supabase_client, product_cache
+from user_adapters import adapter_path
+from vector_store import MODELS_DIR, catalog_version, load_product_vectors
+
 try:
     from supabase import create_client, Client
 except ImportError:
@@ -58,9 +69,9 @@ def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
         return None
     try:
         print(f"Connecting to Supabase for user ID: {user_id}", file=sys.stderr)
-        supabase: Client = create_client(url, key)
+        supabase: Client = get_supabase_client()
         response = supabase.table("profiles").select("*").eq("user_id", user_id).execute()
-        print(f"Got response: {response}", file=sys.stderr)
+        debug("Got response: %s", response)
         data = response.data
         if not data:
             print(f"No profile found for user ID: {user_id}", file=sys.stderr)
@@ -72,170 +83,321 @@ def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
         return None
 
 
+def format_recommendation(product_id: str, score: float, product: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """One recommendation entry; only the ID and score if details are unavailable."""
+    if product is None:
+        return {'product_id': product_id, 'score': float(score)}
+    return {
+        'product_id': product_id,
+        'score': float(score),
+        'name': product.get('name') or '',
+        'description': product.get('description') or '',
+        'category': product.get('category') or '',
+        'image_url': product.get('image_url') or '',
+        'price': float(product.get('price') or 0),
+        'material': product.get('material') or ''
+    }
+
+
+def current_catalog_version() -> str:
+    """Identify the product vectors and attribute index that recommendations are computed from."""
+    return f"{catalog_version()}|{attribute_index_version()}"
+
+
 class StyleRecommender:
-    def __init__(self, embeddings_path=None, user_id=None):
-        """Initialize the style recommender with product embeddings."""
+    def __init__(self, embeddings_path=None, user_id=None, base=None):
+        """Initialize the style recommender with product embeddings.
+
+        If ``base`` is another StyleRecommender, its loaded model and product
+        embeddings are reused instead of being loaded again.
+        """
         self.user_id = user_id
+        self.user_embeddings = None
+        self.user_texts = None
+        self.adapter = None
+        self._rows = None
+        if base is not None:
+            self.model = base.model
+            self.model_key = base.model_key
+            self.product_ids = base.product_ids
+            self.product_embeddings = base.product_embeddings
+            self.index = base.index
+            self.attributes = base.attributes
+            self.neighbours = base.neighbours
+            self.catalog_version = base.catalog_version
+        else:
+            self._load_base()
+
+        # User models come from the shared registry, which keeps recently used
+        # ones resident. Adapters run on the base model; users trained before
+        # adapters existed still get their full model.
+        if user_id:
+            user_model = model_registry.get(user_id)
+            if user_model is None:
+                print(f"[RECOMMEND] No user model found for {user_id}", file=sys.stderr)
+                return
+            self.adapter = user_model.adapter
+            self.user_embeddings = user_model.user_embeddings
+            self.user_texts = user_model.user_texts
+            if user_model.model is not None:
+                self.model = user_model.model
+                self.model_key = user_model.model_key
+
+    def _load_base(self):
+        """Load the default model and the precomputed product embeddings."""
         try:
             print(f"[RECOMMEND] Initializing style recommender with default model", file=sys.stderr)
-            self.model = SentenceTransformer('all-MiniLM-L6-v2')
+            # RECOMMENDER_ENCODER selects PyTorch or an exported ONNX graph
+            with stage('model_load'):
+                self.model, self.model_key = load_encoder()
             print(f"[RECOMMEND] Default model loaded successfully", file=sys.stderr)
         except Exception as e:
             print(f"[RECOMMEND] Error loading default model: {str(e)}", file=sys.stderr)
             sys.exit(1)
 
-        # Load product embeddings and IDs
+        # Load the memory-mapped product vector store (or the legacy .npy files)
         try:
-            print(f"[RECOMMEND] Loading product embeddings from recommender/models/", file=sys.stderr)
-            self.product_ids = np.load('recommender/models/product_ids.npy', allow_pickle=True)
-            self.product_embeddings = np.load('recommender/models/product_embeddings.npy')
+            print(f"[RECOMMEND] Loading product embeddings from {MODELS_DIR}", file=sys.stderr)
+            self.catalog_version = current_catalog_version()
+            with stage('catalog_load'):
+                self.product_ids, self.product_embeddings, normalized = load_product_vectors()
             print(f"[RECOMMEND] Loaded {len(self.product_ids)} product embeddings with shape {self.product_embeddings.shape}", file=sys.stderr)
         except Exception as e:
             print(f"[RECOMMEND] Error loading product embeddings: {str(e)}", file=sys.stderr)
             sys.exit(1)
 
-        # Load user-specific model and embeddings if available
-        if user_id:
-            user_model_dir = f"recommender/models/{user_id}_model"
-            if os.path.exists(user_model_dir):
-                print(f"[RECOMMEND] Loading user model from: {user_model_dir}", file=sys.stderr)
-                try:
-                    self.model = SentenceTransformer(user_model_dir)
-                    print(f"[RECOMMEND] Successfully loaded user model from {user_model_dir}", file=sys.stderr)
-                except Exception as e:
-                    print(f"[RECOMMEND] Error loading model from {user_model_dir}: {str(e)}", file=sys.stderr)
-                    print(f"[RECOMMEND] Falling back to default model", file=sys.stderr)
-                    self.model = SentenceTransformer('all-MiniLM-L6-v2')
-                
-                # Load user embeddings if available
-                user_embeddings_path = os.path.join(user_model_dir, "embeddings.npy")
-                if os.path.exists(user_embeddings_path):
-                    try:
-                        print("[RECOMMEND] Loading user embeddings", file=sys.stderr)
-                        self.user_embeddings = np.load(user_embeddings_path)
-                        self.user_texts = np.load(os.path.join(user_model_dir, "texts.npy"))
-                        print(f"[RECOMMEND] Loaded {len(self.user_embeddings)} user embeddings", file=sys.stderr)
-                    except Exception as e:
-                        print(f"[RECOMMEND] Error loading user embeddings: {str(e)}", file=sys.stderr)
-                        self.user_embeddings = None
-                        self.user_texts = None
-                else:
-                    print("[RECOMMEND] No user embeddings found", file=sys.stderr)
-                    self.user_embeddings = None
-                    self.user_texts = None
-            else:
-                print(f"[RECOMMEND] No user model found for {user_id}", file=sys.stderr)
-                self.user_embeddings = None
-                self.user_texts = None
+        with stage('index_load'):
+            self.index = load_index(self.product_embeddings, normalized=normalized, product_ids=self.product_ids)
+            self.attributes = load_attribute_index(self.product_ids)
+            self.neighbours = load_neighbour_graph(self.product_ids)
+
+    def _product_id(self, idx) -> str:
+        product_id = self.product_ids[idx]
+        return product_id.decode('ascii') if isinstance(product_id, bytes) else str(product_id)
+
+    def product_row(self, product_id: str) -> Optional[int]:
+        """Vector store row of a product, or None if it is not in the catalog."""
+        if self._rows is None:
+            self._rows = {self._product_id(row): row for row in range(len(self.product_ids))}
+        return self._rows.get(product_id)
+
+    def preference(self):
+        """The user's online preference vector, read fresh so the latest swipe counts."""
+        return read_preference(self.user_id)
+
+    def _filter_rows(self, materials=None, filters=None):
+        """Rows allowed by the attribute filters, or None to search every product.
+
+        filters may constrain material, category, tag, colour, min_price and
+        max_price. Material preferences narrow the search to products made of
+        them, unless filters name materials or the catalog has none of them.
+        """
+        filters = dict(filters or {})
+        if materials and not filters.get('material') and self.attributes is not None:
+            known = self.attributes.postings['material']
+            preferred = [term for term in normalize_terms(materials) if term in known]
+            if preferred:
+                filters['material'] = preferred
+        if not any(filters.get(key) is not None for key in FILTER_KEYS):
+            return None
+        if self.attributes is None:
+            print("[RECOMMEND] No attribute index; ignoring filters", file=sys.stderr)
+            return None
+        return self.attributes.filter(filters)
+
+    def encode(self, query) -> np.ndarray:
+        """Encode each preference (cached strings skip the model) and average them."""
+        debug("[RECOMMEND] Encoding query: %.50s...", query)
+        with stage('encode'):
+            return np.mean(query_cache.encode(self.model, query, self.model_key), axis=0)
+
+    def query_vector(self, encoded=None, preference=None) -> Optional[np.ndarray]:
+        """The search vector from the encoded query or the user's embeddings, adapted and blended.
 
-    def recommend(self, query=None, materials=None, top_k=10):
-        """Generate recommendations based on query and materials."""
+        Returns None if there is nothing to search with.
+        """
+        if encoded is not None:
+            query_embedding = encoded
+        elif self.user_embeddings is not None:
+            # Use average of user embeddings as query
+            debug("[RECOMMEND] Using average of %d user embeddings as query", len(self.user_embeddings))
+            query_embedding = np.mean(self.user_embeddings, axis=0)
+        elif preference is not None:
+            # Only swipes so far: their preference vector is the query
+            debug("[RECOMMEND] Using preference vector from %d swipes as query", preference.swipes)
+            query_embedding, preference = preference.vector, None
+        else:
+            return None
+
+        if self.adapter is not None:
+            query_embedding = self.adapter.apply(query_embedding)
+        if preference is not None:
+            query_embedding = preference.blend(query_embedding, ONLINE_WEIGHT)
+        return query_embedding
+
+    def search(self, query_embedding: np.ndarray, materials=None, top_k=10, filters=None) -> List[Tuple[str, float]]:
+        """(product ID, score) of the top_k products allowed by the filters, best first."""
+        rows = self._filter_rows(materials, filters)
+        if rows is not None and not len(rows):
+            debug("[RECOMMEND] No products match the filters")
+            return []
+
+        # Search the index for the top-k most similar products (timed per stage by the index)
+        debug("[RECOMMEND] Searching %s index over %d products", self.index.kind,
+              len(self.index) if rows is None else len(rows))
+        top_indices, top_scores = self.index.search(query_embedding, top_k, rows=rows)
+        debug("[RECOMMEND] Top %d indices: %s", len(top_indices), top_indices.tolist())
+        return [(self._product_id(idx), score) for idx, score in zip(top_indices.tolist(), top_scores.tolist())
+                if score > -1]
+
+    def details(self, ranked: List[Tuple[str, float]]) -> List[Dict[str, Any]]:
+        """Recommendation entries for ranked products, with details where they can be fetched."""
+        # Get product details for recommendations from the local cache;
+        # only products missing from it are fetched from Supabase
+        product_details = {}
+        if ranked:
+            try:
+                with stage('detail_fetch'):
+                    product_details = product_cache.fetch([product_id for product_id, _ in ranked],
+                                                          get_supabase_client())
+                debug("[RECOMMEND] Got details for %d of %d products", len(product_details), len(ranked))
+            except Exception as e:
+                # Return basic recommendations if product details fetch fails
+                print(f"[RECOMMEND] Error getting product details: {str(e)}", file=sys.stderr)
+        return [format_recommendation(product_id, score, product_details.get(product_id))
+                for product_id, score in ranked]
+
+    def similar(self, product_id: str, top_k=10, filters=None) -> Optional[List[Dict[str, Any]]]:
+        """Products most like the given one, or None if it is not in the catalog.
+
+        Served from the precomputed neighbour graph; filtered requests, and
+        ones for more neighbours than the graph keeps, search the index with
+        the product's own embedding instead.
+        """
+        row = self.product_row(product_id)
+        if row is None:
+            return None
+        if self.neighbours is not None and not filters and top_k <= self.neighbours.k:
+            with stage('neighbour_lookup'):
+                rows, scores = self.neighbours.lookup(row, top_k)
+            increment('recommender_similar_total', source='graph')
+        else:
+            allowed = self._filter_rows(filters=filters)
+            if allowed is not None and not len(allowed):
+                return []
+            rows, scores = self.index.search(self.index.embeddings[row], top_k + 1, rows=allowed)
+            keep = rows != row
+            rows, scores = rows[keep][:top_k], scores[keep][:top_k]
+            increment('recommender_similar_total', source='search')
+        return self.details([(self._product_id(idx), score) for idx, score in zip(rows.tolist(), scores.tolist())])
+
+    def recommend(self, query=None, materials=None, top_k=10, filters=None):
+        """Generate recommendations based on query, materials and attribute filters."""
         try:
-            # Encode the query
-            if query:
-                print(f"[RECOMMEND] Encoding query: {str(query)[:50]}...", file=sys.stderr)
-                # Encode each preference and average them
-                query_embeddings = self.model.encode(query)
-                query_embedding = np.mean(query_embeddings, axis=0)
-                print(f"[RECOMMEND] Query encoded successfully with shape {query_embedding.shape}", file=sys.stderr)
-            elif self.user_embeddings is not None:
-                # Use average of user embeddings as query
-                print(f"[RECOMMEND] Using average of {len(self.user_embeddings)} user embeddings as query", file=sys.stderr)
-                query_embedding = np.mean(self.user_embeddings, axis=0)
-                print(f"[RECOMMEND] User embedding mean shape: {query_embedding.shape}", file=sys.stderr)
-            else:
+            preference = self.preference()
+            query_embedding = self.query_vector(self.encode(query) if query else None, preference)
+            if query_embedding is None:
                 print("[RECOMMEND] No query or user embeddings available", file=sys.stderr)
                 return []
-
-            # Calculate similarity scores
-            print(f"[RECOMMEND] Product embeddings shape: {self.product_embeddings.shape}", file=sys.stderr)
-            scores = cosine_similarity([query_embedding], self.product_embeddings)[0]
-            print(f"[RECOMMEND] Calculated similarity scores, min: {min(scores)}, max: {max(scores)}", file=sys.stderr)
-
-            # Get top-k recommendations
-            top_indices = np.argsort(scores)[-top_k:][::-1]
-            print(f"[RECOMMEND] Top {len(top_indices)} indices: {top_indices}", file=sys.stderr)
-            recommendations = []
-            
-            # Get product details for recommendations
-            product_ids = [str(self.product_ids[idx]) for idx in top_indices if scores[idx] > -1]
-            print(f"[RECOMMEND] Found {len(product_ids)} product IDs to fetch details for", file=sys.stderr)
-            if product_ids:
-                # Get Supabase client
-                supabase_url = os.getenv("NEXT_PUBLIC_SUPABASE_URL")
-                supabase_key = os.getenv("NEXT_PUBLIC_SUPABASE_ANON_KEY")
-                print(f"[RECOMMEND] Supabase URL: {supabase_url}", file=sys.stderr)
-                print(f"[RECOMMEND] Supabase Key: {supabase_key and 'Set' or 'Not set'}", file=sys.stderr)
-                if not supabase_url or not supabase_key:
-                    print("[RECOMMEND] Supabase environment variables not set", file=sys.stderr)
-                    # Return basic recommendations without details
-                    for idx in top_indices:
-                        if scores[idx] > -1:
-                            recommendations.append({
-                                'product_id': str(self.product_ids[idx]),
-                                'score': float(scores[idx])
-                            })
-                    return recommendations
-
-                try:
-                    print(f"[RECOMMEND] Creating Supabase client with URL: {supabase_url}", file=sys.stderr)
-                    supabase = create_client(supabase_url, supabase_key)
-                    print("[RECOMMEND] Supabase client created successfully", file=sys.stderr)
-                except Exception as e:
-                    print(f"[RECOMMEND] Error creating Supabase client: {str(e)}", file=sys.stderr)
-                    raise
-                
-                # Get product details
-                try:
-                    print(f"[RECOMMEND] Fetching product details from Supabase for {len(product_ids)} products", file=sys.stderr)
-                    product_details = supabase.table('products').select('*').in_('product_id', product_ids).execute()
-                    product_details = {str(item['product_id']): item for item in product_details.data}
-                    print(f"[RECOMMEND] Got details for {len(product_details)} products", file=sys.stderr)
-
-                    for idx in top_indices:
-                        if scores[idx] > -1:  # Only include products that weren't filtered out
-                            product_id = str(self.product_ids[idx])
-                            if product_id in product_details:
-                                product = product_details[product_id]
-                                recommendations.append({
-                                    'product_id': product_id,
-                                    'score': float(scores[idx]),
-                                    'name': product.get('name', ''),
-                                    'description': product.get('description', ''),
-                                    'category': product.get('category', ''),
-                                    'image_url': product.get('image_url', ''),
-                                    'price': float(product.get('price', 0)),
-                                    'material': product.get('material', '')
-                                })
-                            else:
-                                # If product details not found, add basic info
-                                recommendations.append({
-                                    'product_id': product_id,
-                                    'score': float(scores[idx])
-                                })
-                except Exception as e:
-                    print(f"[RECOMMEND] Error getting product details: {str(e)}", file=sys.stderr)
-                    # Return basic recommendations if product details fetch fails
-                    for idx in top_indices:
-                        if scores[idx] > -1:
-                            recommendations.append({
-                                'product_id': str(self.product_ids[idx]),
-                                'score': float(scores[idx])
-                            })
-
-            return recommendations
+            return self.details(self.search(query_embedding, materials, top_k, filters))
 
         except Exception as e:
             print(f"[RECOMMEND] Error during recommendation: {str(e)}", file=sys.stderr)
+            increment('recommender_errors_total', stage='recommend')
             return []
 
 
+def read_preference(user_id: Optional[str]):
+    """The user's online preference vector, or None if they have none or it cannot be read."""
+    if not user_id or preference_store is None:
+        return None
+    try:
+        return preference_store.get(user_id)
+    except Exception as e:
+        print(f"[RECOMMEND] Could not read preference vector: {str(e)}", file=sys.stderr)
+        return None
+
+
+def stored_recommendations(user_id: str, user_preferences: List[str], user_materials: List[str], limit: int,
+                           catalog: Optional[str] = None) -> Tuple[str, Optional[List[Dict[str, Any]]]]:
+    """The user's fingerprint and their materialised list, if it is current."""
+    fingerprint = user_fingerprint(user_id, user_preferences, user_materials,
+                                   catalog if catalog is not None else current_catalog_version())
+    try:
+        stored = recommendation_store.get(user_id, fingerprint, limit)
+    except Exception as e:
+        print(f"[RECOMMEND] Could not read materialised recommendations: {str(e)}", file=sys.stderr)
+        stored = None
+    if stored is not None:
+        debug("[RECOMMEND] Serving materialised recommendations for user %s", user_id)
+        increment('recommender_materialized_total', result='hit')
+    else:
+        increment('recommender_materialized_total', result='miss')
+    return fingerprint, stored
+
+
+def store_recommendations(user_id: str, fingerprint: str, limit: int, recommendations: List[Dict[str, Any]]):
+    """Materialise a freshly computed list; empty lists are not stored."""
+    if not recommendations:
+        return
+    try:
+        recommendation_store.put(user_id, fingerprint, limit, recommendations)
+    except Exception as e:
+        print(f"[RECOMMEND] Could not store materialised recommendations: {str(e)}", file=sys.stderr)
+
+
+def recommend_for_user(make_recommender: Callable[[], 'StyleRecommender'], user_id: Optional[str],
+                       user_preferences: List[str], user_materials: List[str], limit: int,
+                       catalog: Optional[str] = None,
+                       filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Serve the user's materialised list if it is current, else compute and store it.
+
+    The recommender is only created on a miss, so a hit never loads a model.
+    Requests with attribute filters are always computed, never stored.
+    """
+    if not user_id or recommendation_store is None or filters:
+        return make_recommender().recommend(query=user_preferences or None, materials=user_materials,
+                                            top_k=limit, filters=filters) or []
+
+    fingerprint, stored = stored_recommendations(user_id, user_preferences, user_materials, limit, catalog)
+    if stored is not None:
+        return stored
+
+    recommendations = make_recommender().recommend(query=user_preferences or None, materials=user_materials,
+                                                   top_k=limit) or []
+    store_recommendations(user_id, fingerprint, limit, recommendations)
+    return recommendations
+
+
+def build_results(recommendations: List[Dict[str, Any]],
+                  user_id: Optional[str],
+                  user_preferences: List[str],
+                  user_materials: List[str]) -> Dict[str, Any]:
+    """Wrap recommendations in the JSON payload the API routes expect."""
+    return {
+        "data": recommendations,
+        "count": len(recommendations),
+        "recommendations": recommendations,
+        "metadata": {
+            "user_id": user_id,
+            "user_preferences": user_preferences,
+            "user_materials": user_materials,
+            "is_personalized": bool(user_id and (os.path.exists(adapter_path(user_id)) or
+                                                 os.path.exists(os.path.join(MODELS_DIR, f"{user_id}_model"))))
+        }
+    }
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Get style recommendations')
     parser.add_argument('--user_preferences', type=str, help='User style preferences as JSON array of strings')
     parser.add_argument('--user_materials', type=str, help='User material preferences as JSON array of strings')
     parser.add_argument('--user_id', type=str, help='User ID to fetch profile from Supabase')
     parser.add_argument('--limit', type=int, default=5, help='Number of recommendations to return')
+    parser.add_argument('--filters', type=str,
+                        help='Attribute filters as a JSON object: material, category, tag, colour, min_price, max_price')
+    parser.add_argument('--product_id', type=str, help='Recommend products similar to this one')
+    parser.add_argument('--product_data', type=str, help='Product as a JSON object; its product_id is used as --product_id')
     
     args = parser.parse_args()
     
@@ -255,33 +417,37 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"Error parsing user materials: {e}", file=sys.stderr)
     
-    # If product_data is provided, use the embedding model to find similar items
-    if args.__dict__.get('product_data'):
+    filters = None
+    if args.filters:
+        try:
+            filters = json.loads(args.filters)
+        except Exception as e:
+            print(f"Error parsing filters: {e}", file=sys.stderr)
+
+    product_id = args.product_id
+    if args.product_data:
+        try:
+            product_id = product_id or json.loads(args.product_data).get('product_id')
+        except Exception as e:
+            print(f"Error parsing product data: {e}", file=sys.stderr)
+
+    # With a product, recommend products like it from the neighbour graph
+    recommendations = None
+    if product_id:
         try:
-            product_data = json.loads(args.__dict__.get('product_data'))
-            product_id = product_data.get('product_id')
-            
             print(f"Getting style recommendations for product {product_id}", file=sys.stderr)
-            
-            # Initialize the recommender with user_id if available
-            recommender = StyleRecommender(user_id=args.user_id)
-            
-            # Use the embedding-based recommender always
-            recommendations = recommender.recommend(
-                query=user_preferences,
-                materials=user_materials,
-                top_k=args.limit
-            )
-            
-            print(f"Generated {len(recommendations)} recommendations using {'personalized' if recommender.user_id else 'default'} model", file=sys.stderr)
+            recommendations = StyleRecommender().similar(str(product_id), top_k=args.limit, filters=filters)
+            if recommendations is None:
+                print(f"Product {product_id} is not in the catalog; using preferences instead", file=sys.stderr)
+            else:
+                print(f"Generated {len(recommendations)} recommendations similar to product {product_id}", file=sys.stderr)
         except Exception as e:
             print(f"Error in style recommendation: {e}", file=sys.stderr)
             sys.exit(1)
-    else:
+
+    if recommendations is None:
         print(f"Getting general style recommendations for user {args.user_id or 'unknown'}", file=sys.stderr)
         try:
-            recommender = StyleRecommender(user_id=args.user_id)
-            
             # Process user preferences
             query_input = None
             if user_preferences:
@@ -290,10 +456,13 @@ if __name__ == "__main__":
                     query_input = user_preferences
                     print(f"Using {len(user_preferences)} style preferences as query", file=sys.stderr)
 
-            recommendations = recommender.recommend(
-                query=query_input,
-                materials=user_materials,
-                top_k=args.limit
+            recommendations = recommend_for_user(
+                lambda: StyleRecommender(user_id=args.user_id),
+                args.user_id,
+                query_input or [],
+                user_materials,
+                args.limit,
+                filters=filters
             )
             
             # Ensure we always have at least an empty list for recommendations
@@ -301,7 +470,7 @@ if __name__ == "__main__":
                 print(f"Warning: recommendations is None, setting to empty list", file=sys.stderr)
                 recommendations = []
                 
-            print(f"Generated {len(recommendations)} recommendations using {'personalized' if recommender.user_id else 'default'} model", file=sys.stderr)
+            print(f"Generated {len(recommendations)} recommendations using {'personalized' if args.user_id else 'default'} model", file=sys.stderr)
         except Exception as e:
             print(f"Error in style recommendation: {e}", file=sys.stderr)
             # Even on error, return a valid JSON response
@@ -318,17 +487,8 @@ if __name__ == "__main__":
             print(json.dumps(results))
             sys.exit(1)
     
-    results = {
-        "data": recommendations,
-        "count": len(recommendations),
-        "recommendations": recommendations,
-        "metadata": {
-            "user_id": args.user_id,
-            "user_preferences": user_preferences,
-            "user_materials": user_materials,
-            "is_personalized": bool(args.user_id and os.path.exists(os.path.join('recommender/models', f"{args.user_id}_model")))
-        }
-    }
+    results = build_results(recommendations, args.user_id, user_preferences, user_materials)
+    query_cache.save()
     
     # Only output the JSON to stdout
     print(json.dumps(results))
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+"""
+training_queue.py
+
+Persistent, coalescing queue of user adapter training jobs.
+
+The style-interaction routes used to spawn a training process for every
+retrain, with no limit on how many ran at once: a user swiping quickly
+started overlapping runs that competed for the same CPUs and wrote the same
+adapter file. Now a retrain is a row in a local SQLite queue:
+
+    - a user has at most one pending job; enqueueing again while one is
+      pending replaces its interactions with the newer ones (coalescing)
+    - one scheduler per queue (held with a lock file) runs jobs on a process
+      pool of --workers processes, each loading the base encoder once
+    - a user's job never runs while another of theirs is running
+    - adapters are written to a temporary file and renamed into place
+
+Enqueue a job (or let POST /training/jobs on the service do it) and run the
+scheduler in its own process, or inside the service with
+RECOMMENDER_TRAINING_WORKERS:
+
+    python recommender/training_queue.py enqueue <user_id> --liked '["..."]'
+    python recommender/training_queue.py worker --workers 2
+    python recommender/training_queue.py stats
+
+A job without interactions reads the user's style_interactions from Supabase
+when it runs. RECOMMENDER_TRAINING_DB sets the queue file.
+"""
+
+import argparse
+import fcntl
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from metrics import increment, metrics
+from user_adapters import DEFAULT_RANK, MODELS_DIR
+
+DEFAULT_DB_PATH = os.path.join(MODELS_DIR, 'training_queue.sqlite')
+DEFAULT_WORKERS = 2
+# Finished jobs kept for latency statistics and inspection
+DEFAULT_HISTORY = 1000
+POLL_SECONDS = 0.5
+
+metrics.describe('recommender_training_seconds', 'Training job time spent queued (wait) and running (run)')
+
+
+class TrainingQueue:
+    """SQLite table of training jobs with at most one pending job per user."""
+
+    def __init__(self, path: str = DEFAULT_DB_PATH, history: int = DEFAULT_HISTORY):
+        self.path = path
+        self.history = history
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('''CREATE TABLE IF NOT EXISTS training_jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                user_id TEXT NOT NULL,
+                                status TEXT NOT NULL,
+                                payload TEXT NOT NULL,
+                                coalesced INTEGER NOT NULL DEFAULT 0,
+                                enqueued_at REAL NOT NULL,
+                                started_at REAL,
+                                finished_at REAL,
+                                error TEXT)''')
+            conn.execute('''CREATE UNIQUE INDEX IF NOT EXISTS training_jobs_pending
+                                ON training_jobs(user_id) WHERE status = 'pending' ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS training_jobs_status ON training_jobs(status, id)')
+            self._conn = conn
+        return self._conn
+
+    def enqueue(self, user_id: str, payload: Optional[Dict[str, Any]] = None) -> int:
+        """Queue a job for the user, merging it into their pending job if they have one.
+
+        The job keeps its place in the queue (its original enqueue time) but
+        takes the newer payload.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute("SELECT id FROM training_jobs WHERE user_id = ? AND status = 'pending'",
+                                   (user_id,)).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE training_jobs SET payload = ?, coalesced = coalesced + 1 WHERE id = ?',
+                                 (json.dumps(payload or {}), row[0]))
+                    job_id = row[0]
+                else:
+                    job_id = conn.execute(
+                        "INSERT INTO training_jobs (user_id, status, payload, enqueued_at) VALUES (?, 'pending', ?, ?)",
+                        (user_id, json.dumps(payload or {}), time.time())).lastrowid
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        increment('recommender_training_jobs_total', result='coalesced' if row is not None else 'enqueued')
+        return job_id
+
+    def claim(self, limit: int) -> List[Dict[str, Any]]:
+        """Mark up to limit of the oldest pending jobs running, skipping users already running."""
+        if limit <= 0:
+            return []
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute(
+                    "SELECT id, user_id, payload, enqueued_at FROM training_jobs WHERE status = 'pending' "
+                    "AND user_id NOT IN (SELECT user_id FROM training_jobs WHERE status = 'running') "
+                    "ORDER BY id LIMIT ?", (limit,)).fetchall()
+                now = time.time()
+                conn.executemany("UPDATE training_jobs SET status = 'running', started_at = ? WHERE id = ?",
+                                 [(now, row[0]) for row in rows])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return [{'id': job_id, 'user_id': user_id, 'payload': json.loads(payload),
+                 'enqueued_at': enqueued_at, 'started_at': now}
+                for job_id, user_id, payload, enqueued_at in rows]
+
+    def finish(self, job_id: int, error: Optional[str] = None):
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('UPDATE training_jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?',
+                             ('failed' if error else 'done', time.time(), error, job_id))
+                conn.execute("DELETE FROM training_jobs WHERE status IN ('done', 'failed') AND id <= ("
+                             "SELECT id FROM training_jobs WHERE status IN ('done', 'failed') "
+                             "ORDER BY id DESC LIMIT 1 OFFSET ?)", (self.history,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def requeue_running(self) -> int:
+        """Return jobs left running by a scheduler that died to the queue.
+
+        Only called by the scheduler holding the queue lock, so every running
+        job is abandoned. A user who has since been queued again keeps the
+        newer pending job.
+        """
+        with self._lock:
+            conn = self._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute("SELECT id, user_id FROM training_jobs WHERE status = 'running'").fetchall()
+                for job_id, user_id in rows:
+                    pending = conn.execute("SELECT 1 FROM training_jobs WHERE user_id = ? AND status = 'pending'",
+                                           (user_id,)).fetchone()
+                    if pending is None:
+                        conn.execute("UPDATE training_jobs SET status = 'pending', started_at = NULL WHERE id = ?",
+                                     (job_id,))
+                    else:
+                        conn.execute("UPDATE training_jobs SET status = 'failed', finished_at = ?, "
+                                     "error = 'abandoned; superseded by a newer job' WHERE id = ?",
+                                     (time.time(), job_id))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return len(rows)
+
+    def pending(self) -> int:
+        """Number of jobs waiting to run."""
+        with self._lock:
+            return self._connection().execute(
+                "SELECT COUNT(*) FROM training_jobs WHERE status = 'pending'").fetchone()[0]
+
+    def job(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT id, user_id, status, coalesced, enqueued_at, started_at, finished_at, error '
+                'FROM training_jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'user_id', 'status', 'coalesced', 'enqueued_at', 'started_at', 'finished_at', 'error')
+        return dict(zip(keys, row))
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth by status and wait/run latency percentiles of recent jobs."""
+        with self._lock:
+            conn = self._connection()
+            counts = dict(conn.execute('SELECT status, COUNT(*) FROM training_jobs GROUP BY status').fetchall())
+            times = np.array(conn.execute(
+                "SELECT started_at - enqueued_at, finished_at - started_at FROM training_jobs "
+                "WHERE status = 'done' ORDER BY id DESC LIMIT 100").fetchall(), dtype=np.float64)
+            oldest = conn.execute("SELECT MIN(enqueued_at) FROM training_jobs WHERE status = 'pending'").fetchone()[0]
+        stats: Dict[str, Any] = {status: counts.get(status, 0) for status in ('pending', 'running', 'done', 'failed')}
+        stats['oldest_pending_seconds'] = round(time.time() - oldest, 3) if oldest is not None else 0.0
+        for i, phase in enumerate(('wait', 'run')):
+            for quantile in (50, 95):
+                stats[f'{phase}_seconds_p{quantile}'] = (round(float(np.percentile(times[:, i], quantile)), 3)
+                                                         if len(times) else 0.0)
+        return stats
+
+
+_db_path = os.getenv('RECOMMENDER_TRAINING_DB', DEFAULT_DB_PATH)
+training_queue = TrainingQueue(_db_path) if _db_path else None
+
+
+def interactions_payload(user_id: str) -> Dict[str, List[str]]:
+    """The user's liked, disliked and saved product texts from style_interactions."""
+    from product_cache import get_supabase_client
+    client = get_supabase_client()
+    if client is None:
+        raise RuntimeError('Supabase is not configured')
+    rows = (client.table('style_interactions').select('action,product_name,product_description')
+            .eq('user_id', user_id).order('timestamp').execute().data or [])
+    payload: Dict[str, List[str]] = {'liked': [], 'disliked': [], 'saved': []}
+    keys = {'like': 'liked', 'dislike': 'disliked', 'save': 'saved'}
+    for row in rows:
+        text = row.get('product_description') or row.get('product_name')
+        if text and row.get('action') in keys:
+            payload[keys[row['action']]].append(text)
+    return payload
+
+
+_worker_model = None
+
+
+def _init_worker(threads: int):
+    """Load the base encoder once per worker and give it a share of the CPUs."""
+    global _worker_model
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from sentence_transformers import SentenceTransformer
+    from user_adapters import BASE_MODEL
+    _worker_model = SentenceTransformer(BASE_MODEL)
+
+
+def _run_job(user_id: str, payload: Dict[str, Any]) -> str:
+    from user_adapters import train_user_adapter
+    if not any(payload.get(key) for key in ('liked', 'disliked', 'saved')):
+        payload = dict(payload, **interactions_payload(user_id))
+    return train_user_adapter(user_id, payload.get('liked'), payload.get('disliked'), payload.get('saved'),
+                              model=_worker_model, rank=int(payload.get('rank') or DEFAULT_RANK))
+
+
+class TrainingScheduler:
+    """Runs queued jobs on a bounded process pool; one scheduler per queue."""
+
+    def __init__(self, queue: TrainingQueue, workers: int = DEFAULT_WORKERS):
+        self.queue = queue
+        self.workers = max(1, workers)
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire(self) -> bool:
+        """Take the queue's scheduler lock; False if another scheduler holds it."""
+        lock_file = open(f"{self.queue.path}.lock", 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        requeued = self.queue.requeue_running()
+        if requeued:
+            print(f"[TRAINING] Requeued {requeued} jobs left running by a previous scheduler", file=sys.stderr)
+        return True
+
+    def release(self):
+        """Give up the scheduler lock."""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def drain(self):
+        """Run jobs until the queue is empty, then release the lock.
+
+        A drain started while this one is deciding to exit finds the lock
+        taken and leaves its job to us. So once the lock is released, the
+        queue is checked again and drained again if jobs are waiting and the
+        lock is free; if it is not, the new holder will pick them up.
+        """
+        while True:
+            self.run(drain=True)
+            self.release()
+            if not self.queue.pending() or not self.acquire():
+                return
+
+    def run(self, drain: bool = False):
+        """Run jobs until stopped, or until the queue is empty with drain."""
+        threads = max(1, (os.cpu_count() or 1) // self.workers)
+        # Spawned workers do not inherit the parent's threads and loaded model
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_worker, initargs=(threads,))
+        running = {}
+        try:
+            while not self._stop.is_set():
+                for job in self.queue.claim(self.workers - len(running)):
+                    metrics.observe('recommender_training_seconds', job['started_at'] - job['enqueued_at'],
+                                    phase='wait')
+                    try:
+                        running[pool.submit(_run_job, job['user_id'], job['payload'])] = job
+                    except Exception as e:
+                        self.queue.finish(job['id'], f"Could not start job: {e}")
+                        raise
+                if not running:
+                    if drain:
+                        return
+                    self._stop.wait(POLL_SECONDS)
+                    continue
+                done, _ = wait(list(running), timeout=POLL_SECONDS, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    self._finish(job, future)
+        finally:
+            pool.shutdown(wait=True)
+            for future, job in running.items():
+                self._finish(job, future)
+
+    def _finish(self, job: Dict[str, Any], future):
+        try:
+            path = future.result()
+            error = None
+        except Exception as e:
+            path, error = None, str(e) or type(e).__name__
+        self.queue.finish(job['id'], error)
+        metrics.observe('recommender_training_seconds', time.time() - job['started_at'], phase='run')
+        increment('recommender_training_jobs_total', result='failed' if error else 'done')
+        if error:
+            print(f"[TRAINING] Job {job['id']} for user {job['user_id']} failed: {error}", file=sys.stderr)
+        else:
+            print(f"[TRAINING] Job {job['id']} for user {job['user_id']} wrote {path}", file=sys.stderr)
+
+    def start(self) -> bool:
+        """Run the scheduler on a background thread if no other scheduler holds the queue."""
+        if not self.acquire():
+            print("[TRAINING] Another scheduler is running this queue", file=sys.stderr)
+            return False
+        self._thread = threading.Thread(target=self.run, name='training-scheduler', daemon=True)
+        self._thread.start()
+        print(f"[TRAINING] Scheduler started with {self.workers} workers", file=sys.stderr)
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Queue and run user adapter training jobs')
+    parser.add_argument('command', choices=['enqueue', 'worker', 'stats'],
+                        help='enqueue: queue a job; worker: run queued jobs; stats: print queue depth and latency')
+    parser.add_argument('user_id', type=str, nargs='?', help='User to train (enqueue only)')
+    parser.add_argument('--liked', type=str, help='Liked product descriptions as a JSON array')
+    parser.add_argument('--disliked', type=str, help='Disliked product descriptions as a JSON array')
+    parser.add_argument('--saved', type=str, help='Saved product descriptions as a JSON array')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='Training processes to run at once')
+    parser.add_argument('--drain', action='store_true',
+                        help='Run queued jobs and exit once the queue is empty (with enqueue: unless a worker '
+                             'is already running)')
+    args = parser.parse_args()
+
+    if training_queue is None:
+        print("RECOMMENDER_TRAINING_DB is empty; nothing to do", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command == 'stats':
+        print(json.dumps(training_queue.stats(), indent=2))
+        return
+
+    if args.command == 'enqueue':
+        if not args.user_id:
+            parser.error('enqueue needs a user_id')
+        payload = {key: json.loads(value) for key, value in
+                   (('liked', args.liked), ('disliked', args.disliked), ('saved', args.saved)) if value}
+        job_id = training_queue.enqueue(args.user_id, payload)
+        print(json.dumps({"user_id": args.user_id, "job_id": job_id}))
+        if not args.drain:
+            return
+
+    scheduler = TrainingScheduler(training_queue, workers=args.workers)
+    if not scheduler.acquire():
+        print("[TRAINING] Another scheduler is running this queue", file=sys.stderr)
+        sys.exit(0 if args.command == 'enqueue' else 1)
+    try:
+        if args.drain:
+            scheduler.drain()
+        else:
+            scheduler.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+user_adapters.py
+
+Lightweight per-user personalisation on top of the shared base encoder.
+
+Instead of fine-tuning and saving a full SentenceTransformer per user, a user
+is represented by a small adapter stored in models/<user_id>_adapter.npz:
+
+    bias            preference direction: mean liked/saved minus mean disliked
+    basis           d x rank orthonormal basis of the user's liked embeddings
+    user_embedding  mean liked/saved embedding, used when no query is given
+
+A query embedding q from the base model is adapted as
+
+    q' = normalize(q + gain * basis @ basis.T @ q + alpha * bias)
+
+which boosts the components of the query that lie in the user's taste
+subspace and nudges it towards what they liked and away from what they
+disliked. With the default rank of 4 an adapter is about 10 KB, and applying
+it needs no model load at all.
+
+Train an adapter (same arguments as the old retrain script):
+
+    python recommender/user_adapters.py <user_id> --liked '["..."]' --disliked '["..."]'
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+
+from vector_store import MODELS_DIR
+
+BASE_MODEL = 'all-MiniLM-L6-v2'
+DEFAULT_RANK = 4
+DEFAULT_GAIN = 0.5
+DEFAULT_ALPHA = 0.3
+# Dislikes push away less strongly than likes pull, as in the swipe UI a
+# dislike is often "not right now" rather than "never"
+DISLIKE_WEIGHT = 0.5
+
+
+def adapter_path(user_id: str) -> str:
+    return os.path.join(MODELS_DIR, f"{user_id}_adapter.npz")
+
+
+def _normalize(vector: np.ndarray) -> np.ndarray:
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class UserAdapter:
+    """A user's preference bias and low-rank taste subspace."""
+
+    def __init__(self, user_id: str, bias: np.ndarray, basis: np.ndarray, user_embedding: np.ndarray,
+                 gain: float = DEFAULT_GAIN, alpha: float = DEFAULT_ALPHA, metadata: Optional[dict] = None):
+        self.user_id = user_id
+        self.bias = bias.astype(np.float32)
+        self.basis = basis.astype(np.float32)
+        self.user_embedding = user_embedding.astype(np.float32)
+        self.gain = gain
+        self.alpha = alpha
+        self.metadata = metadata or {}
+
+    @property
+    def nbytes(self) -> int:
+        return self.bias.nbytes + self.basis.nbytes + self.user_embedding.nbytes
+
+    def apply(self, query: np.ndarray) -> np.ndarray:
+        """Adapt a base-model query embedding (or rows of them) to this user."""
+        query = np.asarray(query, dtype=np.float32)
+        norms = np.linalg.norm(query, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        query = query / norms
+        adapted = query + self.gain * (query @ self.basis) @ self.basis.T + self.alpha * self.bias
+        norms = np.linalg.norm(adapted, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return adapted / norms
+
+    def save(self, path: Optional[str] = None) -> str:
+        path = path or adapter_path(self.user_id)
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # A temporary file per writer, so concurrent saves never interleave
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.npz', delete=False) as f:
+            np.savez(f,
+                     bias=self.bias,
+                     basis=self.basis,
+                     user_embedding=self.user_embedding,
+                     gain=np.float32(self.gain),
+                     alpha=np.float32(self.alpha),
+                     metadata=np.array(json.dumps(self.metadata)))
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+        return path
+
+    @classmethod
+    def load(cls, user_id: str, path: Optional[str] = None) -> 'UserAdapter':
+        data = np.load(path or adapter_path(user_id), allow_pickle=False)
+        return cls(user_id, data['bias'], data['basis'], data['user_embedding'],
+                   gain=float(data['gain']), alpha=float(data['alpha']),
+                   metadata=json.loads(str(data['metadata'])))
+
+
+def load_adapter(user_id: str) -> Optional[UserAdapter]:
+    """Return the user's adapter, or None if they do not have one."""
+    path = adapter_path(user_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        return UserAdapter.load(user_id, path)
+    except Exception as e:
+        print(f"[ADAPTER] Error loading adapter from {path}: {e}", file=sys.stderr)
+        return None
+
+
+def fit_adapter(user_id: str, liked_embeddings: np.ndarray, disliked_embeddings: Optional[np.ndarray] = None,
+                rank: int = DEFAULT_RANK, gain: float = DEFAULT_GAIN, alpha: float = DEFAULT_ALPHA,
+                metadata: Optional[dict] = None) -> UserAdapter:
+    """Fit an adapter from embeddings of the products a user liked and disliked."""
+    liked = np.asarray(liked_embeddings, dtype=np.float32)
+    liked = liked / np.maximum(np.linalg.norm(liked, axis=1, keepdims=True), 1e-12)
+    user_embedding = _normalize(liked.mean(axis=0))
+
+    bias = user_embedding.copy()
+    if disliked_embeddings is not None and len(disliked_embeddings):
+        disliked = np.asarray(disliked_embeddings, dtype=np.float32)
+        disliked = disliked / np.maximum(np.linalg.norm(disliked, axis=1, keepdims=True), 1e-12)
+        bias = bias - DISLIKE_WEIGHT * disliked.mean(axis=0)
+    bias = _normalize(bias)
+
+    # Top principal directions of the liked items span the user's taste subspace
+    rank = max(1, min(rank, len(liked)))
+    _, _, vt = np.linalg.svd(liked, full_matrices=False)
+    basis = vt[:rank].T
+
+    return UserAdapter(user_id, bias, basis, user_embedding, gain=gain, alpha=alpha, metadata=metadata)
+
+
+def train_user_adapter(user_id: str, liked: Optional[List[str]], disliked: Optional[List[str]] = None,
+                       saved: Optional[List[str]] = None, model=None, rank: int = DEFAULT_RANK) -> str:
+    """Encode the user's swiped product texts with the base model, fit and save an adapter."""
+    start = time.time()
+    liked = list(liked or [])
+    disliked = list(disliked or [])
+    saved = list(saved or [])
+    print(f"[ADAPTER] Training adapter for user {user_id}: {len(liked)} liked, "
+          f"{len(disliked)} disliked, {len(saved)} saved", file=sys.stderr)
+
+    positives = liked + saved
+    if not positives:
+        print("[ADAPTER] No liked items provided, using a neutral example", file=sys.stderr)
+        positives = ["neutral style item"]
+
+    if model is None:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(BASE_MODEL)
+
+    liked_embeddings = model.encode(positives)
+    disliked_embeddings = model.encode(disliked) if disliked else None
+    adapter = fit_adapter(user_id, liked_embeddings, disliked_embeddings, rank=rank, metadata={
+        'user_id': user_id,
+        'base_model': BASE_MODEL,
+        'liked_count': len(liked),
+        'disliked_count': len(disliked),
+        'saved_count': len(saved),
+        'timestamp': datetime.now().isoformat(),
+    })
+    path = adapter.save()
+    print(f"[ADAPTER] Saved {adapter.nbytes} byte adapter to {path} in {time.time() - start:.2f}s", file=sys.stderr)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Train a lightweight per-user style adapter')
+    parser.add_argument('user_id', type=str, help='User to personalise for')
+    parser.add_argument('--liked', type=str, help='Liked product descriptions as a JSON array')
+    parser.add_argument('--disliked', type=str, help='Disliked product descriptions as a JSON array')
+    parser.add_argument('--saved', type=str, help='Saved product descriptions as a JSON array')
+    parser.add_argument('--rank', type=int, default=DEFAULT_RANK, help='Rank of the taste subspace')
+    args = parser.parse_args()
+
+    try:
+        path = train_user_adapter(
+            args.user_id,
+            json.loads(args.liked) if args.liked else [],
+            json.loads(args.disliked) if args.disliked else [],
+            json.loads(args.saved) if args.saved else [],
+            rank=args.rank
+        )
+    except Exception as e:
+        print(f"[ADAPTER] Error training adapter: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps({"user_id": args.user_id, "adapter_path": path}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+"""
+vector_store.py
+
+On-disk format for the catalog's product vectors, replacing the
+product_embeddings.npy / product_ids.npy pair.
+
+A store is a single file laid out as:
+
+    [header]   HEADER_SIZE bytes: magic, then a JSON header padded with spaces
+    [vectors]  count x dim L2-normalised float32 (or float16) rows
+    [ids]      count fixed-width ASCII product IDs
+    [hashes]   optional: count hex digests of the text each vector was encoded from
+
+The header records the encoder model, dimension, dtype, row count and the
+byte offsets of each section. The content hashes let incremental builds skip
+re-encoding products whose text has not changed. Both sections are opened with np.memmap, so
+loading is close to instant and every worker process on the host shares the
+same page-cached copy instead of holding its own.
+
+Convert the legacy .npy files with:
+
+    python recommender/vector_store.py convert
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+MODELS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+STORE_PATH = os.path.join(MODELS_DIR, 'product_vectors.store')
+LEGACY_EMBEDDINGS_PATH = os.path.join(MODELS_DIR, 'product_embeddings.npy')
+LEGACY_IDS_PATH = os.path.join(MODELS_DIR, 'product_ids.npy')
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+MAGIC = b'SPMVEC1\n'
+HEADER_SIZE = 4096
+# Product IDs are UUIDs
+DEFAULT_ID_WIDTH = 36
+# Hex blake2b-128 digests; see embedding_builder.content_hash
+HASH_WIDTH = 32
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+
+def _align(offset: int, alignment: int = 64) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorStore:
+    """Read-only, memory-mapped view of a product vector store."""
+
+    def __init__(self, path: str, header: dict, vectors: np.ndarray, ids: np.ndarray,
+                 hashes: Optional[np.ndarray] = None):
+        self.path = path
+        self.header = header
+        self.vectors = vectors
+        self.ids = ids
+        self.hashes = hashes
+
+    def __len__(self):
+        return self.header['count']
+
+    @property
+    def model(self) -> str:
+        return self.header['model']
+
+    @property
+    def dim(self) -> int:
+        return self.header['dim']
+
+    def product_id(self, row: int) -> str:
+        return self.ids[row].decode('ascii')
+
+    def product_ids(self) -> List[str]:
+        return [product_id.decode('ascii') for product_id in self.ids]
+
+    @classmethod
+    def open(cls, path: str = STORE_PATH) -> 'VectorStore':
+        header = read_header(path)
+        count, dim = header['count'], header['dim']
+        vectors = np.memmap(path, dtype=header['dtype'], mode='r',
+                            offset=header['vectors_offset'], shape=(count, dim)) if count else \
+            np.empty((0, dim), dtype=header['dtype'])
+        ids = np.memmap(path, dtype=f"S{header['id_width']}", mode='r',
+                        offset=header['ids_offset'], shape=(count,)) if count else \
+            np.empty(0, dtype=f"S{header['id_width']}")
+        hashes = None
+        if header.get('hashes_offset') is not None:
+            hashes = np.memmap(path, dtype=f"S{HASH_WIDTH}", mode='r',
+                               offset=header['hashes_offset'], shape=(count,)) if count else \
+                np.empty(0, dtype=f"S{HASH_WIDTH}")
+        return cls(path, header, vectors, ids, hashes)
+
+
+def read_header(path: str) -> dict:
+    with open(path, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if not raw.startswith(MAGIC):
+        raise ValueError(f"{path} is not a product vector store")
+    return json.loads(raw[len(MAGIC):].decode('ascii'))
+
+
+class VectorStoreWriter:
+    """Writes a vector store, appending vectors in batches as they are produced.
+
+    Rows are normalised as they are appended and the file is written to a
+    temporary path and moved into place on close(), so readers never see a
+    partially written store. id_width is the starting width of the ID
+    column; it widens when a longer ID is appended.
+    """
+
+    def __init__(self, path: str = STORE_PATH, dim: int = 384, model: str = DEFAULT_MODEL,
+                 dtype: str = 'float32', id_width: int = DEFAULT_ID_WIDTH, with_hashes: bool = False):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype}; expected one of {SUPPORTED_DTYPES}")
+        self.path = path
+        self.dim = dim
+        self.model = model
+        self.dtype = dtype
+        self.id_width = id_width
+        self.count = 0
+        self._directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(self._directory, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=self._directory, prefix='.vectors-', delete=False)
+        self._ids = tempfile.TemporaryFile(dir=self._directory)
+        self._hashes = tempfile.TemporaryFile(dir=self._directory) if with_hashes else None
+        self._file.write(b'\0' * HEADER_SIZE)
+
+    def append(self, ids: Iterable[str], vectors: np.ndarray, hashes: Optional[Iterable[str]] = None,
+               normalized: bool = False):
+        """Append rows; pass normalized=True for rows copied from an existing store."""
+        ids = [str(product_id) for product_id in ids]
+        vectors = np.asarray(vectors)
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected vectors of shape (n, {self.dim}), got {vectors.shape}")
+        if len(ids) != len(vectors):
+            raise ValueError(f"Got {len(ids)} IDs for {len(vectors)} vectors")
+        width = max((len(product_id.encode('ascii')) for product_id in ids), default=0)
+        if width > self.id_width:
+            self._widen_ids(width)
+        if self._hashes is not None:
+            hashes = list(hashes) if hashes is not None else []
+            if len(hashes) != len(ids):
+                raise ValueError(f"Got {len(hashes)} content hashes for {len(ids)} IDs")
+            self._hashes.write(np.array(hashes, dtype=f"S{HASH_WIDTH}").tobytes())
+        rows = vectors if normalized else _normalize(vectors)
+        self._file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self._ids.write(np.array(ids, dtype=f"S{self.id_width}").tobytes())
+        self.count += len(ids)
+
+    def close(self) -> dict:
+        itemsize = np.dtype(self.dtype).itemsize
+        ids_offset = _align(HEADER_SIZE + self.count * self.dim * itemsize)
+        self._file.write(b'\0' * (ids_offset - self._file.tell()))
+        self._copy_section(self._ids)
+        hashes_offset = None
+        if self._hashes is not None:
+            hashes_offset = self._file.tell()
+            self._copy_section(self._hashes)
+
+        header = {
+            'model': self.model,
+            'dim': self.dim,
+            'count': self.count,
+            'dtype': self.dtype,
+            'normalized': True,
+            'id_width': self.id_width,
+            'vectors_offset': HEADER_SIZE,
+            'ids_offset': ids_offset,
+            'hashes_offset': hashes_offset,
+        }
+        encoded = MAGIC + json.dumps(header).encode('ascii')
+        if len(encoded) > HEADER_SIZE:
+            raise ValueError("Vector store header does not fit in the reserved space")
+        self._file.seek(0)
+        self._file.write(encoded.ljust(HEADER_SIZE, b' '))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        # NamedTemporaryFile creates the file owner-only; readers may be other users
+        os.chmod(self._file.name, 0o644)
+        os.replace(self._file.name, self.path)
+        return header
+
+    def _widen_ids(self, width: int):
+        """Rewrite the IDs spooled so far at a wider fixed width."""
+        widened = tempfile.TemporaryFile(dir=self._directory)
+        self._ids.seek(0)
+        while True:
+            chunk = self._ids.read(self.id_width * 65536)
+            if not chunk:
+                break
+            widened.write(np.frombuffer(chunk, dtype=f"S{self.id_width}").astype(f"S{width}").tobytes())
+        self._ids.close()
+        self._ids = widened
+        self.id_width = width
+
+    def _copy_section(self, spool):
+        spool.seek(0)
+        while True:
+            chunk = spool.read(1 << 20)
+            if not chunk:
+                break
+            self._file.write(chunk)
+        spool.close()
+
+    def abort(self):
+        """Discard everything written so far."""
+        self._ids.close()
+        if self._hashes is not None:
+            self._hashes.close()
+        self._file.close()
+        os.unlink(self._file.name)
+
+
+def write_vector_store(ids: List[str], vectors: np.ndarray, path: str = STORE_PATH,
+                       model: str = DEFAULT_MODEL, dtype: str = 'float32',
+                       hashes: Optional[List[str]] = None) -> dict:
+    """Write all vectors in one go; see VectorStoreWriter for batched writes."""
+    vectors = np.asarray(vectors)
+    id_width = max([DEFAULT_ID_WIDTH] + [len(str(product_id)) for product_id in ids])
+    writer = VectorStoreWriter(path, dim=vectors.shape[1], model=model, dtype=dtype, id_width=id_width,
+                               with_hashes=hashes is not None)
+    try:
+        writer.append(ids, vectors, hashes)
+    except Exception:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def load_product_vectors(path: str = STORE_PATH) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """Return (ids, vectors, normalized) from the store, or the legacy .npy files."""
+    if os.path.exists(path):
+        store = VectorStore.open(path)
+        print(f"[STORE] Opened {path}: {len(store)} x {store.dim} {store.header['dtype']} "
+              f"({store.model})", file=sys.stderr)
+        return store.ids, store.vectors, True
+    print(f"[STORE] No vector store at {path}, loading legacy .npy embeddings", file=sys.stderr)
+    return np.load(LEGACY_IDS_PATH, allow_pickle=True), np.load(LEGACY_EMBEDDINGS_PATH), False
+
+
+def catalog_version(path: str = STORE_PATH) -> str:
+    """Identify the product vectors load_product_vectors would return, by file and mtime."""
+    for candidate in (path, LEGACY_EMBEDDINGS_PATH):
+        if os.path.exists(candidate):
+            return f"{os.path.basename(candidate)}@{os.path.getmtime(candidate)}"
+    return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the product vector store')
+    parser.add_argument('command', choices=['convert', 'info'],
+                        help='convert: build the store from the legacy .npy files; info: print the header')
+    parser.add_argument('--path', type=str, default=STORE_PATH, help='Vector store path')
+    parser.add_argument('--dtype', type=str, default='float32', choices=SUPPORTED_DTYPES, help='Stored vector dtype')
+    parser.add_argument('--model', type=str, default=DEFAULT_MODEL, help='Encoder that produced the embeddings')
+    args = parser.parse_args()
+
+    if args.command == 'info':
+        print(json.dumps(read_header(args.path), indent=2))
+        return
+
+    ids = [str(product_id) for product_id in np.load(LEGACY_IDS_PATH, allow_pickle=True)]
+    vectors = np.load(LEGACY_EMBEDDINGS_PATH)
+    header = write_vector_store(ids, vectors, args.path, model=args.model, dtype=args.dtype)
+    print(f"Wrote {header['count']} x {header['dim']} {header['dtype']} vectors to {args.path}")
+
+
+if __name__ == '__main__':
+    main()